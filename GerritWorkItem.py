@@ -7,6 +7,18 @@ import operator
 import subprocess
 import pickle as pickle
 
+# Attributes recorded in every journal entry
+JOURNALED_STATE = ('buildnr', 'artifactsdir', 'testresultsdir', 'distro',
+                   'retestiteration', 'EmptyJob', 'Aborted', 'AbortDone',
+                   'BuildDone', 'BuildError', 'recovering',
+                   'InitialTestingStarted', 'InitialTestingError',
+                   'InitialTestingDone', 'TestingStarted', 'TestingDone',
+                   'TestingError', 'AddedTestFailure', 'FinalReportPosted',
+                   'crash_ids_reported', 'ReviewComments',
+                   'PredictedCompletion')
+# Rewrite the full snapshot after this many journal entries
+JOURNAL_COMPACT_EVERY = 50
+
 class GerritWorkItem(object):
     def __init__(self, change, builds, initialtestlist, testlist, fsconfig, EmptyJob=False, Reviewer=None, DISTRO=None):
         self.change = change
@@ -49,19 +61,30 @@ class GerritWorkItem(object):
         self.retestiteration = 0
         self.crash_ids_reported = []
         self.FinalReportPosted = False
+        self.PredictedCompletion = None
+        self.savepath = None # where our snapshot+journal live
+        self.savename = None
+        self.journalcount = 0
 
     def __getstate__(self):
         state = self.__dict__.copy()
         del state['lock']
         del state['fsconfig']
         del state['Reviewer'] # no posts on restarts?
+        for item in ('savepath', 'savename', 'journalcount'):
+            state.pop(item, None)
         return state
     def __setstate__(self, state):
         self.__dict__.update(state)
         self.lock = threading.Lock()
         self.Reviewer = None
+        self.savepath = None
+        self.savename = None
+        self.journalcount = 0
         if not self.__dict__.get('retestiteration'):
             self.retestiteration = 0
+        if not self.__dict__.get('PredictedCompletion'):
+            self.PredictedCompletion = None
         if not self.__dict__.get('distro'):
             self.distro = "centos7" # only matters for old items
         if not self.__dict__.get('builds'):
@@ -153,6 +176,7 @@ class GerritWorkItem(object):
                 except OSError:
                     pass # not that it ever was a problem, but just in case
 
+        self._journal_build(buildinfo)
         self.Write_HTML_Status()
         self.lock.release()
 
@@ -162,7 +186,10 @@ class GerritWorkItem(object):
                          TestStdOut=None, TestStdErr=None, Subtests=None,
                          Skipped=None, Warnings=None):
         self.lock.acquire()
-        if self.InitialTestingStarted and not self.InitialTestingDone:
+        if testinfo.get('Speculative'):
+            # Comprehensive test started early on an idle tester
+            worklist = self.tests
+        elif self.InitialTestingStarted and not self.InitialTestingDone:
             worklist = self.initial_tests
         elif self.TestingStarted and not self.TestingDone:
             worklist = self.tests
@@ -188,7 +215,9 @@ class GerritWorkItem(object):
                 Failed = True
             if Failed:
                 Finished = True
-                if not self.InitialTestingDone:
+                if testinfo.get('Speculative') and not self.InitialTestingDone:
+                    self.TestingError = True
+                elif not self.InitialTestingDone:
                     self.InitialTestingError = True
                 else:
                     self.TestingError = True
@@ -227,14 +256,18 @@ class GerritWorkItem(object):
         if Finished:
             for item in worklist:
                 if not item.get("Finished", False):
+                    self._journal_test(testinfo)
                     self.lock.release()
                     return
             # All entires are finished, time to mark the set
-            if not self.InitialTestingDone:
+            if worklist is self.tests and not self.TestingStarted:
+                pass # Speculative run got ahead, manager sorts it out
+            elif not self.InitialTestingDone:
                 self.InitialTestingDone = True
             elif not self.TestingDone:
                 self.TestingDone = True
 
+        self._journal_test(testinfo)
         self.lock.release()
         if Finished and self.fsconfig.get("testdone-cb"):
             args = [self.fsconfig["testdone-cb"], str(Failed), str(Timeout), str(Crash), str(self.buildnr), str(testinfo.get("ResultsDir"))]
@@ -243,8 +276,52 @@ class GerritWorkItem(object):
             except OSError as e:
                 print("Error running testset callback for " + str(args))
 
+    def merge_shards(self, tests):
+        """ Fold autoshard shards back into one logical test entry each """
+        result = []
+        merged = {}
+        for test in tests:
+            if not test.get('ShardOf'):
+                result.append(test)
+                continue
+            key = (test['ShardOf'], test.get('fstype'), test.get('DNE', False), test.get('SSK', False), test.get('SELINUX', False))
+            entry = merged.get(key)
+            if entry is None:
+                entry = dict(test)
+                entry['name'] = test['ShardOf']
+                entry['Shards'] = []
+                for item in ('ResultsDir', 'StatusMessage', 'SubtestList', 'SkippedSubtests', 'Warnings', 'NewWarnings', 'NewFailures', 'OldFailures'):
+                    entry.pop(item, None)
+                entry['Finished'] = True
+                for item in ('Failed', 'Crash', 'Timeout', 'Aborted', 'Skipped'):
+                    entry[item] = False
+                merged[key] = entry
+                result.append(entry)
+            entry['Shards'].append(test)
+            entry['Finished'] = entry['Finished'] and test.get('Finished', False)
+            for item in ('Failed', 'Crash', 'Timeout', 'Aborted', 'Skipped'):
+                entry[item] = entry[item] or test.get(item, False)
+            if test.get('ResultsDir') and not entry.get('ResultsDir'):
+                entry['ResultsDir'] = test['ResultsDir']
+            for item in ('SubtestList', 'SkippedSubtests', 'Warnings'):
+                if test.get(item):
+                    entry[item] = entry.get(item, '') + test[item]
+            for item in ('NewWarnings', 'NewFailures', 'OldFailures'):
+                if test.get(item):
+                    entry[item] = entry.get(item, []) + test[item]
+
+        for entry in merged.values():
+            messages = []
+            for shard in sorted(entry['Shards'], key=lambda x: x.get('ShardIndex', 0)):
+                if shard.get('StatusMessage') and (shard.get('Failed') or not entry['Failed']):
+                    messages.append("[%d/%d] %s" % (shard.get('ShardIndex', 0), shard.get('ShardCount', 0), shard['StatusMessage']))
+            if messages:
+                entry['StatusMessage'] = " ".join(messages)
+        return result
+
     def testresults_as_html(self, tests):
         htmlteststable = '<table border="1"><tr><th>Test</th><th>Status/results</th><th>Extra info</th></tr>'
+        tests = self.merge_shards(tests)
         for test in sorted(tests, key=operator.itemgetter('test', 'fstype')):
             htmlteststable += '<tr><td>'
             htmlteststable += test['name'] + '@' + test['fstype']
@@ -294,6 +371,12 @@ class GerritWorkItem(object):
 
             if test.get('ResultsDir'):
                 htmlteststable += '</a>'
+            if test.get('Shards'):
+                htmlteststable += ' (shards:'
+                for shard in sorted(test['Shards'], key=lambda x: x.get('ShardIndex', 0)):
+                    if shard.get('ResultsDir'):
+                        htmlteststable += ' <a href="' + shard['ResultsDir'].replace(self.artifactsdir + '/', '') + '/">' + str(shard.get('ShardIndex', 0)) + '</a>'
+                htmlteststable += ')'
 
             htmlteststable += '</td><td>'
             if test.get("Failed", False):
@@ -317,6 +400,12 @@ class GerritWorkItem(object):
             return
         if self.change.get('branchwide'):
             change = '<a href="https://git.whamcloud.com/fs/lustre-release.git/shortlog/%s">Then tip of %s branch "%s"</a>' % (self.change['current_revision'], self.change['branch'], self.change['subject'])
+        elif self.change.get('batch'):
+            members = []
+            for member in self.change['batch']:
+                nr = member['change']['_number']
+                members.append('<a href="http://review.whamcloud.com/%d">%d</a>' % (nr, nr))
+            change = 'batch of %s on %s branch' % (", ".join(members), self.change['branch'])
         else:
             # XXX - need to somehow pass in GERRIT_HOST
             change = '<a href="http://review.whamcloud.com/%d">%d rev %d: %s</a>' % (self.changenr, self.changenr, self.change['revisions'][str(self.revision)]["_number"], self.change['subject'])
@@ -413,6 +502,7 @@ class GerritWorkItem(object):
     def requested_tests_string(self, tests):
         testlist = ""
         self.lock.acquire()
+        tests = self.merge_shards(tests)
         for test in sorted(tests, key=operator.itemgetter('test', 'fstype')):
             testlist += test['name'] + '@' + test['fstype']
             if test.get('DNE', False):
@@ -432,6 +522,7 @@ class GerritWorkItem(object):
         warningtests = ""
         newfailures = ""
         self.lock.acquire()
+        tests = self.merge_shards(tests)
         for test in sorted(tests, key=operator.itemgetter('test', 'fstype')):
             testname = test['name'] + '@' + test['fstype']
             if test.get('DNE', False):
@@ -522,18 +613,135 @@ class GerritWorkItem(object):
         name += ".pickle"
         return name
 
-    def save(self, path):
-        """ Saves the item with common name """
+    def _journaled_state(self):
+        state = {}
+        for item in JOURNALED_STATE:
+            state[item] = getattr(self, item, None)
+        return state
+
+    def _journal(self, record):
+        """ Append a state delta to our journal. Must hold the lock """
+        if not self.savepath:
+            return # No snapshot yet, nothing to append to
+        try:
+            with open(self.savepath + "/" + self.savename + ".journal", "ab") as journal:
+                pickle.dump(record, journal, pickle.HIGHEST_PROTOCOL)
+            self.journalcount += 1
+        except (OSError, RuntimeError, TypeError) as e:
+            print("Cannot append to journal of build " + str(self.buildnr) + ": " + str(e))
+            self.savepath = None # next save would write a full snapshot
+
+    def snapshot_next(self):
+        """ The journal only records changes inside builds, the test lists
+            and change, call this after replacing any of them so the
+            next save writes a full snapshot """
+        with self.lock:
+            self.savepath = None
+
+    def _journal_test(self, testinfo):
+        for listname in ('initial_tests', 'tests'):
+            for idx, item in enumerate(getattr(self, listname)):
+                if item is testinfo:
+                    self._journal(('test', listname, idx, dict(testinfo), self._journaled_state()))
+                    return
+        self._journal(('state', self._journaled_state()))
+
+    def _journal_build(self, buildinfo):
+        for idx, item in enumerate(self.builds):
+            if item is buildinfo:
+                self._journal(('build', idx, dict(buildinfo), self._journaled_state()))
+                return
+        self._journal(('state', self._journaled_state()))
+
+    def _replay(self, record):
+        if record[0] == 'test':
+            tests = getattr(self, record[1])
+            if record[2] < len(tests):
+                tests[record[2]].clear()
+                tests[record[2]].update(record[3])
+            else:
+                print("Journal of build " + str(self.buildnr) + " has " + record[1] + " entry " + str(record[2]) + " past the end, dropped")
+            state = record[4]
+        elif record[0] == 'build':
+            if record[1] < len(self.builds):
+                self.builds[record[1]].clear()
+                self.builds[record[1]].update(record[2])
+            else:
+                print("Journal of build " + str(self.buildnr) + " has build entry " + str(record[1]) + " past the end, dropped")
+            state = record[3]
+        else:
+            state = record[1]
+        for item, value in state.items():
+            setattr(self, item, value)
+
+    @staticmethod
+    def load(path, name):
+        """ Load a saved item: snapshot plus whatever is in its journal """
+        with open(path + "/" + name, "rb") as snapshot:
+            workitem = pickle.load(snapshot)
+        try:
+            with open(path + "/" + name + ".journal", "rb") as journal:
+                while True:
+                    try:
+                        record = pickle.load(journal)
+                    except EOFError:
+                        break
+                    except (pickle.UnpicklingError, ValueError, AttributeError):
+                        # Torn write on crash, the rest is lost anyway
+                        print("Truncated journal for " + path + "/" + name)
+                        break
+                    workitem._replay(record)
+        except OSError:
+            pass # No journal, snapshot is all there is
+        return workitem
+
+    def remove_saved(self, path):
+        """ Delete our snapshot and journal from path """
+        name = self.get_saved_name()
+        for filename in (name, name + ".journal"):
+            try:
+                os.unlink(path + "/" + filename)
+            except OSError:
+                pass
+        if self.savepath == path:
+            self.savepath = None
+
+    def save(self, path, Final=False):
+        """ Saves the item with common name. Once a snapshot exists only
+            the state changes are appended to a journal next to it, the
+            snapshot is rewritten every JOURNAL_COMPACT_EVERY entries.
+            Final saves write a full snapshot and stop journaling.
+            Returns False if nothing could be written this time. """
         name = self.get_saved_name()
 
-        with open(path + "/" + name, "wb") as output:
-            self.lock.acquire()
+        self.lock.acquire()
+        try:
+            if not Final and self.savepath == path and self.savename == name and \
+               self.journalcount < JOURNAL_COMPACT_EVERY:
+                self._journal(('state', self._journaled_state()))
+                return self.savepath is not None
+
             try:
-                pickle.dump(self, output, pickle.HIGHEST_PROTOCOL )
+                with open(path + "/" + name + ".tmp", "wb") as output:
+                    pickle.dump(self, output, pickle.HIGHEST_PROTOCOL)
             except RuntimeError:
-                pass # We just want to avoid the crash. next iteration will write it out.
+                return False # We just want to avoid the crash. next iteration will write it out.
             except TypeError:
                 # This is not supposed to happen, I guess
                 print("Cannot save due to type error")
                 print(self)
+                return False
+            os.replace(path + "/" + name + ".tmp", path + "/" + name)
+            try:
+                os.unlink(path + "/" + name + ".journal")
+            except OSError:
+                pass
+            if Final:
+                self.savepath = None
+            else:
+                self.savepath = path
+                self.savename = name
+            self.journalcount = 0
+            return True
+        finally:
             self.lock.release()
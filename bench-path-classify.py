@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+""" Benchmark old per-pattern fnmatch classification of changed files
+    against the compiled PathClassifier on a synthetic 10k files change.
+    Run from the top directory so filelists/*.json are found.
+"""
+import sys
+import json
+import time
+import fnmatch
+import random
+from mypathclassifier import PathClassifier
+
+TEST_SCRIPT_FILES = [ 'lustre/tests/*' ]
+LUTF_ONLY_FILES = [ 'lustre/tests/lutf/*' ]
+
+def match_fnmatch_list(item, fnlist):
+    for pattern in fnlist:
+        if fnmatch.fnmatch(item, pattern):
+            return True
+    return False
+
+def load(name):
+    with open("filelists/" + name + ".json", "r") as blah:
+        return json.load(blah)
+
+def make_synthetic_change(count):
+    dirs = ['lustre/llite', 'lustre/osd-ldiskfs', 'lustre/osd-zfs', 'lnet/lnet',
+            'lnet/klnds/socklnd', 'lustre/tests', 'lustre/tests/lutf/python',
+            'lustre/utils', 'lustre/ptlrpc', 'Documentation', 'contrib/scripts',
+            'lustre/scripts/systemd', 'config', 'debian', 'lustre/include']
+    exts = ['.c', '.h', '.sh', '.py', '.m4', '', '.in', '.am']
+    random.seed(42)
+    files = []
+    for i in range(count):
+        files.append("%s/file%d%s" % (random.choice(dirs), i, random.choice(exts)))
+    return files
+
+def classify_old(files, lists):
+    result = {}
+    for item in files:
+        result[item] = frozenset(name for name, patterns in lists if match_fnmatch_list(item, patterns))
+    return result
+
+def classify_new(files, classifier):
+    result = {}
+    for item in files:
+        result[item] = classifier.classify(item)
+    return result
+
+if __name__ == "__main__":
+    count = 10000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    lists = [('ignore', load('ignore')), ('lutf', LUTF_ONLY_FILES),
+             ('testscript', TEST_SCRIPT_FILES), ('buildonly', load('buildonly')),
+             ('zfs', load('zfs')), ('ldiskfs', load('ldiskfs')),
+             ('lnet', load('lnet'))]
+    files = make_synthetic_change(count)
+
+    start = time.time()
+    old = classify_old(files, lists)
+    oldtime = time.time() - start
+
+    start = time.time()
+    classifier = PathClassifier(lists)
+    new = classify_new(files, classifier)
+    newtime = time.time() - start
+
+    start = time.time()
+    classify_new(files, classifier)
+    cachedtime = time.time() - start
+
+    if old != new:
+        print("MISMATCH between old and new classification!")
+        sys.exit(1)
+
+    print("%d files, %d patterns" % (count, sum(len(x[1]) for x in lists)))
+    print("fnmatch per pattern:    %.3fs" % (oldtime))
+    print("compiled (incl. build): %.3fs" % (newtime))
+    print("compiled, memoized:     %.3fs" % (cachedtime))
@@ -24,9 +24,15 @@ BSCRIPT=$(gzip -9c ${BASENAME}/distros/${DISTRO}/bin-x86/run_build.sh | base64 -
 ssh -q -o StrictHostKeyChecking=no root@${REMOTEHOST} "mkdir -p /tmp/build.$$/git" || exit 1
 scp -q -o StrictHostKeyChecking=no -r ${GITSOURCE}/.git root@${REMOTEHOST}:"/tmp/build.$$/git/" || exit 1
 
-exec ssh -q -o StrictHostKeyChecking=no root@${REMOTEHOST} "modprobe nbd ; echo $BSCRIPT | base64 -d | zcat > /tmp/build.$$/run_build.sh ; chmod +x /tmp/build.$$/run_build.sh;"'NODE=$(nbd-client -N '${DISTRO}' -p -b 4096 '${NBDSERVER}' | tail -1 | sed "s/.*\/dev/\/dev/") ;'"systemd-nspawn -M ${5}.builder.localnet -P -q --read-only --bind=$1:/tmp/out \
+# Killing the local ssh does not stop the build on the remote host, so
+# when the build is cancelled (TERM to our process group) stop the
+# container there too. The remote side then cleans up as usual.
+trap 'ssh -q -o StrictHostKeyChecking=no -o ConnectTimeout=30 root@${REMOTEHOST} "machinectl terminate ${5}.builder.localnet" ; exit 143' TERM INT
+
+ssh -q -o StrictHostKeyChecking=no root@${REMOTEHOST} "modprobe nbd ; echo $BSCRIPT | base64 -d | zcat > /tmp/build.$$/run_build.sh ; chmod +x /tmp/build.$$/run_build.sh;"'NODE=$(nbd-client -N '${DISTRO}' -p -b 4096 '${NBDSERVER}' | tail -1 | sed "s/.*\/dev/\/dev/") ;'"systemd-nspawn -M ${5}.builder.localnet -P -q --read-only --bind=$1:/tmp/out \
 	--bind-ro=/tmp/build.$$:/home/green/bin \
 	--bind-ro=/tmp/build.$$/git:/home/green/git/lustre-release-base \
 	--bind=${CONFCACHESOURCE}:/tmp/confcache \
 	--tmpfs=/home/green/git/lustre-release:mode=777,size=3G -i "'$NODE'" \
-	-u $4 /home/green/bin/run_build.sh $2 $3 ;"'RETVAL=$?'"; rm -rf /tmp/build.$$"';sync;nbd-client -d $NODE;exit $RETVAL'
+	-u $4 /home/green/bin/run_build.sh $2 $3 ;"'RETVAL=$?'"; rm -rf /tmp/build.$$"';sync;nbd-client -d $NODE >/dev/null 2>&1;exit $RETVAL' &
+wait $!
@@ -48,8 +48,13 @@ cd ${TGTBUILD}
 cp -a ${SRCLOCATION}/.git . || exit 2
 git reset --hard >/dev/null 2>&1
 
-echo $REF | grep -q '^refs/' || git pull >/dev/null 2>&1
-(git fetch https://review.whamcloud.com/fs/lustre-release $REF && git checkout -f FETCH_HEAD ) >>${BUILDLOG} 2>&1
+if echo $REF | grep -q '^refs/batches/' ; then
+	# Combined tree of several changes, only exists in our source copy
+	git checkout -f $REF >>${BUILDLOG} 2>&1
+else
+	echo $REF | grep -q '^refs/' || git pull >/dev/null 2>&1
+	(git fetch https://review.whamcloud.com/fs/lustre-release $REF && git checkout -f FETCH_HEAD ) >>${BUILDLOG} 2>&1
+fi
 
 RETVAL=$?
 
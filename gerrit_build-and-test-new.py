@@ -47,17 +47,33 @@ import queue
 import threading
 import pwd
 import re
+import shlex
 import random
-import operator
+import itertools
 import mybuilder
 import mytester
 import mycrashanalyzer
 import mystatswriter
 from mytuplesorter import TupleSortingOn0
+from myconfigregistry import registry
+from mypathclassifier import PathClassifier
+from mytestcatalog import TestCatalog
+from myreviewhistory import ReviewHistory
+from mydonewithindex import DoneIndex
+from mycommandintake import CommandIntake
+from mygerritevents import make_event_source
+from mygerritclient import GerritClient
+from mypatchanalyzer import PatchAnalyzer
+from myruntimestats import RuntimeHistory, predict_makespan, make_shards
+from mytestqueue import FairShareQueue
+from mybuildqueue import BuildQueue
+from mybatcher import Batcher
+from mysupervisor import Supervisor
+from myadmission import BootAdmission
 from datetime import datetime
 import dateutil.parser
 import shutil
-import pickle
+import copy
 from pprint import pprint
 import subprocess
 import resource
@@ -82,6 +98,10 @@ GERRIT_DRYRUN = os.getenv('GERRIT_DRYRUN', None)
 GERRIT_FORCEALLTESTS = os.getenv('GERRIT_FORCEALLTESTS', None)
 GERRIT_BRANCHMONITORDIR = os.getenv('GERRIT_BRANCHMONITORDIR', "./branches/")
 GERRIT_COMMANDMONITORDIR = os.getenv('GERRIT_COMMANDMONITORDIR', "./commands/")
+GERRIT_CONTROLSOCKET = os.getenv('GERRIT_CONTROLSOCKET', None)
+# ssh, webhook or fake. When set the poll is only a reconciliation sweep
+GERRIT_EVENT_SOURCE = os.getenv('GERRIT_EVENT_SOURCE', None)
+GERRIT_RECONCILE_INTERVAL = int(os.getenv('GERRIT_RECONCILE_INTERVAL', '1800'))
 
 # When this is set - only changes with this topic would be tested.
 # good for trial runs before big deployment
@@ -89,8 +109,18 @@ GERRIT_FORCETOPIC = os.getenv('GERRIT_FORCETOPIC', None)
 
 SAVEDSTATE_DIR = "savedstate"
 DONEWITH_DIR = "donewith"
+DONEWITH_INDEX = "donewith.sqlite"
+RUNTIME_HISTORY_DB = "runtimes.sqlite"
 FAILED_POSTS_DIR = "failed_posts"
 LAST_BUILD_ID = "LASTBUILD_ID"
+SPECULATIVE_PRIORITY = 1 << 40 # Only run when testers have nothing else to do
+COMMAND_CHECK_INTERVAL = 1 # seconds between command directory checks
+COMMAND_SETTLE_TIME = 5 # how long to wait on unparseable command files
+SETTLE_WINDOW = 120 # hold new patchsets this long in case a newer one follows
+SETTLE_MAX_HOLD = 3 # but never more than this many windows in total
+HELD_SUFFIX = ".held" # branch request files are renamed to this while settling
+BATCH_SIZE = 8 # most changes built and tested together
+BATCH_WAIT = 600 # longest a change waits for others to batch with
 
 StopMachine = False
 StopOnIdle = False
@@ -108,7 +138,12 @@ managerthread = None
 #     ...
 # }
 
+# Legacy text history, imported into REVIEW_HISTORY_DB once
 REVIEW_HISTORY_PATH = os.getenv('REVIEW_HISTORY_PATH', 'REVIEW_HISTORY')
+REVIEW_HISTORY_DB = os.getenv('REVIEW_HISTORY_DB', 'REVIEW_HISTORY.sqlite')
+PATCH_MIRROR = os.getenv('PATCH_MIRROR', '/home/green/git/lustre-release-mirror.git')
+# Builders copy their tree from here, batches are pushed here as refs/batches/*
+GITSOURCE = os.getenv('GITSOURCE', '/home/green/git/lustre-release')
 STYLE_LINK = os.getenv('STYLE_LINK',
         'http://wiki.lustre.org/Lustre_Coding_Style_Guidelines')
 #TrivialNagMessage = 'It is recommended to add "Test-Parameters: trivial" directive to patches that do not change any running code to ease the load on the testing subsystem'
@@ -119,15 +154,21 @@ SuspiciousTrivialUsage = 'Suspicious test-param trivial usage for general code c
 USE_CODE_REVIEW_SCORE = False
 
 IGNORE_OLDER_THAN_DAYS = 30
+UPDATE_MAX_AGE = 4 * 3600 # Longest window to ask gerrit for updated changes
+UPDATE_AGE_SLACK = 300
 
-build_queue = queue.Queue()
+build_queue = BuildQueue(lambda entry: build_lane(entry), lambda entry, Primary=False: build_expected(entry, Primary), lambda entry: build_primary(entry))
 build_condition = threading.Condition()
-testing_queue = queue.PriorityQueue()
+testing_queue = FairShareQueue(lambda entry: test_share(entry), lambda share: test_share_weight(share), speculative=SPECULATIVE_PRIORITY)
 testing_condition = threading.Condition()
 managing_queue = queue.Queue()
 managing_condition = threading.Condition()
 reviewer = None
+CancelStats = {'builds':0, 'tests':0, 'builder-seconds':0, 'node-seconds':0}
+BatchIds = itertools.count(1)
 StatsWriter = None
+done_index = None
+patch_analyzer = None
 
 fsconfig = {}
 
@@ -153,14 +194,105 @@ def match_fnmatch_list(item, fnlist):
             return True
     return False
 
+def make_path_classifier(ignore, buildonly, ldiskfs, zfs, lnet):
+    return PathClassifier([('ignore', ignore or []),
+                           ('lutf', LUTF_ONLY_FILES),
+                           ('testscript', TEST_SCRIPT_FILES),
+                           ('buildonly', buildonly or []),
+                           ('zfs', zfs or []),
+                           ('ldiskfs', ldiskfs or []),
+                           ('lnet', lnet or []),
+                           ('unknown', I_DONT_KNOW_HOW_TO_TEST_THESE)])
+
+def get_path_classifier():
+    """ Classifier for current filelists, only recompiled when they change """
+    return registry.get_derived("path-classifier",
+                                ("filelists/ignore.json",
+                                 "filelists/buildonly.json",
+                                 "filelists/ldiskfs.json",
+                                 "filelists/zfs.json",
+                                 "filelists/lnet.json"),
+                                make_path_classifier)
+
+def get_test_catalog():
+    """ Catalog of all test lists, only rebuilt when they change """
+    return registry.get_derived("test-catalog",
+                                ("tests/initial.json",
+                                 "tests/comprehensive.json",
+                                 "tests/lnet.json", "tests/zfs.json",
+                                 "tests/ldiskfs.json"),
+                                TestCatalog)
+
 def is_notknow_howto_test(filelist):
     """ Returns true if there are any changed files that
         are not noops, but we are not testing it """
+    classifier = get_path_classifier()
     for item in sorted(filelist):
-        if match_fnmatch_list(item, I_DONT_KNOW_HOW_TO_TEST_THESE):
+        if 'unknown' in classifier.classify(item):
             return True
     return False
 
+def autoshard_test(test):
+    """ Split a test with 'autoshard' set into shards of about the
+        autoshard seconds (true means fsconfig autoshard-target) based on
+        recorded subtest durations. The last shard runs everything not in
+        the other shards so new subtests are not lost. Tests with --only
+        in testparam or without enough history are left alone. """
+    target = test.pop('autoshard', None)
+    runtimes = fsconfig.get('runtime-history')
+    if not target or not runtimes:
+        return [test]
+    if target is True:
+        target = fsconfig.get('autoshard-target', 3600)
+
+    try:
+        params = shlex.split(test.get('testparam', ''))
+    except ValueError:
+        return [test]
+    if '--only' in params:
+        return [test]
+    otherparams = []
+    excepts = []
+    i = 0
+    while i < len(params):
+        if params[i] == '--except' and i + 1 < len(params):
+            excepts.extend(x for x in params[i + 1].replace(' ', ',').split(',') if x)
+            i += 2
+            continue
+        otherparams.append(params[i])
+        i += 1
+
+    durations = {}
+    for name, duration in runtimes.subtest_durations(test['test'], test['fstype']).items():
+        name = name.replace('test_', '', 1)
+        if name not in excepts:
+            durations[name] = duration
+    shards = make_shards(durations, target, fsconfig.get('autoshard-max', 8))
+    if not shards:
+        return [test]
+
+    result = []
+    for idx, (expected, names) in enumerate(shards):
+        shard = dict(test)
+        shard['name'] = test['name'] + "-shard" + str(idx + 1)
+        shard['ShardOf'] = test['name']
+        shard['ShardIndex'] = idx + 1
+        shard['ShardCount'] = len(shards)
+        shard['ShardExpected'] = int(expected)
+        if idx == len(shards) - 1:
+            # Catch all for everything we don't know about yet
+            others = [name for other in shards[:-1] for name in other[1]]
+            newparams = ['--except', ','.join(others + excepts)]
+        else:
+            newparams = ['--only', ','.join(names)]
+            if excepts:
+                newparams += ['--except', ','.join(excepts)]
+        shard['testparam'] = " ".join(shlex.quote(x) for x in otherparams + newparams)
+        if test['timeout'] > 0:
+            shard['timeout'] = min(test['timeout'], int(expected * 2) + 900)
+        result.append(shard)
+    return result
+
 def populate_testlist_from_array(testlist, testarray, LDiskfsOnly, ZFSOnly, DNE=True, Force=False, Branch=None):
     for item in testarray:
         def getemptytest(item):
@@ -169,7 +301,7 @@ def populate_testlist_from_array(testlist, testarray, LDiskfsOnly, ZFSOnly, DNE=
             # Must always have these two
             test['test'] = item['test']
             test['timeout'] = item['timeout']
-            for elem in ('name', 'testparam', 'DNE', 'env', 'SSK', 'SELINUX', 'fstype', 'austerparam', 'vmparams', 'singletimeout', 'clientdistro', 'serverdistro', 'forcedistro'):
+            for elem in ('name', 'testparam', 'DNE', 'env', 'SSK', 'SELINUX', 'fstype', 'austerparam', 'vmparams', 'singletimeout', 'clientdistro', 'serverdistro', 'forcedistro', 'autoshard'):
                 if item.get(elem):
                     test[elem] = item[elem]
 
@@ -190,36 +322,34 @@ def populate_testlist_from_array(testlist, testarray, LDiskfsOnly, ZFSOnly, DNE=
         if item.get('fstype'):
             test = getemptytest(item)
             # Items that specify fstype are self contained and are not expanded
-            testlist.append(test)
+            testlist.extend(autoshard_test(test))
             continue
         if LDiskfsOnly:
             test = getemptytest(item)
             test['fstype'] = "ldiskfs"
             test['DNE'] = DNE
-            testlist.append(test)
+            testlist.extend(autoshard_test(test))
         if ZFSOnly:
             test = getemptytest(item)
             test['fstype'] = "zfs"
-            testlist.append(test)
+            testlist.extend(autoshard_test(test))
         if ZFSOnly and DNE and not LDiskfsOnly:
             # Need to also do DNE run
             test = getemptytest(item)
             test['fstype'] = "zfs"
             test['DNE'] = True
-            testlist.append(test)
+            testlist.extend(autoshard_test(test))
         if LDiskfsOnly and not ZFSOnly and DNE:
             # Need to capture non-DNE run for ldiskfs
             test = getemptytest(item)
             test['fstype'] = "ldiskfs"
-            testlist.append(test)
+            testlist.extend(autoshard_test(test))
 
     return testlist
 
 def determine_distros_from_change(change):
-    try:
-        with open("distrolist.json", "r") as blah:
-            distrolist = json.load(blah)
-    except:
+    distrolist = registry.get("distrolist.json")
+    if distrolist is None:
         return [] # We return empty list on error and it'll use default distro
 
     branch = change['branch']
@@ -228,7 +358,7 @@ def determine_distros_from_change(change):
         if distro.get('branch'):
             if not branch.startswith(distro['branch']):
                 continue
-        distros.append(distro)
+        distros.append(dict(distro)) # builds get updated with status
     return distros
 
 def determine_testlist(change, filelist, commit_message, ForceFull=False, Branch=None):
@@ -244,52 +374,20 @@ def determine_testlist(change, filelist, commit_message, ForceFull=False, Branch
     FullRun = False
     requested_tests = testlist_from_commit_message(commit_message)
 
-    # Load updated definitions of what we know how to test and what we don't
-    IGNORE_FILES = []
-    BUILD_ONLY_FILES = []
-    LDISKFS_ONLY_FILES = []
-    LNET_ONLY_FILES = []
-    ZFS_ONLY_FILES = []
-
-    try:
-        with open("filelists/ignore.json", "r") as blah:
-            IGNORE_FILES = json.load(blah)
-    except:
-        pass
-
-    try:
-        with open("filelists/buildonly.json", "r") as blah:
-            BUILD_ONLY_FILES = json.load(blah)
-    except:
-        pass
-
-    try:
-        with open("filelists/ldiskfs.json", "r") as blah:
-            LDISKFS_ONLY_FILES = json.load(blah)
-    except:
-        pass
-
-    try:
-        with open("filelists/zfs.json", "r") as blah:
-            ZFS_ONLY_FILES = json.load(blah)
-    except:
-        pass
-
-    try:
-        with open("filelists/lnet.json", "r") as blah:
-            LNET_ONLY_FILES = json.load(blah)
-    except:
-        pass
+    # Compiled from updated definitions of what we know how to test
+    # and what we don't
+    classifier = get_path_classifier()
 
     for item in sorted(filelist):
+        categories = classifier.classify(item)
         # I wish there was a way to detect deleted files, but alas, not in our gerrit?
-        if match_fnmatch_list(item, IGNORE_FILES):
+        if 'ignore' in categories:
             continue # with deletion would set BuildOnly
         DoNothing = False
-        if match_fnmatch_list(item, LUTF_ONLY_FILES):
+        if 'lutf' in categories:
             LUTFOnly = True
             continue
-        if match_fnmatch_list(item, TEST_SCRIPT_FILES):
+        if 'testscript' in categories:
             testname = os.path.basename(item).replace('.sh', '')
             # if it was already requested by the test-params, don't add it again
             if not testname in requested_tests:
@@ -297,16 +395,16 @@ def determine_testlist(change, filelist, commit_message, ForceFull=False, Branch
             if not item.endswith('.c'):
                 continue
         NonTestFilesToo = True
-        if match_fnmatch_list(item, BUILD_ONLY_FILES):
+        if 'buildonly' in categories:
             BuildOnly = True
             continue
-        if match_fnmatch_list(item, ZFS_ONLY_FILES):
+        if 'zfs' in categories:
             ZFSOnly = True
             continue
-        if match_fnmatch_list(item, LDISKFS_ONLY_FILES):
+        if 'ldiskfs' in categories:
             LDiskfsOnly = True
             continue
-        if match_fnmatch_list(item, LNET_ONLY_FILES):
+        if 'lnet' in categories:
             LNetOnly = True
             continue
         # Otherwise unknown file = full test
@@ -344,17 +442,14 @@ def determine_testlist(change, filelist, commit_message, ForceFull=False, Branch
     if LUTFOnly:
         requested_tests.append("lutf")
 
-    # Always reload testlists
-    with open("tests/initial.json", "r") as blah:
-        initialtestlist = json.load(blah)
-    with open("tests/comprehensive.json", "r") as blah:
-        fulltestlist = json.load(blah)
-    with open("tests/lnet.json", "r") as blah:
-        lnettestlist = json.load(blah)
-    with open("tests/zfs.json", "r") as blah:
-        zfstestlist = json.load(blah)
-    with open("tests/ldiskfs.json", "r") as blah:
-        ldiskfstestlist = json.load(blah)
+    # Nothing but the standard lists for the known areas, so it can be
+    # batched with others like it
+    change['LowRisk'] = not DoNothing and not FullRun and not requested_tests
+
+    # Always up to date since the registry reloads changed testlists
+    catalog = get_test_catalog()
+    # Tests we already run due to explicit request
+    disabledtests = set()
 
     initial = []
     comprehensive = []
@@ -373,16 +468,13 @@ def determine_testlist(change, filelist, commit_message, ForceFull=False, Branch
                     NonTestFilesToo = True # To force runtests
                     UnknownItems = True # to force everything
                     continue
-                Found = False
-                for test in initialtestlist + fulltestlist + lnettestlist + zfstestlist + ldiskfstestlist:
-                    if item == test['test']:
-                        foundtests.append(test)
-                        # To avoid doubletesting, mark it as disabled in the
-                        # regular list too - ok to do sice we reread the list
-                        # every time
-                        test['disabled'] = True
-                        Found = True
-                if not Found:
+                found = catalog.find_by_test(item)
+                if found:
+                    foundtests += found
+                    # To avoid doubletesting, mark it as disabled in the
+                    # regular lists too
+                    disabledtests.add(item)
+                else:
                     UnknownItems = True
 
             populate_testlist_from_array(initial, foundtests, True, True, Force=True, Branch=Branch)
@@ -405,7 +497,7 @@ def determine_testlist(change, filelist, commit_message, ForceFull=False, Branch
         # comprehensive but if we have any other files modified that are
         # non-test - add standard initial testing too.
         if not initial or NonTestFilesToo:
-            populate_testlist_from_array(initial, initialtestlist, LDiskfsOnly, ZFSOnly, Branch=Branch)
+            populate_testlist_from_array(initial, catalog.get_list('initial', Branch, disabledtests), LDiskfsOnly, ZFSOnly, Branch=Branch)
         if change.get('updated_tests'):
             updtests = change['updated_tests']
             updtestlist = []
@@ -423,19 +515,19 @@ def determine_testlist(change, filelist, commit_message, ForceFull=False, Branch
         if LNetOnly:
             # For items in this list we don't care about fs as it's supposed
             # to be fs-neutral Lnet-only stuff like lnet-selftest
-            populate_testlist_from_array(comprehensive, lnettestlist, False, True, DNE=False, Branch=Branch)
+            populate_testlist_from_array(comprehensive, catalog.get_list('lnet', Branch, disabledtests), False, True, DNE=False, Branch=Branch)
 
         if ZFSOnly:
             # For items in this list we don't care about fs as it's supposed
             # to be fs-neutral Lnet-only stuff like lnet-selftest
-            populate_testlist_from_array(comprehensive, zfstestlist, False, True, Branch=Branch)
+            populate_testlist_from_array(comprehensive, catalog.get_list('zfs', Branch, disabledtests), False, True, Branch=Branch)
         if LDiskfsOnly:
             # For items in this list we don't care about fs as it's supposed
             # to be fs-neutral Lnet-only stuff like lnet-selftest
-            populate_testlist_from_array(comprehensive, ldiskfstestlist, True, False, Branch=Branch)
+            populate_testlist_from_array(comprehensive, catalog.get_list('ldiskfs', Branch, disabledtests), True, False, Branch=Branch)
 
         if not trivial_requested or GERRIT_FORCEALLTESTS:
-            populate_testlist_from_array(comprehensive, fulltestlist, LDiskfsOnly, ZFSOnly, Branch=Branch)
+            populate_testlist_from_array(comprehensive, catalog.get_list('comprehensive', Branch, disabledtests), LDiskfsOnly, ZFSOnly, Branch=Branch)
 
     return (DoNothing, initial, comprehensive)
 
@@ -531,14 +623,82 @@ def parse_checkpatch_output(out, path_line_comments, warning_count):
 
 def find_and_abort_duplicates(workitem):
     for item in WorkList:
-        if item.changenr == workitem.changenr:
-            item.Aborted = True
+        if item.changenr == workitem.changenr and not item.Aborted:
+            abort_workitem(item)
+
+def remove_queued_builds(workitem):
+    """ Take all queued builds of workitem out of build queue, returns them.
+        Must hold build_condition. """
+    return build_queue.remove_if(lambda job: job[1] is workitem)
+
+def cancel_running_tests(workitem, OnlySpeculative=False):
+    """ Kill testers running anything of workitem.
+        Returns [(testinfo, seconds it ran), ...] """
+    cancelled = []
+    for worker in workers:
+        tester = worker.get('thread')
+        if tester is None:
+            continue
+        result = tester.cancel(workitem, OnlySpeculative=OnlySpeculative)
+        if result is not None:
+            cancelled.append(result)
+    return cancelled
+
+def count_cancelled(queuedbuilds, runningbuilds, queuedtests, runningtests):
+    """ Add up what a cancellation saved us. Tests occupy a server and
+        a client VM, so node-seconds are twice the test time. """
+    buildseconds = 0
+    for job in queuedbuilds:
+        buildseconds += build_expected(job)
+    for job, elapsed in runningbuilds:
+        buildseconds += max(0, build_expected(job) - elapsed)
+    nodeseconds = 0
+    for testinfo in queuedtests:
+        nodeseconds += 2 * testinfo.get('ExpectedRuntime', 0)
+    for testinfo, elapsed in runningtests:
+        nodeseconds += 2 * max(0, testinfo.get('ExpectedRuntime', 0) - elapsed)
+    CancelStats['builds'] += len(queuedbuilds) + len(runningbuilds)
+    CancelStats['tests'] += len(queuedtests) + len(runningtests)
+    CancelStats['builder-seconds'] += int(buildseconds)
+    CancelStats['node-seconds'] += int(nodeseconds)
+    return nodeseconds
+
+def abort_workitem(workitem):
+    """ Stop all work on workitem now: drop its queued builds and tests
+        and kill the builders and testers working on it """
+    workitem.Aborted = True
+    build_condition.acquire()
+    queuedbuilds = remove_queued_builds(workitem)
+    build_condition.release()
+    testing_condition.acquire()
+    queuedtests = [entry[1] for entry in withdraw_queued_tests(workitem)]
+    testing_condition.release()
+
+    runningbuilds = []
+    for builder in builders:
+        result = builder.cancel(workitem)
+        if result is not None:
+            runningbuilds.append(result)
+    runningtests = cancel_running_tests(workitem)
+
+    nodeseconds = count_cancelled(queuedbuilds, runningbuilds, queuedtests, runningtests)
+    logger = logging.getLogger("Abort")
+    logger.info("build " + str(workitem.buildnr) + " aborted: %d queued and %d running builds, %d queued and %d running tests cancelled, saved %d node-seconds" % (len(queuedbuilds), len(runningbuilds), len(queuedtests), len(runningtests), nodeseconds))
+
+    # Nothing might be left to hand it back to the manager
+    managing_condition.acquire()
+    managing_queue.put(workitem)
+    managing_condition.notify()
+    managing_condition.release()
 
 def add_review_comment(WorkItem):
     """
     Convert { PATH: { LINE: [COMMENT, ...] }, ... }, [11] to a gerrit
     ReviewInput() and score
     """
+    if WorkItem.change.get('batch'):
+        return # members hear about it once the batch is done
+
     score = 0
     review_comments = {}
     try:
@@ -564,7 +724,23 @@ def add_review_comment(WorkItem):
             message = 'Cannot detect any functional changes in this patch\n'
             if not (is_trivial_requested(commit_message) or is_testonly_requested(commit_message) or is_buildonly_requested(commit_message)):
                 message += TrivialNagMessage
-    elif WorkItem.BuildDone and not WorkItem.InitialTestingStarted and not WorkItem.TestingStarted:
+    elif waiting_for_builds(WorkItem):
+        return # Final word waits for the other distros to build
+    elif WorkItem.BuildDone and WorkItem.BuildError and (WorkItem.InitialTestingStarted or WorkItem.TestingStarted):
+        # Staged build of another distro failed after testing started
+        if WorkItem.FinalReportPosted:
+            return
+        WorkItem.FinalReportPosted = True
+        message = ""
+        for buildinfo in WorkItem.builds:
+            if buildinfo.get('Failed'):
+                message += buildinfo.get('BuildMessage', 'Build Failed') + "\n"
+                if buildinfo.get('ReviewComments'):
+                    review_comments.update(buildinfo['ReviewComments'])
+        message += 'Testing was stopped.\n'
+        message += '\n Job output URL: ' + WorkItem.get_base_url() + "/" + WorkItem.get_results_filename()
+        score = -1
+    elif ready_for_testing(WorkItem) and not WorkItem.InitialTestingStarted and not WorkItem.TestingStarted:
         # This is after initial build completion
         message = ""
         if WorkItem.BuildError:
@@ -581,9 +757,15 @@ def add_review_comment(WorkItem):
                 message = "This is a retest #%d\n" % (WorkItem.retestiteration)
             else:
                 distros = []
+                pending = []
                 for buildinfo in WorkItem.builds:
-                    distros.append(buildinfo['distro'])
+                    if buildinfo.get('Finished'):
+                        distros.append(buildinfo['distro'])
+                    else:
+                        pending.append(buildinfo['distro'])
                 message = 'Builds for x86_64 ' + ",".join(distros) + ' successful\n'
+                if pending:
+                    message += 'Still building ' + ",".join(pending) + ', tests on those start once done\n'
                 if WorkItem.tests and is_trivial_requested(commit_message):
                     # +7 for line number is needed for our current gerrit since it also shows some metadata at the front
                     review_comments.setdefault("/COMMIT_MSG", []).append({'line': commitmsg_trivial_lineno(commit_message) + 7, 'message': SuspiciousTrivialUsage})
@@ -639,6 +821,10 @@ def add_review_comment(WorkItem):
         #message = "Help, I don't know why I am here" + str(vars(WorkItem))
         return
 
+    reused = WorkItem.change.get('ReusedFrom')
+    if reused and (reused['mode'] == 'results' or not WorkItem.InitialTestingStarted or WorkItem.InitialTestingDone):
+        message = reused['message'] + '\n\n' + message
+
     # Errors = notify owner, no errors - no need to spam people
     if score < 0:
         notify = 'OWNER'
@@ -661,10 +847,13 @@ def add_review_comment(WorkItem):
         'comments': review_comments,
         'notify': notify,
         }
-    if WorkItem.change.get('branchwide', False) or not reviewer.post_review(WorkItem.change, WorkItem.revision, outputdict):
+    post_or_save_review(WorkItem.change, WorkItem.revision, WorkItem.buildnr, outputdict)
+
+def post_or_save_review(change, revision, buildnr, outputdict):
+    if change.get('branchwide', False) or not reviewer.post_review(change, revision, outputdict):
         # Ok, we had a failure posting this message, let's save it for
         # later processing
-        savefile = FAILED_POSTS_DIR + "/build-" + str(WorkItem.buildnr) + "-" + str(WorkItem.changenr) + "." + str(WorkItem.revision)
+        savefile = FAILED_POSTS_DIR + "/build-" + str(buildnr) + "-" + str(change['_number']) + "." + str(revision)
         if os.path.exists(savefile + ".json"):
             attempt = 1
             while os.path.exists(savefile+ "-try" + str(attempt) + ".json"):
@@ -673,7 +862,7 @@ def add_review_comment(WorkItem):
 
         try:
             with open(savefile + ".json", "w") as outfile:
-                json.dump({'change':WorkItem.change, 'output':outputdict}, outfile, indent=4)
+                json.dump({'change':change, 'output':outputdict}, outfile, indent=4)
         except OSError:
             # Only if we cannot save
             pass
@@ -683,31 +872,19 @@ def _now():
     return int(time.time())
 
 def make_requested_testlist(requestedlistparams, branch):
-    # XXX - this is a copy from another func. need to
-    # have it all in a single place
-    with open("tests/initial.json", "r") as blah:
-        initialtestlist = json.load(blah)
-    with open("tests/comprehensive.json", "r") as blah:
-        fulltestlist = json.load(blah)
-    with open("tests/lnet.json", "r") as blah:
-        lnettestlist = json.load(blah)
-    with open("tests/zfs.json", "r") as blah:
-        zfstestlist = json.load(blah)
-    with open("tests/ldiskfs.json", "r") as blah:
-        ldiskfstestlist = json.load(blah)
+    catalog = get_test_catalog()
 
     testarray = []
     for item in requestedlistparams['testlist'].split(','):
         item = item.strip()
-        for test in initialtestlist + fulltestlist + lnettestlist + zfstestlist + ldiskfstestlist:
-            testname = test.get("name", test['test'])
-            if item == testname:
-                for i in ("DNE", "fstype", "testparam", "austerparam", "vmparams", "env", 'SSK', 'SELINUX', 'singletimeout','timeout', 'clientdistro', 'serverdistro', 'forcedistro'):
-                    if requestedlistparams.get(i):
-                        test[i] = requestedlistparams[i]
+        test = catalog.find_by_name(item)
+        if test is None:
+            continue
+        for i in ("DNE", "fstype", "testparam", "austerparam", "vmparams", "env", 'SSK', 'SELINUX', 'singletimeout','timeout', 'clientdistro', 'serverdistro', 'forcedistro'):
+            if requestedlistparams.get(i):
+                test[i] = requestedlistparams[i]
 
-                testarray.append(test)
-                break
+        testarray.append(test)
 
     zfsonly = requestedlistparams.get("zfs", True)
     ldiskfsonly = requestedlistparams.get("ldiskfs", True)
@@ -719,6 +896,14 @@ def make_requested_testlist(requestedlistparams, branch):
 def make_change_from_hash(githash, subject, branch):
     """ Also works for tags and branch names """
 
+    revision = patch_analyzer.resolve(githash)
+    if revision:
+        changenum = int(revision[:8], 16)
+        change = {'branch':branch, '_number':changenum, 'branchwide':True,
+                  'id':githash, 'subject':subject, 'current_revision':revision }
+        return change
+
+    # Not in the mirror, ask gitweb
     url = "https://git.whamcloud.com/fs/lustre-release.git/patch/" + githash
     try:
         r = requests.get(url)
@@ -736,6 +921,12 @@ def make_change_from_hash(githash, subject, branch):
 
     return change
 
+def command_file_mtime(name):
+    try:
+        return os.stat(GERRIT_COMMANDMONITORDIR + "/" + name).st_mtime
+    except OSError:
+        return 0
+
 def isJobListStatic():
     if testing_queue.qsize():
         return False # Don't shutdown anything if we have jobs waiting in the
@@ -763,20 +954,26 @@ class Reviewer(object):
     * Post ReviewInput() to gerrit instance.
     * Track reviewed revisions in history_path.
     """
-    def __init__(self, host, project, branch, username, password, history_path):
+    def __init__(self, host, project, branch, username, password, history_path, history_db=REVIEW_HISTORY_DB):
         self.host = host
         self.project = project
         self.branch = branch
         self.auth = requests.auth.HTTPBasicAuth(username, password)
         self.logger = logging.getLogger(__name__)
         self.history_path = history_path
+        self.history_db = history_db
         self.history_mode = 'rw'
-        self.history = {}
+        self.history = None
         self.timestamp = 0
         self.post_enabled = True and not GERRIT_DRYRUN # XXX
         self.post_interval = 1
         self.update_interval = 120
         self.request_timeout = 60
+        self.client = GerritClient(host, self.auth, timeout=self.request_timeout)
+        self.settling = {} # ('change', nr) or ('branch', name) -> held request
+        self.batcher = Batcher(fsconfig.get('batch-size', BATCH_SIZE),
+                               fsconfig.get('batch-wait', BATCH_WAIT))
+        self.finished_batches = queue.Queue() # reported and split here, not by the manager
 
     def _debug(self, msg, *args):
         """_"""
@@ -794,94 +991,69 @@ class Reviewer(object):
         """
         GET path return Response.
         """
-        url = self._url(path)
-        try:
-            res = requests.get(url, auth=self.auth,
-                               timeout=self.request_timeout)
-        except Exception as exc:
-            self._error("cannot GET '%s': exception = %s", url, str(exc))
-            return None
-
-        if res.status_code != requests.codes.ok:
-            self._error("cannot GET '%s': reason = %s, status_code = %d",
-                        url, res.reason, res.status_code)
-            return None
-
-        return res
+        return self.client.get(path)
 
     def _post(self, path, obj):
         """
         POST json(obj) to path, return True on success.
         """
-        url = self._url(path)
-        data = json.dumps(obj)
         if not self.post_enabled:
-            self._debug("_post: disabled: url = '%s', data = '%s'", url, data)
+            self._debug("_post: disabled: url = '%s', data = '%s'", self._url(path), json.dumps(obj))
             return False
 
-        try:
-            res = requests.post(url, data=data,
-                                headers={'Content-Type': 'application/json'},
-                                auth=self.auth, timeout=self.request_timeout)
-        except Exception as exc:
-            self._error("cannot POST '%s': exception = %s", url, str(exc))
-            return False
-
-        if res.status_code != requests.codes.ok:
-            self._error("cannot POST '%s': reason = %s, status_code = %d",
-                        url, res.reason, res.status_code)
-            return False
-
-        return True
+        return self.client.post(path, obj)
 
     def load_history(self):
         """
-        Load review history from history_path containing lines of the form:
+        Open review history database in history_db. On first use the
+        legacy history_path file containing lines of the form:
         EPOCH      FULL_CHANGE_ID                         REVISION    SCORE
         1394536722 fs%2Flustre-release~master~I5cc6c23... 00e2cc75... 1
         1394536721 -                                      -           0
         1394537033 fs%2Flustre-release~master~I10be8e9... 44f7b504... 1
-        1394537032 -                                      -           0
-        1394537344 -                                      -           0
         ...
+        is imported into it.
         """
-        if 'r' in self.history_mode:
-            with open(self.history_path) as history_file:
-                for line in history_file:
-                    epoch, change_id, revision, score = line.split()
-                    if change_id == '-':
-                        self.timestamp = int(float(epoch))
-                    else:
-                        self.history[change_id + ' ' + revision] = score
+        if self.history is None:
+            legacy = None
+            if 'r' in self.history_mode:
+                legacy = self.history_path
+            self.history = ReviewHistory(self.history_db, legacypath=legacy,
+                                         persistent='w' in self.history_mode)
+        self.timestamp = self.history.get_timestamp()
 
-        self._debug("load_history: history size = %d, timestamp = %d",
-                    len(self.history), self.timestamp)
+        self._debug("load_history: timestamp = %d", self.timestamp)
 
     def write_history(self, change_id, revision, score, epoch=-1):
         """
-        Add review record to history dict and file.
+        Add review record to history db.
         """
         if GERRIT_DRYRUN:
             return
-        if change_id != '-':
-            self.history[change_id + ' ' + revision] = score
 
         if epoch <= 0:
             epoch = self.timestamp
 
-        if 'w' in self.history_mode:
-            with open(self.history_path, 'a') as history_file:
-                print(epoch, change_id, revision, score, file=history_file)
+        if self.history is None:
+            self.load_history()
+        if change_id != '-':
+            self.history.add(change_id, revision, score, epoch)
+        else:
+            self.history.set_timestamp(epoch)
 
     def in_history(self, change_id, revision):
         """
         Return True if change_id/revision was already reviewed.
         """
-        return change_id + ' ' + revision in self.history
+        if self.history is None:
+            return False
+        return self.history.contains(change_id, revision)
 
-    def get_changes(self, query, Absolute=False):
+    def get_changes(self, query, Absolute=False, Cached=False):
         """
-        GET a list of ChangeInfo()s for all changes matching query.
+        GET a list of ChangeInfo()s for all changes matching query,
+        following _more_changes to get all the pages. None if the
+        query failed or came back incomplete.
 
         {'status':'open', '-age':'60m'} =>
           GET /changes/?q=project:...+status:open+-age:60m&o=CURRENT_REVISION =>
@@ -906,110 +1078,23 @@ class Reviewer(object):
         path = ('/changes/?q=' + branches +
                 '+'.join(k + ':' + v for k, v in query.items()) +
                 '&o=CURRENT_REVISION&o=CURRENT_COMMIT&o=CURRENT_FILES')
-        res = self._get(path)
-        if not res:
-            return []
-
-        # Gerrit uses " )]}'" to guard against XSSI.
-        return json.loads(res.content[5:])
-
-    def get_patch(self, change):
-        """
-        GET and decode the (current) patch for change.
-        """
-        revision = change.get('current_revision')
-        args = "cd /home/green/git/lustre-release ; git fetch https://" + GERRIT_HOST + "/" + GERRIT_PROJECT + " " + change['revisions'][revision]['ref'] + "&& git format-patch -1 -n --stdout FETCH_HEAD | head -n -3"
-        pipe = subprocess.Popen(args, shell=True, stdin=subprocess.PIPE,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        out, err = pipe.communicate("")
-        return out
+        if Cached:
+            return self.client.query_change_cached(path)
+        return self.client.query_changes(path)
 
     def analyze_patch(self, change):
         """ Extract useful info from a patch. Things like new tests added,
             tests modified, is it a comment-only change and so on. """
-        patch = self.get_patch(change)
-        if not patch:
+        result = patch_analyzer.analyze(change)
+        if not result:
             return
 
-        chfile = None
-        function = None
-        commentonly = True
-        newtests = []
-        for line in patch.splitlines():
-            line = line.decode("utf-8")
-            # print("Working on: " + line)
-            if line.startswith('+++ '):
-                if newtests:
-                    if not change.get('updated_tests'):
-                        change['updated_tests'] = {}
-                    if basename.endswith('.sh'):
-                        change['updated_tests'].update({basename.replace('.sh', ''):newtests})
-                    newtests = []
-                chfile = line.replace('+++ b/', '')
-                basename = os.path.basename(chfile)
-            if not chfile: # diff did not start yet - skip
-                continue
-            if line.startswith('--- '): # src file - skip
-                continue
-            if line.startswith('@@ '):
-                tags = line.split(' ', 5)
-                if tags[0] != '@@' or tags[3] != '@@':
-                    print("Malformed patch line: " + line)
-                    continue
-                if len(tags) > 4:
-                    function = tags[4].replace('()', '')
-                    if function.endswith("{"):
-                        function = function[:-1]
-                else:
-                    function = None
-            if line.startswith(' '): # context line, not a change - skip
-                if basename.endswith(".sh") and line.startswith(' test_'): # context changed to new function, record it.
-                    tags = line[1:].split(' ')
-                    function = tags[0].replace('()', '')
-                    if function.endswith("{"):
-                        function = function[:-1]
-                continue
-            if line.startswith('-') or line.startswith('+'): # added/removed/changed line
-                tmp = line.replace(' ', '').replace('\t', '') # remove spaces
-                if not line[1:]: # empty line? skip
-                    continue
-                if "ldiskfs/kernel_patches/" in chfile:
-                    commentonly = False
-                if (basename.endswith('.c') or basename.endswith('.h')) \
-                    and not (tmp[1:].startswith('/*') or tmp[1:].startswith('//') or \
-                   tmp[1:].startswith('*')):
-                    commentonly = False
-                if (basename.endswith('.sh') or basename.endswith('.pl') or
-                    basename.endswith('.py') or
-                    basename in ('runtests', 'auster', 'rundbench', 'runiozone', 'runmultiop_bg_pause', 'runvmstat', 'runobdstat')) \
-                   and not tmp[1:].startswith('#'):
-                    commentonly = False
-                if line[1:].startswith('test_'):
-                    function = None # Added or removed function, we'll catch with the +run_test
-                if function and function not in newtests:
-                    if basename.endswith('.sh') and function.startswith("test_"):
-                        newtests.append(function)
-                    function = None # To ease our work
-
-            if line.startswith('+'): # Added/changed line
-                if basename.endswith('.sh'):
-                    # Try to detect a new test added.
-                    # while we can try and detect new function added, instead
-                    # in our framework there's a very specific pattern:
-                    # +run_test 65 "Check lfs quota result"
-                    # So let's match for that instead
-                    if line.startswith("+run_test "):
-                        tags = line.split(" ")
-                        if len(tags) > 1:
-                            test = "test_" + tags[1]
-                            newtests.append(test)
-
-        # Catch remaining stuff
-        if newtests and basename.endswith('.sh'):
+        (updated_tests, commentonly) = result
+        if updated_tests:
             if not change.get('updated_tests'):
                 change['updated_tests'] = {}
-            change['updated_tests'].update({basename.replace('.sh', ''):newtests})
+            for script, tests in updated_tests.items():
+                change['updated_tests'][script] = list(tests)
         if commentonly:
             change['CommentOnly'] = True
 
@@ -1046,6 +1131,11 @@ class Reviewer(object):
             #self._debug("change_needs_review: already reviewed")
             return False
 
+        # Waiting for a batch, it goes into history once that starts
+        batched = self.batcher.find(change['_number'])
+        if batched is not None and batched.revision == current_revision:
+            return False
+
         self._debug("change_needs_review: current_revision = '%s'",
                     current_revision)
 
@@ -1060,6 +1150,9 @@ class Reviewer(object):
         """
         self._debug("review_change: change = %s, subject = '%s'",
                     change['id'], change.get('subject', ''))
+        if not change.get('branchwide'):
+            # Explicit requests supersede whatever we were holding
+            self.settling.pop(('change', str(change.get('_number'))), None)
 
         current_revision = change.get('current_revision')
         self._debug("change_needs_review: current_revision = '%s'",
@@ -1099,9 +1192,26 @@ class Reviewer(object):
                 DISTRO = DISTRO.split(",")[0] # Make first one the main one
         else:
             distrolist = determine_distros_from_change(change)
+        if not DoNothing and not change.get('branchwide'):
+            change['tree'] = patch_analyzer.tree(change)
         workItem = GerritWorkItem(change, distrolist, ilist, clist, fsconfig, EmptyJob=DoNothing, Reviewer=self, DISTRO=DISTRO)
+        if not DoNothing:
+            reused = find_reusable(change, workItem)
+            if reused:
+                self._debug("review_change: " + reused['message'])
+                change['ReusedFrom'] = reused
+                if reused['mode'] == 'tests':
+                    workItem.tests = []
         if DoNothing:
             add_review_comment(workItem)
+        elif batchable(workItem):
+            self._debug("review_change: holding %s for a batch", str(change['_number']))
+            # Not in the history until the batch goes out, the poll
+            # cursor stays behind it meanwhile (see update)
+            group = self.batcher.add(batch_key(workItem), workItem, files, since=self.timestamp)
+            if group:
+                self.dispatch_batch(group)
+            return
         else:
             managing_condition.acquire()
             managing_queue.put(workItem)
@@ -1110,255 +1220,433 @@ class Reviewer(object):
 
         self.write_history(change['id'], current_revision, 0)
 
+    def dispatch_batch(self, items):
+        """ Start a batch the batcher let go """
+        self._debug("Batching changes " + ", ".join(str(x.changenr) for x in items))
+        queue_batch(items)
+        for workitem in items:
+            self.write_history(workitem.change['id'], workitem.revision, 0)
+
     def update(self):
         """
         GET recently updated changes and review as needed.
         """
 
-        self.check_for_commands()
-
         new_timestamp = _now()
-        age = 4 # Age
+        # Only ask for what changed since the last poll, with some slack
+        # for clock skew.
+        if self.timestamp > 0:
+            age = min(new_timestamp - self.timestamp + UPDATE_AGE_SLACK, UPDATE_MAX_AGE)
+        else:
+            age = UPDATE_MAX_AGE
         #self._debug("update: age = %d", age)
 
 
         open_changes = self.get_changes({'status':'open',
-                                         '-age':str(age) + 'h',
+                                         '-age':str(age) + 's',
                                          '-label':'Code-Review=-2'})
+        if open_changes is None:
+            # Keep the old cursor so the next poll covers the gap
+            self._error("update: query failed, will retry from %d", self.timestamp)
+            return
         #self._debug("update: got %d open_changes", len(open_changes))
 
         # Sort the list backwards so we get newer changes first.
         # Useful if there's a patchset so we start with the tail end of it
         # to get a quicker reading of the health of the entire thing
-        for change in sorted(open_changes, key=lambda x: x['_number'], reverse=True):
+        needs_review = [change for change in sorted(open_changes, key=lambda x: x['_number'], reverse=True) if self.change_needs_review(change)]
+        # Get the patches reviewed right away fetched and analyzed in
+        # parallel, held ones wait until they are due
+        patch_analyzer.submit([change for change in needs_review if not self.held_back(change)])
+        for change in needs_review:
             if self.change_needs_review(change):
-                self.review_change(change)
-                # Don't POST more than every post_interval seconds.
-                time.sleep(self.post_interval)
-
+                if self.settle_change(change):
+                    # Don't POST more than every post_interval seconds.
+                    time.sleep(self.post_interval)
+
+        # Held changes only live in memory, the saved cursor must not
+        # move past them or a restart would never see them again
+        for key, held in self.settling.items():
+            if key[0] == 'change':
+                new_timestamp = min(new_timestamp, held['since'])
+        # Same for changes waiting for their batch
+        batched = self.batcher.since()
+        if batched is not None:
+            new_timestamp = min(new_timestamp, batched)
         self.timestamp = new_timestamp
         self.write_history('-', '-', 0)
 
-    def check_for_commands(self):
-        global StopOnIdle
-        global DrainQueueAndStop
-        global GERRIT_FORCETOPIC
+    def check_for_commands(self, Branches=True):
+        """ Run all command files (and branch requests), returns True if
+            some file looked half written and needs another look """
+        retry = False
         # See if we got any commands
-        for commandfile in os.listdir(GERRIT_COMMANDMONITORDIR):
+        for commandfile in sorted(os.listdir(GERRIT_COMMANDMONITORDIR), key=lambda x: (command_file_mtime(x), x)):
             command = {}
+            path = GERRIT_COMMANDMONITORDIR + "/" + commandfile
             try:
-                with open(GERRIT_COMMANDMONITORDIR + "/" + commandfile, "r") as cmdfl:
+                with open(path, "r") as cmdfl:
                     try:
                         command = json.load(cmdfl)
                     except: # XXX Add some json format error here
-                        pass
-                    os.unlink(GERRIT_COMMANDMONITORDIR + "/" + commandfile)
+                        # We look right away now, so the writer might
+                        # not be done with it yet
+                        if time.time() - os.fstat(cmdfl.fileno()).st_mtime < COMMAND_SETTLE_TIME:
+                            retry = True
+                            continue
+                os.unlink(path)
             except OSError:
                 pass
             if not command:
                 continue
-            change = {}
-            testlist = command.get("testlist")
-            distro = command.get("distro")
-            subject = command.get("subject")
-            if command.get("test-commit"):
-                branch = command.get("branch")
-                if not branch:
-                    print("Asked for commit, but not branch to match, skipping")
-                    continue
-                githash = command['test-commit']
-                if not subject:
-                    subject = "githash test request " + str(command)
-                change = make_change_from_hash(githash, subject, branch)
-            elif command.get("test-ref"):
-                desiredchange = str(command['test-ref'])
-                if not desiredchange:
+            result = self.process_command(command)
+            self._debug("Command " + commandfile + ": " + str(result))
+
+        if not Branches:
+            return retry
+
+        # Now check if we have any branches to test
+        for name in os.listdir(GERRIT_BRANCHMONITORDIR):
+            if name.endswith(HELD_SUFFIX):
+                branch = name[:-len(HELD_SUFFIX)]
+                if ('branch', branch) in self.settling:
                     continue
-                print("Asking for single change " + desiredchange)
-                open_changes = self.get_changes({'status':'open',
-                                                 'change':desiredchange},
-                                                Absolute=True)
-                if open_changes:
-                    change = open_changes[0]
+                # Held when we went down, start over
+            else:
+                branch = name
+            try:
+                with open(GERRIT_BRANCHMONITORDIR + "/" + name, "r") as brfil:
+                    subject = brfil.read()
+                    subject = subject.strip()
 
-            # We'll hide it in the change so it's visible everywhere
-            if command.get("completion-cb"):
-                change['completion-cb'] = command['completion-cb']
+                # The request stays on disk until the branch is reviewed,
+                # these do not come back through the gerrit poll
+                os.replace(GERRIT_BRANCHMONITORDIR + "/" + name,
+                           GERRIT_BRANCHMONITORDIR + "/" + branch + HELD_SUFFIX)
+            except OSError:
+                subject = "Cannot read file"
+            self.settle_branch(branch, subject)
+        return retry
 
-            if command.get("highprio"):
-                change['highprio'] = command['highprio']
+    def review_branch(self, branch, subject):
+        """ Test the current tip of branch """
+        # XXX
+        change = make_change_from_hash(branch, subject, branch)
+        change['highprio'] = True
 
-            if change:
-                if testlist:
-                    tlist = make_requested_testlist(command, change.get('branch'))
+        self.review_change(change)
+        try:
+            os.unlink(GERRIT_BRANCHMONITORDIR + "/" + branch + HELD_SUFFIX)
+        except OSError:
+            pass
 
-                    workitem = GerritWorkItem(change, None, tlist, [], fsconfig, Reviewer=self, DISTRO=distro)
-                    managing_condition.acquire()
-                    managing_queue.put(workitem)
-                    managing_condition.notify()
-                    managing_condition.release()
-                else:
-                    self.review_change(change, DISTRO=distro)
-                continue
+    def hold(self, key, window, **request):
+        """ Keep request as the newest one for key until nothing newer
+            came for window seconds (SETTLE_MAX_HOLD windows at most) """
+        now = time.time()
+        held = self.settling.get(key)
+        if held is None:
+            first = now
+            since = self.timestamp
+        else:
+            first = held['first']
+            since = held['since']
+        request['first'] = first
+        request['since'] = since # poll cursor that still covers it
+        request['deadline'] = min(now + window, first + SETTLE_MAX_HOLD * window)
+        self.settling[key] = request
+
+    def settle_change(self, change):
+        """ Hold change for its settle window so a quick newer patchset
+            replaces it before anything is built. Returns True if it was
+            reviewed right away. """
+        if not self.held_back(change):
+            self.review_change(change)
+            return True
+        window = settle_window(change.get('branch'))
+        key = ('change', str(change['_number']))
+        held = self.settling.get(key)
+        if held is not None and held['revision'] == change['current_revision']:
+            held['change'] = change # Same revision, just fresher info
+            return False
+        if held is not None:
+            self._debug("Change %s revision %s replaces held %s", str(change['_number']), change['current_revision'], held['revision'])
+        self.hold(key, window, change=change, revision=change['current_revision'])
+        return False
+
+    @staticmethod
+    def held_back(change):
+        """ settle_change would hold change """
+        return not change.get('highprio') and settle_window(change.get('branch')) > 0
+
+    def settle_branch(self, branch, subject):
+        """ Same for branch tip pushes, the tip is only looked up once
+            the pushes stop """
+        window = settle_window(branch, BranchTip=True)
+        if window <= 0:
+            self.review_branch(branch, subject)
+            return
+        self.hold(('branch', branch), window, subject=subject)
+
+    def dispatch_settled(self):
+        """ Review everything that sat out its settle window """
+        now = time.time()
+        due = [key for key, held in self.settling.items() if held['deadline'] <= now]
+        patch_analyzer.submit([self.settling[key]['change'] for key in due if key[0] == 'change'])
+        for key in due:
+            held = self.settling.pop(key)
+            if key[0] == 'branch':
+                self.review_branch(key[1], held['subject'])
+            elif self.change_needs_review(held['change']):
+                self.review_change(held['change'])
+
+    def process_command(self, command):
+        """ Execute one command, returns result dict with status and
+            message. Must be called from the reviewer thread. """
+        global StopOnIdle
+        global DrainQueueAndStop
+        global GERRIT_FORCETOPIC
+        change = {}
+        testlist = command.get("testlist")
+        distro = command.get("distro")
+        subject = command.get("subject")
+        if command.get("test-commit"):
+            branch = command.get("branch")
+            if not branch:
+                print("Asked for commit, but not branch to match, skipping")
+                return {'status':'error', 'message':'test-commit needs a branch'}
+            githash = command['test-commit']
+            if not subject:
+                subject = "githash test request " + str(command)
+            change = make_change_from_hash(githash, subject, branch)
+        elif command.get("test-ref"):
+            desiredchange = str(command['test-ref'])
+            if not desiredchange:
+                return {'status':'error', 'message':'Empty test-ref'}
+            print("Asking for single change " + desiredchange)
+            open_changes = self.get_changes({'status':'open',
+                                             'change':desiredchange},
+                                            Absolute=True, Cached=True)
+            if open_changes:
+                change = open_changes[0]
+            else:
+                return {'status':'error', 'message':'No open change ' + desiredchange}
 
-            if command.get("retest-item"):
-                retestitem = str(command['retest-item'])
-                self._debug("Asked to retest build id: " + retestitem)
-                # This is a retest request, see if we got new test list
-                # or if not - clean up old tests.
-                retestfile = DONEWITH_DIR + "/" + retestitem + ".pickle"
-                if not os.path.exists(retestfile):
-                    self._debug("Build id: " + retestitem + " does not exist")
-                    continue # no file - nothing to do. error print?
-
-                with open(retestfile, "rb") as blah:
-                    try:
-                        workitem = pickle.load(blah)
-                    except:
-                        self._debug("Build id: " + retestitem + " cannot be loaded")
-                        continue
-                if not workitem.BuildDone or workitem.BuildError:
-                    self._debug("Build id: " + retestitem + " has no successful build")
-                    # Cannot retest a failed build
-                    continue
+        # We'll hide it in the change so it's visible everywhere
+        if command.get("completion-cb"):
+            change['completion-cb'] = command['completion-cb']
 
-                workitem.Reviewer = reviewer # Since it cannot be saved otherwise
-                workitem.fsconfig = fsconfig
-                workitem.FinalReportPosted = False # To post new report.
-
-                # We don't know how many times it was retested so need to find
-                # out by checkign the done with place.
-                while os.path.exists(DONEWITH_DIR + "/" + workitem.get_saved_name()):
-                    workitem.retestiteration += 1
-
-                workitem.Aborted = False
-                workitem.AbortDone = False
-                workitem.TestingDone = False
-                workitem.TestingStarted = False
-                workitem.TestingError = False
-                workitem.InitialTestingDone = False
-                workitem.InitialTestingError = False
-                workitem.InitialTestingStarted = False
-                # If they requested a different distro to test, lets
-                # cross our fingers and hope the artefacts really are there.
-                if distro:
-                    workitem.distro = distro
+        if command.get("highprio"):
+            change['highprio'] = command['highprio']
 
-                try:
-                    if testlist:
-                        workitem.initial_tests = make_requested_testlist(command, workitem.change.get('branch'))
-                        workitem.tests = []
-                    else:
-                        # Redetermine testlist based on current rules
-                        # instead of depending on old rules in place of
-                        # initial run
-                        change = workitem.change
-                        current_revision = change.get('current_revision')
-                        commit_message = change['revisions'][str(current_revision)]['commit']['message']
-                        files = change['revisions'][str(current_revision)].get('files', [])
-                        isMerge = len(change['revisions'][str(current_revision)]['commit']['parents']) > 1
-                        (DoNothing, ilist, clist) = determine_testlist(change, files, commit_message, ForceFull=isMerge, Branch=change.get('branch'))
-                        workitem.initial_tests = ilist
-                        workitem.tests = clist
-                except: # Add some array list here?
-                    self._debug("Build id: " + retestitem + " cannot update test list")
-
-                WorkList.append(workitem)
+        if change:
+            if testlist:
+                tlist = make_requested_testlist(command, change.get('branch'))
+
+                workitem = GerritWorkItem(change, None, tlist, [], fsconfig, Reviewer=self, DISTRO=distro)
                 managing_condition.acquire()
                 managing_queue.put(workitem)
                 managing_condition.notify()
                 managing_condition.release()
-            elif command.get("abort"):
-                buildnr = command.get("abort")
-                self._debug("Requested abort of build " + str(buildnr))
-                for item in WorkList:
-                    if item.buildnr == buildnr:
-                        item.Aborted = True
-                        self._debug("Aborted build " + str(buildnr))
-                        break
-            elif command.get("idlestop") != None:
-                StopOnIdle = command['idlestop']
-            elif command.get("drain-and-stop") != None:
-                DrainQueueAndStop = command['drain-and-stop']
-                StopOnIdle = DrainQueueAndStop
-            elif command.get("forcetopic") != None:
-                GERRIT_FORCETOPIC = command['forcetopic']
-            elif command.get("removetopic") != None:
-                GERRIT_FORCETOPIC = None
-            elif command.get("add-builders") != None:
-                buildersfilename = command['add-builders']
-                try:
-                    with open(buildersfilename) as buildersfile:
-                        buildersinfo = json.load(buildersfile)
-                except:
-                    self._debug("Malformed builders file " + buildersfilename)
-                else:
-                    for builderinfo in buildersinfo:
-                        if not builderinfo.get('run'):
-                            continue
-                        builders.append(mybuilder.Builder(builderinfo, fsconfig, build_condition, build_queue, managing_condition, managing_queue))
-            elif command.get("add-workers") != None:
-                workersfilename = command['add-workers']
-                try:
-                    with open(workersfilename) as nodes_file:
-                        newworkers = json.load(nodes_file)
-                except:
-                    self._debug("Malformed testnodes file " + workersfilename)
+            else:
+                self.review_change(change, DISTRO=distro)
+            return {'status':'ok', 'message':'Queued ' + str(change.get('_number', change.get('id')))}
+
+        if command.get("retest-item"):
+            retestitem = str(command['retest-item'])
+            self._debug("Asked to retest build id: " + retestitem)
+            # This is a retest request, see if we got new test list
+            # or if not - clean up old tests.
+            try:
+                if "-" in retestitem:
+                    buildnr, iteration = retestitem.split("-", 1)
+                    workitem = done_index.load(int(buildnr), int(iteration))
                 else:
-                    for worker in newworkers:
-                        if not worker.get('name'):
-                            continue
-                        # we need to ensure the worker we are adding
-                        # does not yet exist or hilarity will ensue
-                        found = False
-                        for t in workers:
-                            if t['name'] == worker['name']:
-                                found = True
-                                break
-                        if not found:
-                            worker['thread'] = mytester.Tester(worker, fsconfig, testing_condition, testing_queue, managing_condition, managing_queue)
-                            workers.append(worker)
-
-            elif command.get("del-builders") != None:
-                self._debug("Removing builders is not yet implemented")
-            elif command.get("del-workers") != None:
-                workersfilename = command['del-workers']
-                try:
-                    with open(workersfilename) as nodes_file:
-                        newworkers = json.load(nodes_file)
-                except:
-                    self._debug("Malformed testnodes file " + workersfilename)
+                    workitem = done_index.load(int(retestitem))
+            except:
+                self._debug("Build id: " + retestitem + " cannot be loaded")
+                return {'status':'error', 'message':'Build id ' + retestitem + ' cannot be loaded'}
+            if workitem is None:
+                self._debug("Build id: " + retestitem + " does not exist")
+                return {'status':'error', 'message':'Build id ' + retestitem + ' does not exist'}
+            if not workitem.BuildDone or workitem.BuildError:
+                self._debug("Build id: " + retestitem + " has no successful build")
+                # Cannot retest a failed build
+                return {'status':'error', 'message':'Build id ' + retestitem + ' has no successful build'}
+
+            workitem.Reviewer = reviewer # Since it cannot be saved otherwise
+            workitem.fsconfig = fsconfig
+            workitem.FinalReportPosted = False # To post new report.
+
+            # We don't know how many times it was retested so need to find
+            # out from the done with index.
+            workitem.retestiteration = done_index.next_retest(workitem.buildnr)
+
+            workitem.change.pop('ReusedFrom', None) # This one really runs
+            workitem.Aborted = False
+            workitem.AbortDone = False
+            workitem.TestingDone = False
+            workitem.TestingStarted = False
+            workitem.TestingError = False
+            workitem.InitialTestingDone = False
+            workitem.InitialTestingError = False
+            workitem.InitialTestingStarted = False
+            clear_queued_flags(workitem)
+            # If they requested a different distro to test, lets
+            # cross our fingers and hope the artefacts really are there.
+            if distro:
+                workitem.distro = distro
+
+            try:
+                if testlist:
+                    workitem.initial_tests = make_requested_testlist(command, workitem.change.get('branch'))
+                    workitem.tests = []
                 else:
-                    found = False
-                    for worker in newworkers:
-                        for t in workers:
-                            if t['name'] == worker.get('name'):
-                                t['thread'].RequestExit = True
-                                found = True
-                                break
-                    if found: # need to wake all waiters to ensure threads exit
-                        testing_condition.acquire()
-                        testing_condition.notifyAll()
-                        testing_condition.release()
+                    # Redetermine testlist based on current rules
+                    # instead of depending on old rules in place of
+                    # initial run
+                    change = workitem.change
+                    current_revision = change.get('current_revision')
+                    commit_message = change['revisions'][str(current_revision)]['commit']['message']
+                    files = change['revisions'][str(current_revision)].get('files', [])
+                    isMerge = len(change['revisions'][str(current_revision)]['commit']['parents']) > 1
+                    (DoNothing, ilist, clist) = determine_testlist(change, files, commit_message, ForceFull=isMerge, Branch=change.get('branch'))
+                    workitem.initial_tests = ilist
+                    workitem.tests = clist
+            except: # Add some array list here?
+                self._debug("Build id: " + retestitem + " cannot update test list")
+            workitem.snapshot_next()
 
+            WorkList.append(workitem)
+            managing_condition.acquire()
+            managing_queue.put(workitem)
+            managing_condition.notify()
+            managing_condition.release()
+            return {'status':'ok', 'message':'Retesting build id ' + retestitem + ' iteration ' + str(workitem.retestiteration)}
+        elif command.get("abort"):
+            buildnr = command.get("abort")
+            self._debug("Requested abort of build " + str(buildnr))
+            for item in WorkList:
+                if item.buildnr == buildnr:
+                    abort_workitem(item)
+                    self._debug("Aborted build " + str(buildnr))
+                    return {'status':'ok', 'message':'Aborted build ' + str(buildnr)}
+            return {'status':'error', 'message':'No active build ' + str(buildnr)}
+        elif command.get("idlestop") != None:
+            StopOnIdle = command['idlestop']
+        elif command.get("drain-and-stop") != None:
+            DrainQueueAndStop = command['drain-and-stop']
+            StopOnIdle = DrainQueueAndStop
+        elif command.get("forcetopic") != None:
+            GERRIT_FORCETOPIC = command['forcetopic']
+        elif command.get("removetopic") != None:
+            GERRIT_FORCETOPIC = None
+        elif command.get("add-builders") != None:
+            buildersfilename = command['add-builders']
+            try:
+                with open(buildersfilename) as buildersfile:
+                    buildersinfo = json.load(buildersfile)
+            except:
+                self._debug("Malformed builders file " + buildersfilename)
+                return {'status':'error', 'message':'Malformed builders file ' + buildersfilename}
             else:
-                self._debug("Unknown command file contents: " + str(command))
-
-        # Now check if we have any branches to test
-        for branch in os.listdir(GERRIT_BRANCHMONITORDIR):
+                for builderinfo in buildersinfo:
+                    if not builderinfo.get('run'):
+                        continue
+                    builders.append(mybuilder.Builder(builderinfo, fsconfig, build_condition, build_queue, managing_condition, managing_queue))
+        elif command.get("add-workers") != None:
+            workersfilename = command['add-workers']
             try:
-                with open(GERRIT_BRANCHMONITORDIR + "/" + branch, "r") as brfil:
-                    subject = brfil.read()
-                    subject = subject.strip()
+                with open(workersfilename) as nodes_file:
+                    newworkers = json.load(nodes_file)
+            except:
+                self._debug("Malformed testnodes file " + workersfilename)
+                return {'status':'error', 'message':'Malformed testnodes file ' + workersfilename}
+            else:
+                for worker in newworkers:
+                    if not worker.get('name'):
+                        continue
+                    # we need to ensure the worker we are adding
+                    # does not yet exist or hilarity will ensue
+                    found = False
+                    for t in workers:
+                        if t['name'] == worker['name']:
+                            found = True
+                            break
+                    if not found:
+                        worker['thread'] = mytester.Tester(worker, fsconfig, testing_condition, testing_queue, managing_condition, managing_queue)
+                        workers.append(worker)
+
+        elif command.get("del-builders") != None:
+            self._debug("Removing builders is not yet implemented")
+            return {'status':'error', 'message':'Removing builders is not yet implemented'}
+        elif command.get("del-workers") != None:
+            workersfilename = command['del-workers']
+            try:
+                with open(workersfilename) as nodes_file:
+                    newworkers = json.load(nodes_file)
+            except:
+                self._debug("Malformed testnodes file " + workersfilename)
+                return {'status':'error', 'message':'Malformed testnodes file ' + workersfilename}
+            else:
+                found = False
+                for worker in newworkers:
+                    for t in workers:
+                        if t['name'] == worker.get('name'):
+                            t['thread'].RequestExit = True
+                            found = True
+                            break
+                if found: # need to wake all waiters to ensure threads exit
+                    testing_condition.acquire()
+                    testing_condition.notifyAll()
+                    testing_condition.release()
 
-                os.unlink(GERRIT_BRANCHMONITORDIR + "/" + branch)
-            except OSError:
-                subject = "Cannot read file"
-            # XXX
-            change = make_change_from_hash(branch, subject, branch)
-            change['highprio'] = True
+        else:
+            self._debug("Unknown command file contents: " + str(command))
+            return {'status':'error', 'message':'Unknown command'}
+
+        return {'status':'ok'}
 
-            self.review_change(change)
+
+    def handle_event(self, event):
+        """ React to one gerrit stream event. Must be called from the
+            reviewer thread. """
+        change = event.get('change', {})
+        if change.get('project', self.project) != self.project:
+            return
+        if isinstance(self.branch, list):
+            branches = self.branch
+        else:
+            branches = [self.branch]
+        if change.get('branch') not in branches:
+            return
+        if GERRIT_FORCETOPIC and change.get('topic') != GERRIT_FORCETOPIC:
+            return
+        changenr = change.get('number')
+        if not changenr:
+            return
+
+        if event['type'] == 'change-abandoned':
+            self.settling.pop(('change', str(changenr)), None)
+            self.batcher.remove(changenr)
+            for item in WorkList:
+                if str(item.changenr) == str(changenr) and not item.Aborted:
+                    abort_workitem(item)
+                    self._debug("Aborted build " + str(item.buildnr) + " of abandoned change " + str(changenr))
+            return
+
+        # patchset-created or comment-added, latter could be a rebase
+        # in gerrit ui or anything that requires another look
+        changeinfo = event.get('changeinfo')
+        if not changeinfo:
+            open_changes = self.get_changes({'status':'open',
+                                             'change':str(changenr)},
+                                            Absolute=True)
+            if not open_changes:
+                return
+            changeinfo = open_changes[0]
+        if self.change_needs_review(changeinfo):
+            self.settle_change(changeinfo)
 
     def update_single_change(self, change):
 
@@ -1366,6 +1654,8 @@ class Reviewer(object):
 
         open_changes = self.get_changes({'status':'open',
                                          'change':change}, Absolute=True)
+        if open_changes is None:
+            open_changes = []
         self._debug("update: got %d open_changes", len(open_changes))
 
         for change in open_changes:
@@ -1381,14 +1671,64 @@ class Reviewer(object):
         if self.timestamp <= 0:
             self.load_history()
 
+        intake = CommandIntake([GERRIT_COMMANDMONITORDIR, GERRIT_BRANCHMONITORDIR],
+                               socketpath=GERRIT_CONTROLSOCKET)
+        if make_event_source(GERRIT_EVENT_SOURCE, intake.add_event, self.host):
+            # Events bring in new patchsets, the poll is just to catch
+            # anything we missed while disconnected.
+            self.update_interval = GERRIT_RECONCILE_INTERVAL
+        next_update = 0
+        retry = False
+        draining = False
         while True:
-            if StopOnIdle and len(WorkList) == 0:
+            if StopOnIdle and len(WorkList) == 0 and (DrainQueueAndStop or not self.settling) and not len(self.batcher) and self.finished_batches.empty():
                 print_WorkList_to_HTML()
                 sys.exit(0)
 
-            if not DrainQueueAndStop and managerthread.is_alive():
-                self.update()
-            time.sleep(self.update_interval)
+            # Commands are always looked at, so a drain can be cancelled,
+            # but no new branch work is picked up while draining.
+            if draining and not DrainQueueAndStop:
+                # Branch requests that came in meanwhile did not change
+                # the directory again, look at them now
+                retry = True
+            draining = DrainQueueAndStop
+            if intake.dirs_changed() or retry:
+                retry = self.check_for_commands(Branches=not DrainQueueAndStop)
+
+            for request in intake.wait(COMMAND_CHECK_INTERVAL):
+                if request.kind == 'event':
+                    if DrainQueueAndStop or not managerthread.is_alive():
+                        continue
+                    try:
+                        self.handle_event(request.command)
+                    except Exception as e:
+                        self._error("Failed to handle event %s: %s", str(request.command)[:200], str(e))
+                    continue
+                try:
+                    request.result = self.process_command(request.command)
+                except Exception as e:
+                    request.result = {'status':'error', 'message':str(e)}
+                self._debug("Socket command " + str(request.command) + ": " + str(request.result))
+                request.done.set()
+
+            if self.settling and not DrainQueueAndStop and managerthread.is_alive():
+                self.dispatch_settled()
+
+            if len(self.batcher) and managerthread.is_alive():
+                # Batched changes were taken on already, a drain does
+                # not wait for the batch to fill
+                for group in self.batcher.due(Everything=DrainQueueAndStop):
+                    self.dispatch_batch(group)
+
+            # Posting and re-batching run git and talk to gerrit, that
+            # is too slow for the manager thread
+            while not self.finished_batches.empty():
+                batch_finished(self.finished_batches.get())
+
+            if time.time() >= next_update:
+                if not DrainQueueAndStop and managerthread.is_alive():
+                    self.update()
+                next_update = time.time() + self.update_interval
 
 def save_WorkItem(workitem):
     print_WorkList_to_HTML()
@@ -1410,30 +1750,309 @@ def print_garbage():
     except BlockingIOError:
         print("Overflow of printing queue")
 
+def test_identity(testinfo):
+    """ What makes two test entries the same test run, shards count as
+        their whole test since the split changes with run times """
+    identity = (testinfo.get('ShardOf', testinfo.get('name')), testinfo['test'],
+                testinfo.get('fstype'), bool(testinfo.get('DNE')),
+                bool(testinfo.get('SSK')), bool(testinfo.get('SELINUX')))
+    for elem in ('env', 'austerparam', 'vmparams', 'clientdistro', 'serverdistro', 'forcedistro'):
+        identity += (testinfo.get(elem),)
+    if not testinfo.get('ShardOf'):
+        identity += (testinfo.get('testparam'),)
+    return identity
+
+def same_testing(prior, workitem):
+    """ prior ran the same builds and tests workitem is going to """
+    if prior.distro != workitem.distro:
+        return False
+    if sorted(x.get('distro', prior.distro) for x in prior.builds) != sorted(x.get('distro', workitem.distro) for x in workitem.builds):
+        return False
+    for mine, theirs in ((workitem.initial_tests, prior.initial_tests), (workitem.tests, prior.tests)):
+        if set(test_identity(x) for x in mine) != set(test_identity(x) for x in theirs):
+            return False
+    return True
+
+def has_final_result(prior):
+    """ prior got all the way to a verdict """
+    if prior.Aborted or prior.EmptyJob or not prior.BuildDone:
+        return False
+    if any(build.get('Timeout') for build in prior.builds):
+        return False # more likely the builder than the code
+    if prior.BuildError or not prior.initial_tests or prior.TestingDone:
+        return True
+    return prior.InitialTestingDone and (prior.InitialTestingError or not prior.tests)
+
+def patchset_number(item):
+    return item.change.get('revisions', {}).get(str(item.revision), {}).get('_number', -1)
+
+def find_reusable(change, workitem):
+    """ Look for an earlier build of the same code (same tree or a
+        commit message only change) or a trivial rebase of a revision
+        that passed everything. Returns the ReusedFrom dict or None """
+    if change.get('branchwide') or done_index is None:
+        return None
+    kind = change['revisions'][str(change['current_revision'])].get('kind', 'REWORK')
+    candidates = []
+    tree = change.get('tree')
+    if tree:
+        # Same revision is a retest someone asked for, run it again
+        candidates += [(buildnr, retest, 'results') for buildnr, retest, revision in done_index.find_tree(tree) if revision != workitem.revision]
+    if kind in ('NO_CODE_CHANGE', 'TRIVIAL_REBASE'):
+        for buildnr, retest, revision in done_index.find_change(workitem.changenr):
+            if revision == workitem.revision:
+                continue # that is a retest of us, not an earlier patchset
+            if kind == 'NO_CODE_CHANGE':
+                candidates.append((buildnr, retest, 'results'))
+            elif workitem.tests:
+                candidates.append((buildnr, retest, 'tests'))
+            break # only the patchset right before us counts
+
+    for buildnr, retest, mode in candidates:
+        try:
+            prior = done_index.load(buildnr, retest)
+        except:
+            continue
+        if prior is None or not has_final_result(prior) or not same_testing(prior, workitem):
+            continue
+        if mode == 'results':
+            if not prior.artifactsdir or not os.path.isdir(prior.artifactsdir):
+                continue
+            message = "Patchset %d has the same code as build %d (patchset %d of change %s), its build and test results are carried over instead of running again." % (patchset_number(workitem), prior.buildnr, patchset_number(prior), str(prior.changenr))
+        else:
+            if prior.BuildError or prior.InitialTestingError or prior.TestingError or not prior.TestingDone:
+                continue
+            message = "Patchset %d is a trivial rebase of patchset %d that passed all testing in build %d, only initial testing is repeated." % (patchset_number(workitem), patchset_number(prior), prior.buildnr)
+        return {'mode':mode, 'buildnr':prior.buildnr, 'retest':prior.retestiteration, 'message':message}
+    return None
+
+def carry_over_results(workitem):
+    """ Take over builds and test results of the earlier build of the same
+        code. Its artifacts and result dirs are linked into our build dir
+        so all the links keep working, the test results dir itself is our
+        own so a retest does not write into the earlier build.
+        Returns False if it is gone. """
+    reused = workitem.change['ReusedFrom']
+    try:
+        prior = done_index.load(reused['buildnr'], reused['retest'])
+    except:
+        prior = None
+    if prior is None or not os.path.isdir(prior.artifactsdir):
+        return False
+    priorresults = os.path.normpath(getattr(prior, 'testresultsdir', '') or prior.artifactsdir)
+    for name in os.listdir(prior.artifactsdir):
+        if name.startswith('results') and name.endswith('.html'):
+            continue # ours get written
+        source = prior.artifactsdir + "/" + name
+        target = workitem.artifactsdir + "/" + name
+        if os.path.normpath(source) == priorresults and os.path.isdir(source):
+            os.makedirs(target, exist_ok=True)
+            for entry in os.listdir(source):
+                if not os.path.lexists(target + "/" + entry):
+                    os.symlink(source + "/" + entry, target + "/" + entry)
+            continue
+        if not os.path.lexists(target):
+            os.symlink(source, target)
+
+    def moved(path):
+        if not path:
+            return path
+        return path.replace(prior.artifactsdir, workitem.artifactsdir, 1)
+
+    workitem.builds = copy.deepcopy(prior.builds)
+    workitem.initial_tests = copy.deepcopy(prior.initial_tests)
+    workitem.tests = copy.deepcopy(prior.tests)
+    workitem.snapshot_next()
+    for testinfo in workitem.initial_tests + workitem.tests:
+        if testinfo.get('ResultsDir'):
+            testinfo['ResultsDir'] = moved(testinfo['ResultsDir'])
+    workitem.testresultsdir = moved(getattr(prior, 'testresultsdir', ''))
+    for flag in ('BuildDone', 'BuildError', 'InitialTestingStarted',
+                 'InitialTestingError', 'InitialTestingDone', 'TestingStarted',
+                 'TestingDone', 'TestingError', 'AddedTestFailure'):
+        setattr(workitem, flag, getattr(prior, flag))
+    workitem.ReviewComments = copy.deepcopy(prior.ReviewComments)
+    return True
+
+def batchable(workitem):
+    """ Low risk change that can share a build and test run with others """
+    change = workitem.change
+    if not fsconfig.get('batching') or GERRIT_DRYRUN:
+        return False
+    if change.get('branchwide') or change.get('highprio') or change.get('completion-cb') or change.get('ReusedFrom'):
+        return False
+    return bool(change.get('LowRisk'))
+
+def batch_key(workitem):
+    """ Changes with the same key get the same builds and tests """
+    return (workitem.change.get('branch'), workitem.distro,
+            tuple(sorted(x.get('distro', workitem.distro) for x in workitem.builds)),
+            frozenset(test_identity(x) for x in workitem.initial_tests),
+            frozenset(test_identity(x) for x in workitem.tests))
+
+def batch_member_name(change):
+    patchset = change['revisions'][str(change['current_revision'])].get('_number', -1)
+    return "%s rev %d" % (str(change['_number']), patchset)
+
+def make_batch_item(items):
+    """ Combine the changes of items into one tree on top of their branch
+        and make the work item for it. Returns (batch item or None,
+        items that have to go on their own) """
+    first = items[0]
+    batchid = time.strftime("%Y%m%d%H%M%S") + "-" + str(next(BatchIds))
+    message = "Batch " + batchid + " of changes " + ", ".join(batch_member_name(x.change) for x in items)
+    commit, applied = patch_analyzer.combine(first.change['branch'], [x.change for x in items], message)
+    members = [x for x in items if any(x.change is change for change in applied)]
+    if commit is None or len(members) < 2:
+        return (None, items)
+    ref = "refs/batches/" + batchid
+    if not patch_analyzer.publish(commit, GITSOURCE, ref):
+        return (None, items)
+
+    files = {}
+    for workitem in members:
+        for name in workitem.change['revisions'][str(workitem.revision)].get('files', []):
+            files[name] = {}
+    change = {'branch':first.change['branch'], '_number':'batch-' + batchid,
+              'id':'batch-' + batchid, 'current_revision':commit,
+              'subject':'Batch of ' + ", ".join(batch_member_name(x.change) for x in members),
+              'revisions':{commit:{'ref':ref, '_number':1, 'files':files,
+                                   'commit':{'message':message, 'parents':[{'commit':commit + '^'}]}}},
+              'batch':[{'change':x.change, 'distro':x.distro,
+                        'builds':copy.deepcopy(x.builds),
+                        'initial_tests':copy.deepcopy(x.initial_tests),
+                        'tests':copy.deepcopy(x.tests)} for x in members]}
+    batchitem = GerritWorkItem(change, copy.deepcopy(first.builds),
+                               copy.deepcopy(first.initial_tests),
+                               copy.deepcopy(first.tests), fsconfig,
+                               Reviewer=reviewer, DISTRO=first.distro)
+    return (batchitem, [x for x in items if x not in members])
+
+def queue_batch(items):
+    """ Hand items to the manager as one batch, a lone item or anything
+        that would not combine goes on its own """
+    if len(items) > 1:
+        batchitem, alone = make_batch_item(items)
+    else:
+        batchitem, alone = None, items
+    if batchitem is not None:
+        alone = [batchitem] + alone
+    managing_condition.acquire()
+    for workitem in alone:
+        managing_queue.put(workitem)
+    managing_condition.notify()
+    managing_condition.release()
+
+def batch_member_superseded(change):
+    """ A newer revision of change showed up while its batch ran """
+    changenr = str(change['_number'])
+    revision = change['current_revision']
+    held = reviewer.settling.get(('change', changenr))
+    if held is not None and held['revision'] != revision:
+        return True
+    pending = reviewer.batcher.find(changenr)
+    if pending is not None and pending.revision != revision:
+        return True
+    for item in WorkList:
+        if str(item.changenr) == changenr and item.revision != revision:
+            return True
+        for member in item.change.get('batch', []):
+            if str(member['change']['_number']) == changenr and member['change']['current_revision'] != revision:
+                return True
+    return False
+
+def post_batch_result(workitem, member):
+    """ Report a batch that passed to one of its changes """
+    others = [batch_member_name(x['change']) for x in workitem.change['batch'] if x is not member]
+    message = "Built and tested in build %d together with %s\n" % (workitem.buildnr, ", ".join(others))
+    message += 'Job output URL: ' + workitem.get_base_url() + '/' + workitem.get_results_filename() + '\n\n'
+    if workitem.initial_tests:
+        message += 'Initial testing succeeded.\n' + workitem.test_status_output(workitem.initial_tests)
+    else:
+        message += 'This was detected as a build-only change, no further testing would be performed by this bot.\n'
+    if workitem.tests:
+        message += '\nTesting has completed Successfully\n' + workitem.test_status_output(workitem.tests)
+    if USE_CODE_REVIEW_SCORE:
+        code_review_score = 1
+    else:
+        code_review_score = 0
+    outputdict = {
+        'message': (message),
+        'labels': {
+            'Code-Review': code_review_score
+        },
+        'comments': {},
+        'notify': 'NONE',
+        }
+    post_or_save_review(member['change'], member['change']['current_revision'], workitem.buildnr, outputdict)
+
+def batch_finished(workitem):
+    """ All changes of a batch that passed get its results. A failed one
+        is split in halves that go again, so the culprit ends up on its
+        own with its own build, testing and review. The changes of an
+        aborted one go through review again. Reviewer thread only. """
+    patch_analyzer.publish(None, GITSOURCE, workitem.ref)
+    members = [x for x in workitem.change['batch'] if not batch_member_superseded(x['change'])]
+    if workitem.Aborted:
+        # Says nothing about the changes, they just start over
+        for member in members:
+            reviewer.review_change(member['change'])
+        return
+    if not (workitem.BuildError or workitem.InitialTestingError or workitem.TestingError):
+        for member in members:
+            post_batch_result(workitem, member)
+        return
+
+    items = [GerritWorkItem(x['change'], x['builds'], x['initial_tests'], x['tests'],
+                            fsconfig, Reviewer=reviewer, DISTRO=x['distro']) for x in members]
+    logger = logging.getLogger("Batch")
+    logger.info("batch build " + str(workitem.buildnr) + " failed, splitting " + ", ".join(str(x.changenr) for x in items))
+    half = (len(items) + 1) // 2
+    for group in (items[:half], items[half:]):
+        if group:
+            queue_batch(group)
+
+def make_done_entry(buildnr, retestiteration, subject, status, artifactsdir, resultsfile):
+    """ Row of the recently completed items table """
+    item = {}
+    link = ""
+    if artifactsdir:
+        link = '<a href="' + artifactsdir.replace(fsconfig['root_path_offset'], "") + "/" + resultsfile + '">'
+    item['build'] = link + str(buildnr)
+    if retestiteration:
+        item['build'] += " retest %d" % (retestiteration)
+    item['build'] += '</a>'
+    item['subject'] = link + subject + '</a>'
+    item['status'] = status
+    return item
+
 def donewith_WorkItem(workitem):
     print_WorkList_to_HTML()
     print("Trying to be done with buildid " + str(workitem.buildnr))
-    workitem.save(DONEWITH_DIR)
+    saved = workitem.save(DONEWITH_DIR, Final=True)
     try:
         WorkList.remove(workitem)
     except ValueError:
         pass # We are not in the list, e.g. because this is a duplicate hit for like a crash processing
     else:
-        item = {}
-        link = ""
-        if workitem.artifactsdir:
-            link = '<a href="' + workitem.artifactsdir.replace(fsconfig['root_path_offset'], "") + "/" + workitem.get_results_filename() + '">'
-        item['build'] = link + str(workitem.buildnr)
-        if workitem.retestiteration:
-            item['build'] += " retest %d" % (workitem.retestiteration)
-        item['build'] += '</a>'
-        item['subject'] = link + workitem.change['subject'] + '</a>'
-        item['status'] = workitem.get_current_text_status()
-        DoneList.append(item)
+        if saved:
+            done_index.add(workitem)
+        else:
+            # Index rows must point at a pickle that is there
+            logging.getLogger("DoneWith").error("build " + str(workitem.buildnr) + " could not be archived, not indexed")
+        DoneList.append(make_done_entry(workitem.buildnr,
+                                        workitem.retestiteration,
+                                        workitem.change['subject'],
+                                        workitem.get_current_text_status(),
+                                        workitem.artifactsdir,
+                                        workitem.get_results_filename()))
         # Make sure it does not grow too big
         if len(DoneList) >= 101:
             DoneList.pop(0)
 
+        if workitem.change.get('batch'):
+            reviewer.finished_batches.put(workitem)
+
         if workitem.change.get("completion-cb") or fsconfig.get("testsetdone-cb"): # Need to deliver the results
             if workitem.Aborted:
                 status = "ABORTED"
@@ -1454,10 +2073,7 @@ def donewith_WorkItem(workitem):
                 except OSError as e:
                     print("Error running custom callback for " + str(args))
 
-    try:
-        os.unlink(SAVEDSTATE_DIR + "/" + workitem.get_saved_name())
-    except OSError:
-        pass
+    workitem.remove_saved(SAVEDSTATE_DIR)
 
 def print_WorkList_to_HTML():
     template = """
@@ -1469,6 +2085,12 @@ def print_WorkList_to_HTML():
 <p>
 <b>Test Clusters</b>: {testers}
 <p>
+<b>Test queue waits</b> (p50/p90/p99 minutes): {queuewaits}
+<p>
+<b>Cancelled work</b>: {cancelled}
+<p>
+<b>Boot slots</b> (booting/allowed, usual boot seconds): {bootslots}
+<p>
 <b>Core queue</b>: {corequeue}
 <p>
 <b>Compressor queue</b>: {compressorqueue}
@@ -1522,6 +2144,8 @@ def print_WorkList_to_HTML():
         workitems += '</td><td>'
 
         workitems += workitem.get_current_text_status()
+        if getattr(workitem, 'PredictedCompletion', None) and not workitem.TestingDone:
+            workitems += time.strftime(" (ETA %H:%M)", time.localtime(workitem.PredictedCompletion))
         workitems += '</td></tr>'
 
     completeditems = ""
@@ -1572,6 +2196,32 @@ def print_WorkList_to_HTML():
         deadmsg += "(%d fatal exceptions caught)" % (fatalexceptions)
     testclusters = "Total: %d%s, busy %d, in_error_state %d, idle %d. Items in queue: %d" % (len(workers), deadmsg, busy, invalid, idle, testing_queue.qsize())
 
+    waits = testing_queue.wait_percentiles()
+    try:
+        StatsWriter.queuewaitstats(waits)
+    except:
+        pass # Don't want statistics to disrupt main operations.
+    queuewaits = ""
+    for share in sorted(waits):
+        p50, p90, p99, count = waits[share]
+        queuewaits += "%s: %d/%d/%d (%d); " % (share, p50 / 60, p90 / 60, p99 / 60, count)
+
+    try:
+        StatsWriter.cancelstats(CancelStats)
+    except:
+        pass # Don't want statistics to disrupt main operations.
+    cancelled = "%d builds, %d tests, saved %d builder hours and %d node hours" % (CancelStats['builds'], CancelStats['tests'], CancelStats['builder-seconds'] / 3600, CancelStats['node-seconds'] / 3600)
+
+    bootslots = "not limited"
+    admission = fsconfig.get('boot-admission')
+    if admission is not None:
+        bootslots = ""
+        slots = admission.status()
+        for name in sorted(slots):
+            allowed, booting, usual = slots[name]
+            bootslots += "%s: %d/%d, %s; " % (name, booting, allowed, "%d" % usual if usual is not None else "?")
+        bootslots += "%d waiting" % (admission.waiting_count())
+
     idle = 0
     busy = 0
     dead = 0
@@ -1608,12 +2258,265 @@ def print_WorkList_to_HTML():
 
     all_items = {'status':status, 'workitems':workitems, 'testers':testclusters,\
             'builders':buildclusters, 'completeditems':completeditems, \
+            'queuewaits':queuewaits, 'cancelled':cancelled, \
+            'bootslots':bootslots, \
             'corequeue':fsconfig["core-queue"].qsize(), \
             'compressorqueue':fsconfig["compressor-queue"].qsize()}
     with open(fsconfig["outputs"] + "/status.html", "w") as indexfile:
         indexfile.write(template.format(**all_items))
 
 
+def test_share(entry):
+    """ Fair share a testing queue entry belongs to: (source, branch, owner) """
+    change = entry[2].change
+    if change.get('branchwide'):
+        source = 'branch'
+    elif change.get('completion-cb'):
+        source = 'request'
+    else:
+        source = 'gerrit'
+    owner = change.get('owner', {}).get('_account_id', 'none')
+    return (source, change.get('branch', 'none'), owner)
+
+def test_share_weight(share):
+    """ Product of configured weights like "owner:1234": 0.5,
+        "branch:master": 2 or "source:branch": 0.5, default 1 """
+    weights = fsconfig.get('fairshare-weights', {})
+    weight = 1.0
+    for kind, value in zip(('source', 'branch', 'owner'), share):
+        weight *= weights.get(kind + ':' + str(value), 1.0)
+    return weight
+
+def primary_builds(workitem):
+    """ Builds of the distro testing runs on """
+    primaries = [x for x in workitem.builds if x.get('distro', workitem.distro) == workitem.distro]
+    return primaries or workitem.builds
+
+def primary_build_done(workitem):
+    for buildinfo in primary_builds(workitem):
+        if not buildinfo.get('Finished') or buildinfo.get('Failed'):
+            return False
+    return True
+
+def ready_for_testing(workitem):
+    """ Testing can start once the primary distro built, the rest of the
+        builds are not waited for """
+    if workitem.BuildDone:
+        return True
+    return bool(workitem.initial_tests) and not workitem.BuildError and primary_build_done(workitem)
+
+def waiting_for_builds(workitem):
+    """ Testing got to its final word, but some distro is still building """
+    if workitem.BuildDone or workitem.Aborted:
+        return False
+    if workitem.TestingDone:
+        return True
+    return workitem.InitialTestingDone and (workitem.InitialTestingError or not workitem.tests)
+
+def test_distros_built(workitem, testinfo):
+    """ False while a build testinfo needs is still pending or failed """
+    distro = testinfo.get('forcedistro', workitem.distro)
+    needed = (testinfo.get('serverdistro', distro), testinfo.get('clientdistro', distro))
+    for buildinfo in workitem.builds:
+        if buildinfo.get('distro', workitem.distro) in needed and (not buildinfo.get('Finished') or buildinfo.get('Failed')):
+            return False
+    return True
+
+def queue_builds(workitem):
+    """ Primary distro builds go first, other distros only get the
+        builders nobody else wants until the primary one succeeds """
+    primaries = primary_builds(workitem)
+    build_condition.acquire()
+    for buildinfo in workitem.builds:
+        if fsconfig.get('staged-builds', True) and not any(buildinfo is x for x in primaries):
+            buildinfo['Deferred'] = True
+        build_queue.put([buildinfo, workitem])
+        build_condition.notify()
+    build_condition.release()
+
+def skip_builds(workitem, removed, message):
+    """ Builds taken out of the build queue count as done without a result """
+    count_cancelled(removed, [], [], [])
+    for buildinfo, item in removed:
+        buildinfo['Skipped'] = True
+        workitem.UpdateBuildStatus(buildinfo, message, Finished=True)
+
+def advance_staged_builds(workitem):
+    """ Once the primary distro is built the deferred builds get normal
+        priority, if it failed the ones not started yet are dropped.
+        Same once initial testing failed, the verdict is known already. """
+    if workitem.InitialTestingDone and workitem.InitialTestingError and not workitem.BuildDone:
+        build_condition.acquire()
+        removed = remove_queued_builds(workitem)
+        build_condition.release()
+        if removed:
+            skip_builds(workitem, removed, "Not built, initial testing on " + workitem.distro + " failed")
+        return
+    deferred = [x for x in workitem.builds if x.get('Deferred')]
+    if not deferred:
+        return
+    for buildinfo in primary_builds(workitem):
+        if not buildinfo.get('Finished'):
+            return
+    # A deferred build that got an idle builder may have failed already,
+    # that is no reason to skip the rest when the primary one is fine
+    build_condition.acquire()
+    if not primary_build_done(workitem):
+        removed = build_queue.remove_if(lambda job: job[1] is workitem and job[0].get('Deferred'))
+    else:
+        removed = []
+    for buildinfo in deferred:
+        buildinfo.pop('Deferred', None) # running ones just go on
+    build_queue.requeue_if(lambda job: job[1] is workitem)
+    build_condition.release()
+    if removed:
+        failed = [x.get('distro', workitem.distro) for x in workitem.builds if x.get('Failed')]
+        skip_builds(workitem, removed, "Not built, " + ",".join(failed) + " build failed")
+
+def settle_window(branch, BranchTip=False):
+    """ Seconds to hold new revisions of branch, fsconfig
+        settle-window-branches has per branch overrides """
+    overrides = fsconfig.get('settle-window-branches', {})
+    if branch in overrides:
+        return overrides[branch]
+    if BranchTip:
+        return fsconfig.get('branch-settle-window', fsconfig.get('settle-window', SETTLE_WINDOW))
+    return fsconfig.get('settle-window', SETTLE_WINDOW)
+
+def build_lane(entry):
+    """ Build queue lane: highprio and branch-wide first, then items with
+        initial tests waiting on the build, then everything else """
+    workitem = entry[1]
+    if workitem.change.get('highprio') or workitem.change.get('branchwide'):
+        return 0
+    if workitem.initial_tests:
+        return 1
+    return 2
+
+def build_primary(entry):
+    """ The distro testing runs on is built first """
+    return entry[0].get('distro', entry[1].distro) == entry[1].distro
+
+def build_expected(entry, Primary=False):
+    """ Expected seconds to build entry, of its primary distro with Primary """
+    distro = entry[1].distro
+    if not Primary:
+        distro = entry[0].get('distro', distro)
+    default = fsconfig.get('expected-build-time', 600)
+    runtimes = fsconfig.get('runtime-history')
+    if not runtimes:
+        return default
+    return runtimes.expected_build(distro, default)
+
+def expected_runtime(testinfo, workitem):
+    if testinfo.get('ShardExpected'):
+        return testinfo['ShardExpected']
+    runtimes = fsconfig.get('runtime-history')
+    if not runtimes:
+        return 0
+    return int(runtimes.expected_test(testinfo, testinfo.get('forcedistro', workitem.distro)))
+
+def comprehensive_priority(workitem):
+    # High priority items get placed ahead of the queue.
+    if workitem.change.get('highprio'):
+        return (3, workitem.buildnr)
+    # We sort by build id so the jobs that come in first are served
+    # first for comprehensive testing (initial still in front)
+    # And if there are any free nodes - then subsequent jobs
+    # can come in and do stuff too.
+    # space them out every 100 so we can later add some
+    # additional prioritization if desired.
+    return (workitem.buildnr * 100,)
+
+def queue_built_tests(workitem):
+    """ Tests that waited for another distro to build can go now """
+    testing_condition.acquire()
+    if workitem.TestingStarted:
+        queue_tests(workitem, workitem.tests, comprehensive_priority(workitem))
+    elif not workitem.InitialTestingDone:
+        queue_tests(workitem, workitem.initial_tests, (0, workitem.buildnr))
+        if fsconfig.get('speculative-testing') and workitem.tests:
+            queue_tests(workitem, workitem.tests, (SPECULATIVE_PRIORITY, workitem.buildnr), Speculative=True)
+    testing_condition.release()
+
+def stop_testing(workitem):
+    """ Nothing more is going to be tested, drop queued tests and kill
+        the running ones """
+    for testinfo in workitem.initial_tests + workitem.tests:
+        if not testinfo.get('Finished', False):
+            testinfo['Cancelled'] = True
+    testing_condition.acquire()
+    queuedtests = [entry[1] for entry in withdraw_queued_tests(workitem)]
+    testing_condition.release()
+    count_cancelled([], [], queuedtests, cancel_running_tests(workitem))
+
+def queue_tests(workitem, tests, priority, Speculative=False):
+    """ Queue all unfinished tests, longest expected run time first
+        within the build (LPT) so all of its tests finish close together.
+        priority is a tuple, -expected runtime is appended to it.
+        Returns number of tests queued. Must hold testing_condition. """
+    pending = []
+    for testinfo in tests:
+        # save/restart logic:
+        if testinfo.get('Finished', False):
+            continue
+        if testinfo.get('Queued', False):
+            continue # Already queued or running speculatively
+        if not test_distros_built(workitem, testinfo):
+            continue # Queued once its build is done
+        testinfo['ExpectedRuntime'] = expected_runtime(testinfo, workitem)
+        pending.append(testinfo)
+
+    if not Speculative:
+        predict_completion(workitem, pending, priority)
+    for testinfo in sorted(pending, key=lambda x: (-x['ExpectedRuntime'], x['test'], x.get('fstype', ''))):
+        testinfo['Queued'] = True
+        if Speculative:
+            testinfo['Speculative'] = True
+        testing_queue.put(TupleSortingOn0((priority + (-testinfo['ExpectedRuntime'],), testinfo, workitem)))
+        testing_condition.notify()
+    return len(pending)
+
+def withdraw_queued_tests(workitem, Cancel=False):
+    """ Take all still queued tests of workitem out of the testing queue,
+        returns the removed entries. With Cancel the running speculative
+        ones are stopped too. Must hold testing_condition. """
+    removed = testing_queue.remove_if(lambda entry: entry[2] is workitem)
+    for entry in removed:
+        entry[1].pop('Queued', None)
+    if Cancel:
+        for testinfo in workitem.tests:
+            if testinfo.get('Speculative') and not testinfo.get('Finished', False):
+                testinfo['Cancelled'] = True
+        runningtests = cancel_running_tests(workitem, OnlySpeculative=True)
+        count_cancelled([], [], [entry[1] for entry in removed], runningtests)
+    return removed
+
+def clear_queued_flags(workitem):
+    """ Nothing is queued after a restart or for a retest """
+    for testinfo in workitem.initial_tests + workitem.tests:
+        testinfo.pop('Queued', None)
+        testinfo.pop('Cancelled', None)
+
+def predict_completion(workitem, pending, priority):
+    """ Rough finish time: whatever is queued ahead of us spread over all
+        testers, then our tests longest first. Comprehensive tests not
+        queued yet are assumed to follow the initial ones. """
+    slots = 0
+    for worker in workers:
+        if worker.get('thread') and not worker['thread'].RequestExit:
+            slots += 1
+    ahead = 0
+    for entry in testing_queue.queue:
+        if entry[0] < priority:
+            ahead += entry[1].get('ExpectedRuntime', 0)
+    start = time.time() + ahead / max(slots, 1)
+    finish = predict_makespan([x['ExpectedRuntime'] for x in pending], slots, start)
+    if not workitem.TestingStarted:
+        later = [expected_runtime(x, workitem) for x in workitem.tests if not x.get('Finished', False)]
+        finish = predict_makespan(later, slots, finish)
+    workitem.PredictedCompletion = int(finish)
+
 def run_workitem_manager():
     JobListStatic = True
     current_build = 1
@@ -1710,11 +2613,19 @@ def run_workitem_manager():
             if GERRIT_DRYRUN:
                 donewith_WorkItem(workitem)
                 continue
-            for buildinfo in workitem.builds:
-                build_condition.acquire()
-                build_queue.put([buildinfo, workitem])
-                build_condition.notify()
-                build_condition.release()
+            if workitem.change.get('ReusedFrom', {}).get('mode') == 'results':
+                if carry_over_results(workitem):
+                    logger.info("build " + str(workitem.buildnr) + " reused results of build " + str(workitem.change['ReusedFrom']['buildnr']))
+                    save_WorkItem(workitem)
+                    add_review_comment(workitem)
+                    # Retests of this build are not carried over
+                    workitem.change.pop('ReusedFrom')
+                    workitem.snapshot_next()
+                    workitem.Write_HTML_Status()
+                    donewith_WorkItem(workitem)
+                    continue
+                workitem.change.pop('ReusedFrom') # Gone meanwhile, do it all
+            queue_builds(workitem)
             continue
 
         if workitem.AbortDone:
@@ -1722,6 +2633,7 @@ def run_workitem_manager():
             # just strugglers coming out
             continue
 
+        advance_staged_builds(workitem)
         save_WorkItem(workitem)
         # We print all the updated state changes to gerrit here, and not above, but need to
         # move it above if we want to also print the "Job picked up" sort of messages
@@ -1739,6 +2651,9 @@ def run_workitem_manager():
             # We just failed the build
             # report and don't return this item anywhere
             logger.warning("ref " + workitem.ref + " build " + str(workitem.buildnr)  + " failed building")
+            if workitem.InitialTestingStarted:
+                # Other distro failed after testing on the primary started
+                stop_testing(workitem)
             donewith_WorkItem(workitem)
             workitem = None
             print_garbage()
@@ -1753,7 +2668,15 @@ def run_workitem_manager():
             print_garbage()
             continue
 
-        if workitem.BuildDone and not workitem.InitialTestingStarted:
+        if waiting_for_builds(workitem):
+            logger.info("ref " + workitem.ref + " build " + str(workitem.buildnr)  + " testing done, waiting for remaining builds")
+            continue
+
+        if workitem.InitialTestingStarted and not workitem.TestingDone:
+            # Anything that waited for a build that just completed
+            queue_built_tests(workitem)
+
+        if ready_for_testing(workitem) and not workitem.InitialTestingStarted:
             # Just finished building, need to do some initial testing
             # Create the test output dir first
             testresultsdir = workitem.artifactsdir + "/" + fsconfig["testoutputdir"]
@@ -1768,14 +2691,12 @@ def run_workitem_manager():
             workitem.testresultsdir = testresultsdir
             workitem.InitialTestingStarted = True
             testing_condition.acquire()
-            # Perhaps also sort by timeout once populated?
-            for testinfo in sorted(workitem.initial_tests, key=operator.itemgetter('test')):
-                # save/restart logic:
-                if testinfo.get('Finished', False):
-                    continue
-                # First 0 is priority - highest
-                testing_queue.put(TupleSortingOn0((0, testinfo, workitem)))
-                testing_condition.notify()
+            # First 0 is priority - highest
+            queue_tests(workitem, workitem.initial_tests, (0, workitem.buildnr))
+            if fsconfig.get('speculative-testing') and workitem.tests:
+                # Let idle testers get a head start on comprehensive
+                # testing, these only run when there is nothing else to do
+                queue_tests(workitem, workitem.tests, (SPECULATIVE_PRIORITY, workitem.buildnr), Speculative=True)
             testing_condition.release()
             continue
 
@@ -1790,6 +2711,10 @@ def run_workitem_manager():
             # Need to report it and move on,
             # Don't return the item anywhere
             logger.warning("ref " + workitem.ref + " build " + str(workitem.buildnr)  + " failed initial testing")
+            testing_condition.acquire()
+            if withdraw_queued_tests(workitem, Cancel=True):
+                logger.info("build " + str(workitem.buildnr) + " dropped queued speculative tests")
+            testing_condition.release()
             donewith_WorkItem(workitem)
             workitem = None
             print_garbage()
@@ -1809,32 +2734,19 @@ def run_workitem_manager():
             logger.info("ref " + workitem.ref + " build " + str(workitem.buildnr)  + " completed initial testing and switching to full testing " + str(workitem.tests))
             workitem.TestingStarted = True
             testing_condition.acquire()
-            # Perhaps sort by timeout once available to run short tests
-            # first?
-            for testinfo in sorted(workitem.tests, key=operator.itemgetter('test', 'fstype')):
-                # save/restart logic:
-                if testinfo.get('Finished', False):
-                    continue
-
-                # High priority items get placed ahead of the queue.
-                if workitem.change.get('highprio'):
-                    priority = 3
-                # We sort by build id so the jobs that come in first are served
-                # first for comprehensive testing (initial still in front)
-                # And if there are any free nodes - then subsequent jobs
-                # can come in and do stuff too.
-                # jobs with timeouts less than 1000 seconds are fast and it's
-                # worth letting them in first anyway to keep a pool of nodes
-                # that would complete fast for use by later lower priority tests
-                elif testinfo['timeout'] > 0 and testinfo['timeout'] <= 1000:
-                    priority = workitem.buildnr
-                else:
-                    # space them out every 100 so we can later add some
-                    # additional prioritization if desired.
-                    priority = workitem.buildnr * 100
-                testing_queue.put(TupleSortingOn0((priority, testinfo, workitem)))
-                testing_condition.notify()
+            priority = comprehensive_priority(workitem)
+            # Speculative ones that did not get to run yet need the real
+            # priority now
+            withdraw_queued_tests(workitem)
+            queued = queue_tests(workitem, workitem.tests, priority)
             testing_condition.release()
+            if not queued:
+                workitem.lock.acquire()
+                if not workitem.TestingDone and all(x.get('Finished', False) for x in workitem.tests):
+                    # Everything already ran speculatively
+                    workitem.TestingDone = True
+                    managing_queue.put(workitem) # Ok not to lock here, we are the consumer anyway.
+                workitem.lock.release()
             continue
 
         if workitem.TestingDone:
@@ -1867,12 +2779,19 @@ if __name__ == "__main__":
 
     fsconfig["testoutputowneruid"] = testoutputowner_uid
 
+    # One thread watches the processes of all builders and testers
+    fsconfig['supervisor'] = Supervisor()
     for arch in architectures:
         with open("builders-" + arch + ".json") as buildersfile:
             buildersinfo = json.load(buildersfile)
             for builderinfo in buildersinfo:
                 builders.append(mybuilder.Builder(builderinfo, fsconfig, build_condition, build_queue, managing_condition, managing_queue))
 
+    # Limit how many VMs boot at once per host and NFS root server,
+    # boot-concurrency of 0 turns it off
+    if fsconfig.get('boot-concurrency', 8):
+        fsconfig['boot-admission'] = BootAdmission(initial=fsconfig.get('boot-concurrency', 8),
+                                                   maximum=fsconfig.get('boot-concurrency-max', 64))
     for worker in workers:
         worker['thread'] = mytester.Tester(worker, fsconfig, testing_condition,\
                                            testing_queue, managing_condition, \
@@ -1883,11 +2802,18 @@ if __name__ == "__main__":
     fsconfig['core-threads'] = []
     fsconfig['compressor-queue'] = queue.Queue()
     fsconfig['compressor-threads'] = []
+    fsconfig['runtime-history'] = RuntimeHistory(RUNTIME_HISTORY_DB)
+    testing_queue.maxwait = fsconfig.get('fairshare-max-wait', testing_queue.maxwait)
     for i in range(fsconfig['core-processors']):
             fsconfig['core-threads'].append(mycrashanalyzer.Crasher(fsconfig, fsconfig['core-queue'], fsconfig['compressor-queue']))
     for i in range(fsconfig['core-compressors']):
             fsconfig['compressor-threads'].append(mycrashanalyzer.Compressor(fsconfig, fsconfig['compressor-queue']))
 
+    # Now load last 100 entries from the done list
+    done_index = DoneIndex(DONEWITH_INDEX, DONEWITH_DIR)
+    for row in done_index.recent(100):
+        DoneList.append(make_done_entry(*row))
+
     managerthread = threading.Thread(target=run_workitem_manager, args=())
     managerthread.daemon = True
     managerthread.start()
@@ -1897,80 +2823,71 @@ if __name__ == "__main__":
         username = auth[GERRIT_HOST]['gerrit/http']['username']
         password = auth[GERRIT_HOST]['gerrit/http']['password']
 
+    patch_analyzer = PatchAnalyzer(PATCH_MIRROR,
+                                   "https://" + GERRIT_HOST + "/" + GERRIT_PROJECT,
+                                   workers=fsconfig.get('patch-analyzers', 8))
+
     reviewer = Reviewer(GERRIT_HOST, GERRIT_PROJECT, GERRIT_BRANCH,
                         username, password, REVIEW_HISTORY_PATH)
 
     StatsWriter = mystatswriter.StatsWriter()
 
     for savedstateitem in os.listdir(SAVEDSTATE_DIR):
-        with open(SAVEDSTATE_DIR + "/" + savedstateitem, "rb") as blah:
-            try:
-                saveitem = pickle.load(blah)
-            except:
-                # delete bad item.
-                os.unlink(SAVEDSTATE_DIR + "/" + savedstateitem)
-                continue
-
-            sys.stdout.flush()
-            if saveitem.Aborted: # Kill it
-                os.unlink(SAVEDSTATE_DIR + "/" + savedstateitem)
-            elif not saveitem.BuildDone:
-                # Need to clean up build dir
-                try:
-                    shutil.rmtree(fsconfig["outputs"] + "/" + str(saveitem.buildnr))
-                except OSError:
-                    pass # Ok if it's not there
-                saveitem.recovering = True
-            elif saveitem.BuildError or (saveitem.InitialTestingError and saveitem.InitialTestingDone) or (saveitem.TestingError and saveitem.TestingDone):
-                pass # just insert for final notify
-            elif saveitem.InitialTestingStarted and not saveitem.InitialTestingDone:
-                # To reinsert it we just need to unmark initial testing started
-                saveitem.InitialTestingStarted = False
-            elif saveitem.TestingStarted and not saveitem.TestingDone:
-                # Same here
-                saveitem.TestingStarted = False
-
-            saveitem.Reviewer = reviewer # Since it cannot be saved otherwise
-            saveitem.fsconfig = fsconfig
-
-            WorkList.append(saveitem)
-            managing_condition.acquire()
-            managing_queue.put(saveitem)
-            managing_condition.notify()
-            managing_condition.release()
-
-    # Now load last 100 entries from the done list
-    for savedstateitem in sorted(os.listdir(DONEWITH_DIR), key=lambda x: int(x.replace('-', '.').split('.')[0]), reverse=True):
-        with open(DONEWITH_DIR + "/" + savedstateitem, "rb") as blah:
+        if not savedstateitem.endswith(".pickle"):
+            continue # journals are replayed together with their snapshot
+        try:
+            saveitem = GerritWorkItem.load(SAVEDSTATE_DIR, savedstateitem)
+        except:
+            # delete bad item.
+            os.unlink(SAVEDSTATE_DIR + "/" + savedstateitem)
             try:
-                saveitem = pickle.load(blah)
-            except:
-                continue # ignore bad items
-        if not saveitem.buildnr:
+                os.unlink(SAVEDSTATE_DIR + "/" + savedstateitem + ".journal")
+            except OSError:
+                pass
             continue
-        if saveitem.artifactsdir:
-            savelink = '<a href="' + saveitem.artifactsdir.replace(fsconfig['root_path_offset'], "") + "/" + saveitem.get_results_filename() + '">'
-        else:
-            savelink = ""
-        doneitem = {}
-        doneitem['build'] = savelink + str(saveitem.buildnr) + '</a>'
 
-        if saveitem.change.get('subject'):
-            doneitem['subject'] = savelink + saveitem.change['subject'] + '</a>'
-        else:
-            doneitem['subject'] = savelink + saveitem.change['id']  + '</a>'
-
-        try:
-            doneitem['status'] = saveitem.get_current_text_status()
-        except:
-            doneitem['status'] = "Too old to know state"
-
-        DoneList.insert(0, doneitem)
-        if len(DoneList) == 100:
-            break
-    # free up some RAM
-    del saveitem
-    del doneitem
+        sys.stdout.flush()
+        if saveitem.Aborted: # Kill it
+            saveitem.remove_saved(SAVEDSTATE_DIR)
+        elif not saveitem.BuildDone:
+            # Need to clean up build dir
+            try:
+                shutil.rmtree(fsconfig["outputs"] + "/" + str(saveitem.buildnr))
+            except OSError:
+                pass # Ok if it's not there
+            saveitem.recovering = True
+            # With staged builds testing might have started already, those
+            # results went away with the build dir
+            saveitem.BuildError = False
+            saveitem.InitialTestingStarted = False
+            saveitem.InitialTestingDone = False
+            saveitem.InitialTestingError = False
+            saveitem.TestingStarted = False
+            saveitem.TestingDone = False
+            saveitem.TestingError = False
+            for buildinfo in saveitem.builds:
+                for item in ('Finished', 'Failed', 'Timeout', 'Deferred', 'Skipped'):
+                    buildinfo.pop(item, None)
+            for testinfo in saveitem.initial_tests + saveitem.tests:
+                testinfo['Finished'] = False
+        elif saveitem.BuildError or (saveitem.InitialTestingError and saveitem.InitialTestingDone) or (saveitem.TestingError and saveitem.TestingDone):
+            pass # just insert for final notify
+        elif saveitem.InitialTestingStarted and not saveitem.InitialTestingDone:
+            # To reinsert it we just need to unmark initial testing started
+            saveitem.InitialTestingStarted = False
+        elif saveitem.TestingStarted and not saveitem.TestingDone:
+            # Same here
+            saveitem.TestingStarted = False
+        clear_queued_flags(saveitem)
+
+        saveitem.Reviewer = reviewer # Since it cannot be saved otherwise
+        saveitem.fsconfig = fsconfig
+
+        WorkList.append(saveitem)
+        managing_condition.acquire()
+        managing_queue.put(saveitem)
+        managing_condition.notify()
+        managing_condition.release()
 
     print_WorkList_to_HTML()
 
@@ -0,0 +1,118 @@
+""" Limits how many VMs boot at once so the VM hosts and the NFS servers
+    their roots come from are not swamped by a burst of new tests
+"""
+import time
+import threading
+import logging
+
+class Bucket(object):
+    """ Boot slots of one host or NFS server. The number of slots grows
+        by one for every limit worth of boots that went fine and is halved
+        when a boot fails or takes slowfactor times longer than usual
+        (AIMD). Usual is the moving average of boot times. """
+    def __init__(self, name, initial, minimum, maximum, slowfactor, alpha):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.slowfactor = slowfactor
+        self.alpha = alpha
+        self.inflight = 0
+        self.baseline = None
+        self.lastdecrease = 0
+        self.logger = logging.getLogger("BootAdmission")
+
+    def has_room(self, weight):
+        # Something must always be able to go, however big
+        return self.inflight == 0 or self.inflight + weight <= int(self.limit)
+
+    def feedback(self, started, weight, duration, failed):
+        slow = not failed and self.baseline is not None and \
+               duration > self.slowfactor * self.baseline
+        if not failed:
+            if self.baseline is None:
+                self.baseline = float(duration)
+            else:
+                self.baseline = self.alpha * duration + (1 - self.alpha) * self.baseline
+        if failed or slow:
+            # Boots started before the last cut still saw the old load
+            if started > self.lastdecrease:
+                self.limit = max(self.minimum, self.limit / 2)
+                self.lastdecrease = time.time()
+                self.logger.warning("%s: boot %s, down to %d booting VMs" %
+                                    (self.name, "failed" if failed else "took %ds" % duration, int(self.limit)))
+            return
+        self.limit = min(self.maximum, self.limit + float(weight) / self.limit)
+
+class BootAdmission(object):
+    """ Every boot asks for room in the buckets of all resources it uses
+        (e.g. its host and its NFS root server). Boots sharing a resource
+        go in the order they asked. """
+    def __init__(self, initial=8, minimum=2, maximum=64, slowfactor=2.0, alpha=0.2):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.slowfactor = slowfactor
+        self.alpha = alpha
+        self.cond = threading.Condition()
+        self.buckets = {}
+        self.waiting = [] # tickets in arrival order
+
+    def _bucket(self, name):
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            bucket = Bucket(name, self.initial, self.minimum, self.maximum,
+                            self.slowfactor, self.alpha)
+            self.buckets[name] = bucket
+        return bucket
+
+    def _can_go(self, ticket):
+        for other in self.waiting:
+            if other is ticket:
+                break
+            if set(other['resources']) & set(ticket['resources']):
+                return False
+        return all(bucket.has_room(ticket['weight']) for bucket in ticket['buckets'])
+
+    def admit(self, resources, weight=1, abort=None, poll=5):
+        """ Wait until all of resources have room for weight more booting
+            VMs. Returns a ticket to hand to release or None if abort()
+            came true while waiting """
+        with self.cond:
+            ticket = {'resources':list(resources), 'weight':weight,
+                      'buckets':[self._bucket(x) for x in resources],
+                      'started':None}
+            self.waiting.append(ticket)
+            while not self._can_go(ticket):
+                if abort is not None and abort():
+                    self.waiting.remove(ticket)
+                    self.cond.notify_all()
+                    return None
+                self.cond.wait(poll)
+            self.waiting.remove(ticket)
+            for bucket in ticket['buckets']:
+                bucket.inflight += weight
+            ticket['started'] = time.time()
+            self.cond.notify_all()
+        return ticket
+
+    def release(self, ticket, duration=None, Failed=False):
+        """ Boot of ticket is over. duration is how long it took if it
+            worked, Failed if it did not. Neither if it says nothing about
+            the load, like a cancelled boot """
+        with self.cond:
+            for bucket in ticket['buckets']:
+                bucket.inflight -= ticket['weight']
+                if Failed or duration is not None:
+                    bucket.feedback(ticket['started'], ticket['weight'], duration, Failed)
+            self.cond.notify_all()
+
+    def status(self):
+        """ {resource: (allowed, booting, usual boot seconds)} """
+        with self.cond:
+            return {name: (int(bucket.limit), bucket.inflight, bucket.baseline)
+                    for name, bucket in self.buckets.items()}
+
+    def waiting_count(self):
+        with self.cond:
+            return len(self.waiting)
@@ -0,0 +1,90 @@
+""" Collects small independent changes so they get built and tested
+    together as one combined tree
+"""
+import time
+import threading
+
+class Batcher(object):
+    """ Pending groups of work items keyed by whatever must be the same
+        for them to share one build and test run (branch, distros, test
+        lists). Items in a group never touch the same file. A group goes
+        out once it has maxsize items or its oldest one waited maxwait
+        seconds. """
+    def __init__(self, maxsize=8, maxwait=600):
+        self.maxsize = maxsize
+        self.maxwait = maxwait
+        self.groups = {} # key -> [{'first':time, 'items':[(workitem, files, since)]}]
+        self.lock = threading.Lock()
+
+    def _remove(self, changenr):
+        for key in list(self.groups):
+            groups = self.groups[key]
+            for group in groups:
+                group['items'] = [x for x in group['items'] if str(x[0].changenr) != str(changenr)]
+            groups[:] = [group for group in groups if group['items']]
+            if not groups:
+                del self.groups[key]
+
+    def add(self, key, workitem, files, since=0):
+        """ Queue workitem, an earlier revision of the same change is
+            dropped. since is the poll cursor that still covers it.
+            Returns the list of items of a group that got full """
+        files = set(files)
+        with self.lock:
+            self._remove(workitem.changenr)
+            groups = self.groups.setdefault(key, [])
+            for group in groups:
+                if not any(files & x[1] for x in group['items']):
+                    break
+            else:
+                group = {'first':time.time(), 'items':[]}
+                groups.append(group)
+            group['items'].append((workitem, files, since))
+            if len(group['items']) < self.maxsize:
+                return None
+            groups.remove(group)
+            if not groups:
+                del self.groups[key]
+        return [x[0] for x in group['items']]
+
+    def remove(self, changenr):
+        """ Forget the pending item of changenr (abandoned) """
+        with self.lock:
+            self._remove(changenr)
+
+    def find(self, changenr):
+        """ Pending work item of changenr or None """
+        with self.lock:
+            for groups in self.groups.values():
+                for group in groups:
+                    for item in group['items']:
+                        if str(item[0].changenr) == str(changenr):
+                            return item[0]
+        return None
+
+    def since(self):
+        """ Oldest poll cursor of anything pending or None """
+        with self.lock:
+            cursors = [item[2] for groups in self.groups.values() for group in groups for item in group['items']]
+        if not cursors:
+            return None
+        return min(cursors)
+
+    def due(self, Everything=False):
+        """ Take out groups that waited long enough (all of them with
+            Everything), returns a list of work item lists """
+        now = time.time()
+        result = []
+        with self.lock:
+            for key in list(self.groups):
+                groups = self.groups[key]
+                for group in [x for x in groups if Everything or now - x['first'] >= self.maxwait]:
+                    groups.remove(group)
+                    result.append([x[0] for x in group['items']])
+                if not groups:
+                    del self.groups[key]
+        return result
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(group['items']) for groups in self.groups.values() for group in groups)
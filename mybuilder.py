@@ -2,13 +2,15 @@
 """
 import sys
 import os
+import signal
 import threading
 import logging
 import shlex
 import traceback
 from pprint import pprint
-from subprocess import Popen, PIPE, TimeoutExpired
+from subprocess import Popen, PIPE
 import time
+from myoutputbuffer import OutputBuffer
 
 def parse_compile_error(change, stderr):
     """ Parse build error and create annotated gettit object """
@@ -100,6 +102,9 @@ class Builder(object):
             buildinfo = job[0]
             workitem = job[1]
             self.logger.info("Got build job " + buildinfo.get('distro', 'NONE') + " for id " + str(workitem.buildnr))
+            self.jobstart = time.time()
+            self.currentjob = job
+            self.currentitem = workitem
             try:
                 result = self.build_worker(buildinfo, workitem)
                 self.logger.info("Finished build job " + buildinfo.get('distro', 'NONE') + " for id " + str(workitem.buildnr))
@@ -109,6 +114,9 @@ class Builder(object):
                 self.logger.info("backtrace: " + str(tb))
                 result = True # No point in restarting a bad job?
                 self.fatal_exceptions += 1
+            self.currentjob = None
+            self.currentitem = None
+            self.process = None
 
             if result:
                 # On correct run return it to manager
@@ -135,14 +143,37 @@ class Builder(object):
         self.RequestExit = False
         self.OneShot = builderinfo.get('oneshot', False)
         self.fatal_exceptions = 0
+        self.currentjob = None
+        self.currentitem = None
+        self.process = None
+        self.jobstart = 0
         self.daemon = threading.Thread(target=self.run_daemon, args=(in_cond, in_queue, out_cond, out_queue))
         self.daemon.daemon = True
         self.daemon.start()
 
+    def kill_build(self, process):
+        """ Build script spawns a whole tree of make and friends, kill it all.
+            Scripts that build elsewhere must stop the remote build on TERM
+            (builder-run-remote.sh does) """
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except OSError:
+            pass # Already gone
+
+    def cancel(self, workitem):
+        """ Called from other threads. Kill our build if it is for workitem
+            Returns (job, seconds it ran) or None if we were not building it """
+        process = self.process
+        job = self.currentjob
+        if self.currentitem is not workitem or process is None:
+            return None
+        self.logger.warning("Cancelling build for id " + str(workitem.buildnr))
+        self.kill_build(process)
+        return (job, time.time() - self.jobstart)
+
     def build_worker(self, buildinfo, workitem):
         # Might need to make this per-arch?
 
-        # Only check at the start.
         if workitem.Aborted:
             return True
 
@@ -161,25 +192,44 @@ class Builder(object):
             env = os.environ.copy()
             env['DISTRO'] = distro
 
-            builder = Popen(args, close_fds=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=True, env=env)
+            # Own process group so cancel can get all the children too
+            builder = Popen(args, close_fds=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=True, env=env, start_new_session=True)
         except (OSError) as details:
             self.logger.warning("Failed to run builder " + str(details))
             return False
+        self.process = builder
+        started = time.time()
+        if workitem.Aborted: # Raced with cancel
+            self.kill_build(builder)
 
-        outs = ""
-        errs = ""
+        # Full output goes next to the artifacts, the tail stays here
+        outs = OutputBuffer(outdir + "/build-" + distro + ".stdout")
+        errs = OutputBuffer(outdir + "/build-" + distro + ".stderr")
+        try:
+            builder.stdin.close()
+        except OSError:
+            pass
+        watch = self.fsinfo['supervisor'].watch()
+        watch.add_process(builder, outs.write, errs.write)
         try:
             # Typically build takes 4-5 minutes, so 30 minutes should be aplenty
             # This is because we run our builders at the lowest priority and
             # so procuring enough cpu time might be hard under load.
-            outs, errs = builder.communicate(timeout=1800)
-        except TimeoutExpired:
-            self.logger.info("Build " + str(buildnr) + " timed out, killing")
-            builder.terminate()
-            touts, terrs = builder.communicate()
-            outs += touts
-            errs += terrs
-            workitem.UpdateBuildStatus(buildinfo, "Build is taking too long, aborting", Timeout=True, Failed=True, BuildStdOut=outs, BuildStdErr=errs)
+            if not watch.wait_exit(builder, 1800):
+                self.logger.info("Build " + str(buildnr) + " timed out, killing")
+                self.kill_build(builder)
+                while not watch.wait_exit(builder, 600):
+                    self.logger.warning("Build " + str(buildnr) + " does not want to die")
+                workitem.UpdateBuildStatus(buildinfo, "Build is taking too long, aborting", Timeout=True, Failed=True, BuildStdOut=outs.reference(), BuildStdErr=errs.reference())
+                return True
+        finally:
+            watch.close()
+            outs.close()
+            errs.close()
+
+        if workitem.Aborted:
+            # Killed or not, nobody wants the results anymore
+            self.logger.info("Build " + str(buildnr) + " aborted")
             return True
 
         if builder.returncode != 0:
@@ -189,29 +239,32 @@ class Builder(object):
             if code in (255, 2, 1):
                 # Technically we want to put the job back into build queue
                 message = "General error"
-                self.logger.warning("stdout: " + outs)
-                self.logger.warning("stderr: " + errs)
+                self.logger.warning("stdout: " + str(outs))
+                self.logger.warning("stderr: " + str(errs))
                 return False
             elif code == 10:
-                message = "git checkout error error: \n" + errs
+                message = "git checkout error error: \n" + str(errs)
                 return False #let's retry
             elif code == 12:
-                message = "Configure error: \n" + errs
+                message = "Configure error: \n" + str(errs)
             elif code == 14:
                 # This is a build error, we can try to parse it
-                reviewitems = parse_compile_error(workitem.change, errs)
+                reviewitems = parse_compile_error(workitem.change, str(errs))
                 buildinfo['ReviewComments'] = reviewitems
                 message = '%s: Compile failed\n' % (distro)
                 if not reviewitems:
-                    message += errs.replace('\n', '\n ')
+                    message += str(errs).replace('\n', '\n ')
             else:
-                self.logger.warning("stdout: " + outs)
-                self.logger.warning("stderr: " + errs)
+                self.logger.warning("stdout: " + str(outs))
+                self.logger.warning("stderr: " + str(errs))
 
-            workitem.UpdateBuildStatus(buildinfo, message, Timeout=True, Failed=True, BuildStdOut=outs, BuildStdErr=errs)
+            workitem.UpdateBuildStatus(buildinfo, message, Timeout=True, Failed=True, BuildStdOut=outs.reference(), BuildStdErr=errs.reference())
         else:
             message = "Success"
+            history = self.fsinfo.get('runtime-history')
+            if history is not None:
+                history.record_build(distro, time.time() - started)
             # XXX add a check that artifact exists
-            workitem.UpdateBuildStatus(buildinfo, message, Finished=True, BuildStdOut=outs, BuildStdErr=errs)
+            workitem.UpdateBuildStatus(buildinfo, message, Finished=True, BuildStdOut=outs.reference(), BuildStdErr=errs.reference())
 
         return True
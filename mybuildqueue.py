@@ -0,0 +1,135 @@
+""" Build queue, drop in replacement for the queue.Queue of
+    [buildinfo, workitem] entries
+"""
+import time
+import heapq
+import queue
+import threading
+import itertools
+
+class BuildQueue(object):
+    """ Entries are served by lane_of(entry) (lower first), then work
+        items with the shortest expected build first, all builds of one
+        work item together with its primary distro first.
+        expected_of(entry) is the expected build time of entry in seconds.
+        An entry that waited longer than maxwait is served first so long
+        builds do not starve. Deferred builds (buildinfo['Deferred']) only
+        go when there is nothing else to build. """
+    def __init__(self, lane_of, expected_of, primary_of, maxwait=2 * 3600):
+        self.lane_of = lane_of
+        self.expected_of = expected_of
+        self.primary_of = primary_of
+        self.maxwait = maxwait
+        self.heap = []
+        self.items = {} # id(workitem) -> [item key, queued entries]
+        self.seq = itertools.count()
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+
+    def _itemkey(self, entry):
+        workitem = entry[1]
+        known = self.items.get(id(workitem))
+        if known is not None:
+            known[1] += 1
+            return known[0]
+        # All builds of the item sort by its primary build, so they stay
+        # together even when other items are queued later
+        key = (self.lane_of(entry), self.expected_of(entry, Primary=True), next(self.seq))
+        self.items[id(workitem)] = [key, 1]
+        return key
+
+    def _forget(self, entry):
+        known = self.items.get(id(entry[1]))
+        if known is None:
+            return
+        known[1] -= 1
+        if known[1] <= 0:
+            del self.items[id(entry[1])]
+
+    def put(self, entry, block=True, timeout=None):
+        with self.mutex:
+            itemkey = self._itemkey(entry)
+            primary = 0 if self.primary_of(entry) else 1
+            deferred = 1 if entry[0].get('Deferred') else 0
+            item = (deferred, itemkey, primary, self.expected_of(entry), next(self.seq), time.time(), entry)
+            heapq.heappush(self.heap, item)
+            self.not_empty.notify()
+
+    def _pick(self):
+        now = time.time()
+        oldest = None
+        for idx, item in enumerate(self.heap):
+            if not item[0] and now - item[5] > self.maxwait:
+                if oldest is None or item[5] < self.heap[oldest][5]:
+                    oldest = idx
+        if oldest is None:
+            return heapq.heappop(self.heap)
+        item = self.heap[oldest]
+        self.heap[oldest] = self.heap[-1]
+        self.heap.pop()
+        heapq.heapify(self.heap)
+        return item
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if not block:
+                if not self.heap:
+                    raise queue.Empty
+            elif timeout is None:
+                while not self.heap:
+                    self.not_empty.wait()
+            else:
+                deadline = time.time() + timeout
+                while not self.heap:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self.not_empty.wait(remaining)
+            item = self._pick()
+            self._forget(item[6])
+            return item[6]
+
+    def remove_if(self, predicate):
+        """ Take out and return all entries predicate(entry) is true for """
+        with self.mutex:
+            removed = [item[6] for item in self.heap if predicate(item[6])]
+            if removed:
+                self.heap = [item for item in self.heap if not predicate(item[6])]
+                heapq.heapify(self.heap)
+                for entry in removed:
+                    self._forget(entry)
+        return removed
+
+    def requeue_if(self, predicate):
+        """ Sort entries predicate(entry) is true for again after their
+            buildinfo changed, they keep their work item's place """
+        with self.mutex:
+            count = 0
+            for idx, item in enumerate(self.heap):
+                if predicate(item[6]):
+                    deferred = 1 if item[6][0].get('Deferred') else 0
+                    self.heap[idx] = (deferred,) + item[1:]
+                    count += 1
+            if count:
+                heapq.heapify(self.heap)
+        return count
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def put_nowait(self, entry):
+        return self.put(entry, block=False)
+
+    def qsize(self):
+        with self.mutex:
+            return len(self.heap)
+
+    def empty(self):
+        with self.mutex:
+            return not self.heap
+
+    @property
+    def queue(self):
+        """ Snapshot of all queued entries, in no particular order """
+        with self.mutex:
+            return [item[6] for item in self.heap]
@@ -0,0 +1,129 @@
+""" Immediate intake of control commands for the reviewer thread
+"""
+import os
+import json
+import queue
+import socket
+import socketserver
+import threading
+import logging
+
+class CommandRequest(object):
+    """ One command submitted through the control socket, the submitter
+        waits on done until the reviewer thread fills in result.
+        Gerrit events travel the same way with kind 'event', nobody
+        waits for those. """
+    def __init__(self, command, kind='command'):
+        self.command = command
+        self.kind = kind
+        self.result = None
+        self.done = threading.Event()
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """ One JSON command per connection, JSON result sent back """
+    def handle(self):
+        try:
+            data = self.rfile.readline()
+            command = json.loads(data.decode('utf-8', errors='replace'))
+        except ValueError:
+            result = {'status':'error', 'message':'Malformed command'}
+        else:
+            if not isinstance(command, dict) or not command:
+                result = {'status':'error', 'message':'Command must be a json object'}
+            else:
+                result = self.server.intake.submit(command)
+        try:
+            self.wfile.write((json.dumps(result) + "\n").encode('utf-8'))
+        except OSError:
+            pass # Client went away, nothing to tell
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class CommandIntake(object):
+    """ Watch command/branch directories and an optional unix socket.
+        Directory changes are noticed by the directory mtime so checking
+        is just a stat per directory, socket commands are queued and
+        handed to the reviewer thread in arrival order. """
+    def __init__(self, watchdirs, socketpath=None, timeout=600):
+        self.watchdirs = watchdirs
+        self.dirstamps = {}
+        self.requests = queue.Queue()
+        self.timeout = timeout
+        self.logger = logging.getLogger("CommandIntake")
+        self.server = None
+        if socketpath:
+            self.start_server(socketpath)
+
+    def start_server(self, socketpath):
+        try:
+            os.unlink(socketpath)
+        except OSError:
+            pass
+        oldmask = os.umask(0o077)
+        try:
+            self.server = ControlServer(socketpath, ControlHandler)
+        finally:
+            os.umask(oldmask)
+        self.server.intake = self
+        thread = threading.Thread(target=self.server.serve_forever, args=())
+        thread.daemon = True
+        thread.start()
+        self.logger.info("Listening for commands on " + socketpath)
+
+    def submit(self, command):
+        """ Called from socket threads, blocks until command is executed """
+        request = CommandRequest(command)
+        self.requests.put(request)
+        if not request.done.wait(self.timeout):
+            return {'status':'error', 'message':'Timed out waiting for command to run'}
+        return request.result
+
+    def add_event(self, event):
+        """ Called from event source threads, does not wait """
+        self.requests.put(CommandRequest(event, kind='event'))
+
+    def dirs_changed(self):
+        """ True if any watched directory changed since the last call """
+        changed = False
+        for path in self.watchdirs:
+            try:
+                st = os.stat(path)
+                stamp = (st.st_mtime_ns, st.st_ino)
+            except OSError:
+                stamp = None
+            if self.dirstamps.get(path) != stamp:
+                self.dirstamps[path] = stamp
+                changed = True
+        return changed
+
+    def wait(self, timeout):
+        """ Wait up to timeout seconds for socket commands, return
+            all currently queued requests in order """
+        pending = []
+        try:
+            pending.append(self.requests.get(timeout=timeout))
+        except queue.Empty:
+            return pending
+        while True:
+            try:
+                pending.append(self.requests.get_nowait())
+            except queue.Empty:
+                return pending
+
+def send_command(socketpath, command, timeout=600):
+    """ Client side helper: send command, return result dict """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socketpath)
+        sock.sendall((json.dumps(command) + "\n").encode('utf-8'))
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    return json.loads(data.decode('utf-8'))
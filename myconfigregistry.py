@@ -0,0 +1,125 @@
+""" Shared registry of parsed json config files that are reloaded on change
+"""
+import os
+import json
+import threading
+import logging
+
+class ConfigRegistry(object):
+    """ Loads every json file once and keeps the parsed object around.
+        A file is only reparsed when its stat signature (mtime, size, inode)
+        changes. New objects are swapped in as a whole, so readers either
+        see the old or the new version, never a partial one.
+        Objects handed out are shared, callers must not modify them. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {} # path -> (signature, object, version)
+        self.derived = {} # name -> (versions, object)
+        self.validators = {}
+        self.logger = logging.getLogger("ConfigRegistry")
+
+    def set_validator(self, path, validator):
+        """ validator(obj) should raise ValueError for unacceptable content """
+        self.validators[path] = validator
+
+    def _signature(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _refresh(self, path):
+        """ Returns (signature, object, version) for path, reloading if needed """
+        signature = self._signature(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == signature:
+            return entry
+
+        if entry is not None:
+            version = entry[2]
+        else:
+            version = 0
+
+        obj = None
+        if signature is not None:
+            try:
+                with open(path, "r") as cfgfile:
+                    obj = json.load(cfgfile)
+                validator = self.validators.get(path)
+                if validator:
+                    validator(obj)
+            except (OSError, ValueError) as e:
+                self.logger.error("Cannot load config file " + path + ": " + str(e))
+                if entry is not None and entry[1] is not None:
+                    # Keep the last good version around, but remember the
+                    # signature so we don't try to reparse it every time
+                    entry = (signature, entry[1], entry[2])
+                    self.entries[path] = entry
+                    return entry
+                obj = None
+
+        entry = (signature, obj, version + 1)
+        self.entries[path] = entry
+        return entry
+
+    def get(self, path, default=None):
+        """ Return parsed contents of path or default if it cannot be loaded """
+        with self.lock:
+            obj = self._refresh(path)[1]
+        if obj is None:
+            return default
+        return obj
+
+    def version(self, path):
+        """ Number that changes every time path is reloaded """
+        with self.lock:
+            return self._refresh(path)[2]
+
+    def get_derived(self, name, paths, factory):
+        """ Return factory(*objects) for the given config paths, only calling
+            factory again once any of the underlying files was reloaded. """
+        with self.lock:
+            entries = [self._refresh(path) for path in paths]
+            versions = tuple(entry[2] for entry in entries)
+            cached = self.derived.get(name)
+            if cached is not None and cached[0] == versions:
+                return cached[1]
+        # Build outside of the lock, it might be slow.
+        obj = factory(*[entry[1] for entry in entries])
+        with self.lock:
+            self.derived[name] = (versions, obj)
+        return obj
+
+def validate_pattern_list(obj):
+    if not isinstance(obj, list) or not all(isinstance(x, str) for x in obj):
+        raise ValueError("expected a list of strings")
+
+def validate_test_list(obj):
+    if not isinstance(obj, list):
+        raise ValueError("expected a list of tests")
+    for item in obj:
+        if not isinstance(item, dict) or 'test' not in item or 'timeout' not in item:
+            raise ValueError("test entry without test or timeout: " + str(item))
+
+def validate_dict_list(obj):
+    if not isinstance(obj, list) or not all(isinstance(x, dict) for x in obj):
+        raise ValueError("expected a list of dictionaries")
+
+def validate_dict(obj):
+    if not isinstance(obj, dict):
+        raise ValueError("expected a dictionary")
+
+registry = ConfigRegistry()
+
+for _path in ("filelists/ignore.json", "filelists/buildonly.json",
+              "filelists/ldiskfs.json", "filelists/zfs.json",
+              "filelists/lnet.json"):
+    registry.set_validator(_path, validate_pattern_list)
+for _path in ("tests/initial.json", "tests/comprehensive.json",
+              "tests/lnet.json", "tests/zfs.json", "tests/ldiskfs.json"):
+    registry.set_validator(_path, validate_test_list)
+for _path in ("distrolist.json", "console_errors_lookup.json",
+              "suite_errors_lookup.json"):
+    registry.set_validator(_path, validate_dict_list)
+registry.set_validator("crash_processor.json", validate_dict)
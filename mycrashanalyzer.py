@@ -6,12 +6,12 @@ import time
 import threading
 import queue
 import shlex
-import json
 import re
 import psycopg2
 from pprint import pprint
 import subprocess
 from subprocess import Popen, PIPE, TimeoutExpired
+from myconfigregistry import registry
 
 ### Important - we need transform_null_equals = on in postgresql.conf or =null logic breaks
 
@@ -396,10 +396,8 @@ class Crasher(object):
                 self.logger("Got crash job, but no ResultsDir set?")
                 return True
 
-            try:
-                with open("crash_processor.json", "r") as blah:
-                    crashprocessorinfo = json.load(blah)
-            except OSError: # no file?
+            crashprocessorinfo = registry.get("crash_processor.json")
+            if crashprocessorinfo is None: # no file?
                 return False
 
             command = "%s %s %s %s %s" % (crashprocessorinfo['command'], workitem.artifactsdir, crashfilename, distro, arch)
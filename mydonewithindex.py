@@ -0,0 +1,104 @@
+""" Summary index of finished work items kept in the donewith/ archive
+"""
+import os
+import sqlite3
+import threading
+import logging
+from GerritWorkItem import GerritWorkItem
+
+class DoneIndex(object):
+    """ sqlite table with one small row per archived work item so the
+        status page and retest lookups never need to unpickle the archive.
+        Full items are loaded from their recorded location on demand. """
+    def __init__(self, dbpath, donewithdir):
+        self.donewithdir = donewithdir
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger("DoneIndex")
+        self.conn = sqlite3.connect(dbpath, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS done (buildnr INTEGER NOT NULL, retest INTEGER NOT NULL, changenr TEXT, revision TEXT, subject TEXT, status TEXT, artifactsdir TEXT, resultsfile TEXT, location TEXT, PRIMARY KEY (buildnr, retest))")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(done)")]
+            if 'tree' not in columns:
+                self.conn.execute("ALTER TABLE done ADD COLUMN tree TEXT")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS done_tree ON done(tree)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS done_change ON done(changenr)")
+            self.conn.commit()
+            scanned = self.conn.execute("SELECT value FROM meta WHERE key = 'scanned'").fetchone()
+        if scanned is None:
+            self.scan_archive()
+
+    def scan_archive(self):
+        """ One time import of everything already in the donewith dir """
+        count = 0
+        for name in os.listdir(self.donewithdir):
+            if not name.endswith(".pickle"):
+                continue
+            try:
+                workitem = GerritWorkItem.load(self.donewithdir, name)
+            except:
+                continue # ignore bad items
+            if not workitem.buildnr:
+                continue
+            self.add(workitem, Commit=False)
+            count += 1
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('scanned', '1')")
+            self.conn.commit()
+        self.logger.info("Indexed %d archived work items", count)
+
+    def add(self, workitem, Commit=True):
+        if workitem.change.get('subject'):
+            subject = workitem.change['subject']
+        else:
+            subject = workitem.change.get('id', '')
+        try:
+            status = workitem.get_current_text_status()
+        except:
+            status = "Too old to know state"
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO done(buildnr, retest, changenr, revision, subject, status, artifactsdir, resultsfile, location, tree) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                              (workitem.buildnr, workitem.retestiteration,
+                               str(workitem.changenr), workitem.revision,
+                               subject, status, workitem.artifactsdir,
+                               workitem.get_results_filename(),
+                               workitem.get_saved_name(),
+                               workitem.change.get('tree')))
+            if Commit:
+                self.conn.commit()
+
+    def recent(self, count):
+        """ Newest count entries, oldest first """
+        with self.lock:
+            rows = self.conn.execute("SELECT buildnr, retest, subject, status, artifactsdir, resultsfile FROM done ORDER BY buildnr DESC, retest DESC LIMIT ?", (count,)).fetchall()
+        rows.reverse()
+        return rows
+
+    def next_retest(self, buildnr):
+        """ Next free retest iteration for buildnr """
+        with self.lock:
+            row = self.conn.execute("SELECT MAX(retest) FROM done WHERE buildnr = ?", (buildnr,)).fetchone()
+        if row is None or row[0] is None:
+            return 0
+        return row[0] + 1
+
+    def find_tree(self, tree, count=5):
+        """ [(buildnr, retest, revision), ...] of the newest items built
+            from tree """
+        with self.lock:
+            return self.conn.execute("SELECT buildnr, retest, revision FROM done WHERE tree = ? ORDER BY buildnr DESC, retest DESC LIMIT ?", (tree, count)).fetchall()
+
+    def find_change(self, changenr, count=5):
+        """ [(buildnr, retest, revision), ...] newest items of a change """
+        with self.lock:
+            return self.conn.execute("SELECT buildnr, retest, revision FROM done WHERE changenr = ? ORDER BY buildnr DESC, retest DESC LIMIT ?", (str(changenr), count)).fetchall()
+
+    def load(self, buildnr, retest=0):
+        """ Load the full archived work item or None """
+        with self.lock:
+            row = self.conn.execute("SELECT location FROM done WHERE buildnr = ? AND retest = ?", (buildnr, retest)).fetchone()
+        if row is None:
+            return None
+        return GerritWorkItem.load(self.donewithdir, row[0])
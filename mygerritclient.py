@@ -0,0 +1,124 @@
+""" Gerrit REST client with keep-alive sessions, paginated change
+    queries and a small cache for single change lookups
+"""
+import copy
+import json
+import time
+import threading
+import logging
+import requests
+
+class GerritClient(object):
+    """ One requests.Session per thread (sessions are not thread safe,
+        but the reviewer and manager threads both talk to gerrit), so
+        connections and TLS sessions get reused between calls. """
+    def __init__(self, host, auth, timeout=60, poolsize=4, cachettl=60):
+        self.host = host
+        self.auth = auth
+        self.timeout = timeout
+        self.poolsize = poolsize
+        self.cachettl = cachettl
+        self.cache = {}
+        self.cachelock = threading.Lock()
+        self.local = threading.local()
+        self.logger = logging.getLogger("GerritClient")
+
+    def _session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.auth = self.auth
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=self.poolsize,
+                                                    max_retries=2)
+            session.mount('https://', adapter)
+            self.local.session = session
+        return session
+
+    def url(self, path):
+        return 'https://' + self.host + '/a' + path
+
+    def get(self, path):
+        """ GET path, returns Response or None """
+        url = self.url(path)
+        try:
+            res = self._session().get(url, timeout=self.timeout)
+        except Exception as exc:
+            self.logger.error("cannot GET '%s': exception = %s", url, str(exc))
+            self.local.session = None # Start afresh next time
+            return None
+
+        if res.status_code != requests.codes.ok:
+            self.logger.error("cannot GET '%s': reason = %s, status_code = %d",
+                              url, res.reason, res.status_code)
+            return None
+
+        return res
+
+    def post(self, path, obj):
+        """ POST json(obj) to path, returns True on success """
+        url = self.url(path)
+        try:
+            res = self._session().post(url, data=json.dumps(obj),
+                                       headers={'Content-Type': 'application/json'},
+                                       timeout=self.timeout)
+        except Exception as exc:
+            self.logger.error("cannot POST '%s': exception = %s", url, str(exc))
+            self.local.session = None
+            return False
+
+        if res.status_code != requests.codes.ok:
+            self.logger.error("cannot POST '%s': reason = %s, status_code = %d",
+                              url, res.reason, res.status_code)
+            return False
+
+        return True
+
+    def get_json(self, path):
+        """ GET and decode, None on any error """
+        res = self.get(path)
+        if not res:
+            return None
+        try:
+            # Gerrit uses ")]}'" to guard against XSSI.
+            return json.loads(res.content[5:])
+        except ValueError:
+            self.logger.error("Cannot decode response for '%s'", path)
+            return None
+
+    def query_changes(self, path, maxpages=100):
+        """ GET all pages of a /changes/ query, path already has ?q=
+            Returns None if any page failed or there were more than
+            maxpages, a partial list is no good to poll with. """
+        result = []
+        for page in range(maxpages):
+            if result:
+                pagepath = path + '&S=' + str(len(result))
+            else:
+                pagepath = path
+            changes = self.get_json(pagepath)
+            if changes is None:
+                return None
+            if not changes:
+                return result
+            result.extend(changes)
+            if not changes[-1].get('_more_changes'):
+                return result
+        self.logger.error("'%s' has more than %d pages", path, maxpages)
+        return None
+
+    def query_change_cached(self, path):
+        """ Same as query_changes, but remembers the result for cachettl
+            seconds. For single change lookups that come in bursts. """
+        now = time.time()
+        with self.cachelock:
+            entry = self.cache.get(path)
+            if entry and entry[0] > now:
+                return copy.deepcopy(entry[1])
+        changes = self.query_changes(path)
+        if changes:
+            with self.cachelock:
+                if len(self.cache) > 1000:
+                    self.cache = {k:v for k, v in self.cache.items() if v[0] > now}
+                self.cache[path] = (now + self.cachettl, copy.deepcopy(changes))
+        return changes
@@ -0,0 +1,171 @@
+""" Gerrit change event sources: ssh stream-events, webhook receiver
+    and a local fake that reads event files from a directory
+"""
+import os
+import json
+import time
+import threading
+import subprocess
+import logging
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# Event types we act on, everything else is dropped at the source
+INTERESTING_EVENTS = ('patchset-created', 'change-abandoned', 'comment-added')
+
+class EventSource(threading.Thread):
+    """ Base: feed every interesting event to deliver(event) """
+    def __init__(self, deliver):
+        super(EventSource, self).__init__()
+        self.deliver = deliver
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.daemon = True
+
+    def handle_line(self, line):
+        try:
+            event = json.loads(line)
+        except ValueError:
+            self.logger.warning("Malformed event: " + str(line)[:200])
+            return
+        self.handle_event(event)
+
+    def handle_event(self, event):
+        if not isinstance(event, dict):
+            return
+        if event.get('type') not in INTERESTING_EVENTS:
+            return
+        self.deliver(event)
+
+class SSHEventSource(EventSource):
+    """ gerrit stream-events over ssh, reconnecting with backoff """
+    def __init__(self, deliver, host, user=None, port=29418, keyfile=None):
+        super(SSHEventSource, self).__init__(deliver)
+        self.host = host
+        self.user = user
+        self.port = port
+        self.keyfile = keyfile
+        self.start()
+
+    def command(self):
+        args = ['ssh', '-o', 'BatchMode=yes', '-o', 'ServerAliveInterval=30',
+                '-p', str(self.port)]
+        if self.keyfile:
+            args += ['-i', self.keyfile]
+        if self.user:
+            args.append(self.user + "@" + self.host)
+        else:
+            args.append(self.host)
+        args += ['gerrit', 'stream-events']
+        for eventtype in INTERESTING_EVENTS:
+            args += ['-s', eventtype]
+        return args
+
+    def run(self):
+        backoff = 1
+        while True:
+            started = time.time()
+            try:
+                proc = subprocess.Popen(self.command(), stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+            except OSError as e:
+                self.logger.error("Cannot start ssh: " + str(e))
+            else:
+                self.logger.info("Connected to " + self.host + " event stream")
+                for line in proc.stdout:
+                    self.handle_line(line.decode('utf-8', errors='replace'))
+                proc.wait()
+                self.logger.warning("Event stream ended with status " + str(proc.returncode))
+            # Stream that ran for a while resets the backoff
+            if time.time() - started > 60:
+                backoff = 1
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 300)
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = 0
+        data = self.rfile.read(length)
+        try:
+            event = json.loads(data.decode('utf-8', errors='replace'))
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+        self.server.source.handle_event(event)
+        self.send_response(202)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass # too noisy
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class WebhookEventSource(EventSource):
+    """ Receive events POSTed by the gerrit webhooks plugin """
+    def __init__(self, deliver, port, bind='127.0.0.1'):
+        super(WebhookEventSource, self).__init__(deliver)
+        self.server = WebhookServer((bind, port), WebhookHandler)
+        self.server.source = self
+        self.start()
+
+    def run(self):
+        self.server.serve_forever()
+
+class FakeEventSource(EventSource):
+    """ Local stand in for gerrit: every *.json file dropped into
+        directory is an event (or a list of events), taken in name order.
+        Events may carry a 'changeinfo' with the REST ChangeInfo to use
+        so no gerrit server is needed at all. """
+    def __init__(self, deliver, directory, interval=0.2):
+        super(FakeEventSource, self).__init__(deliver)
+        self.directory = directory
+        self.interval = interval
+        self.start()
+
+    def run(self):
+        while True:
+            try:
+                names = sorted(os.listdir(self.directory))
+            except OSError:
+                names = []
+            for name in names:
+                if not name.endswith(".json"):
+                    continue # also skips files still being written as .tmp
+                path = self.directory + "/" + name
+                try:
+                    with open(path, "r") as eventfile:
+                        events = json.load(eventfile)
+                except (OSError, ValueError) as e:
+                    self.logger.warning("Bad event file " + name + ": " + str(e))
+                    events = []
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                if not isinstance(events, list):
+                    events = [events]
+                for event in events:
+                    self.handle_event(event)
+            time.sleep(self.interval)
+
+def make_event_source(kind, deliver, host):
+    """ Event source from GERRIT_EVENT_SOURCE style setting or None """
+    if not kind:
+        return None
+    if kind == "ssh":
+        return SSHEventSource(deliver, host,
+                              user=os.getenv('GERRIT_SSH_USER', None),
+                              port=int(os.getenv('GERRIT_SSH_PORT', '29418')),
+                              keyfile=os.getenv('GERRIT_SSH_KEY', None))
+    if kind == "webhook":
+        return WebhookEventSource(deliver,
+                                  int(os.getenv('GERRIT_WEBHOOK_PORT', '8025')),
+                                  bind=os.getenv('GERRIT_WEBHOOK_BIND', '127.0.0.1'))
+    if kind == "fake":
+        return FakeEventSource(deliver, os.getenv('GERRIT_FAKE_EVENTS_DIR', "./fake-events/"))
+    raise ValueError("Unknown event source " + kind)
@@ -0,0 +1,83 @@
+""" Process output that does not have to fit in memory
+"""
+import io
+import logging
+from mystreammatcher import StreamMatcher
+
+# How much of the most recent output is kept in memory
+TAILSIZE = 256 * 1024
+
+class OutputBuffer(object):
+    """ Collects the output of a process that might run for hours.
+        Everything goes to filename as it arrives, only the last tailsize
+        characters stay in memory. Strings in watchfor are matched over
+        the whole output, 'in' only sees the tail for anything else.
+        str() is the tail. Without a filename only the tail is kept. """
+    def __init__(self, filename=None, tailsize=TAILSIZE, watchfor=()):
+        self.filename = filename
+        self.tailsize = tailsize
+        self.chunks = []
+        self.chunkslen = 0
+        self.size = 0
+        self.fd = None
+        self.closed = False
+        self.matcher = StreamMatcher(watchfor)
+
+    def write(self, data):
+        if not data:
+            return
+        self.size += len(data)
+        self.matcher.feed(data)
+        if self.filename and not self.closed:
+            try:
+                if self.fd is None:
+                    self.fd = io.open(self.filename, "w", encoding="utf-8", errors="replace")
+                self.fd.write(data)
+            except OSError as e:
+                logging.getLogger("OutputBuffer").warning("Cannot save output to " + self.filename + ": " + str(e))
+                self.close()
+                self.filename = None
+        self.chunks.append(data)
+        self.chunkslen += len(data)
+        if self.chunkslen > 2 * self.tailsize:
+            self._trim()
+
+    def _trim(self):
+        tail = "".join(self.chunks)[-self.tailsize:]
+        self.chunks = [tail]
+        self.chunkslen = len(tail)
+
+    def tail(self):
+        self._trim()
+        return self.chunks[0] if self.chunks else ""
+
+    def __str__(self):
+        return self.tail()
+
+    def __contains__(self, string):
+        if self.matcher.knows(string):
+            return self.matcher.seen(string)
+        return string in self.tail()
+
+    def __len__(self):
+        return self.size
+
+    def reference(self):
+        """ Name of the file with all of the output, None if there was
+            no output or it could not be saved """
+        if self.fd is None or self.filename is None:
+            return None
+        try:
+            self.fd.flush()
+        except (OSError, ValueError):
+            pass
+        return self.filename
+
+    def close(self):
+        """ Safe to do many times, later output only goes to the tail """
+        self.closed = True
+        if self.fd is not None:
+            try:
+                self.fd.close()
+            except OSError:
+                pass
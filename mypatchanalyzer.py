@@ -0,0 +1,303 @@
+""" Patch analysis from a local bare git mirror with a pool of workers
+"""
+import os
+import tempfile
+import threading
+import subprocess
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+SHELL_TEST_HELPERS = ('runtests', 'auster', 'rundbench', 'runiozone',
+                      'runmultiop_bg_pause', 'runvmstat', 'runobdstat')
+
+def parse_patch(patch):
+    """ Extract useful info from a patch. Things like new tests added,
+        tests modified, is it a comment-only change and so on.
+        Returns (updated_tests, commentonly) """
+    updated_tests = {}
+    chfile = None
+    basename = ""
+    function = None
+    commentonly = True
+    newtests = []
+    for line in patch.splitlines():
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="replace")
+        if line.startswith('+++ '):
+            if newtests:
+                if basename.endswith('.sh'):
+                    updated_tests.update({basename.replace('.sh', ''):newtests})
+                newtests = []
+            chfile = line.replace('+++ b/', '')
+            basename = os.path.basename(chfile)
+        if not chfile: # diff did not start yet - skip
+            continue
+        if line.startswith('--- '): # src file - skip
+            continue
+        if line.startswith('@@ '):
+            tags = line.split(' ', 5)
+            if len(tags) < 4 or tags[0] != '@@' or tags[3] != '@@':
+                print("Malformed patch line: " + line)
+                continue
+            if len(tags) > 4:
+                function = tags[4].replace('()', '')
+                if function.endswith("{"):
+                    function = function[:-1]
+            else:
+                function = None
+        if line.startswith(' '): # context line, not a change - skip
+            if basename.endswith(".sh") and line.startswith(' test_'): # context changed to new function, record it.
+                tags = line[1:].split(' ')
+                function = tags[0].replace('()', '')
+                if function.endswith("{"):
+                    function = function[:-1]
+            continue
+        if line.startswith('-') or line.startswith('+'): # added/removed/changed line
+            tmp = line.replace(' ', '').replace('\t', '') # remove spaces
+            if not line[1:]: # empty line? skip
+                continue
+            if "ldiskfs/kernel_patches/" in chfile:
+                commentonly = False
+            if (basename.endswith('.c') or basename.endswith('.h')) \
+                and not (tmp[1:].startswith('/*') or tmp[1:].startswith('//') or \
+               tmp[1:].startswith('*')):
+                commentonly = False
+            if (basename.endswith('.sh') or basename.endswith('.pl') or
+                basename.endswith('.py') or basename in SHELL_TEST_HELPERS) \
+               and not tmp[1:].startswith('#'):
+                commentonly = False
+            if line[1:].startswith('test_'):
+                function = None # Added or removed function, we'll catch with the +run_test
+            if function and function not in newtests:
+                if basename.endswith('.sh') and function.startswith("test_"):
+                    newtests.append(function)
+                function = None # To ease our work
+
+        if line.startswith('+'): # Added/changed line
+            if basename.endswith('.sh'):
+                # Try to detect a new test added.
+                # while we can try and detect new function added, instead
+                # in our framework there's a very specific pattern:
+                # +run_test 65 "Check lfs quota result"
+                # So let's match for that instead
+                if line.startswith("+run_test "):
+                    tags = line.split(" ")
+                    if len(tags) > 1:
+                        test = "test_" + tags[1]
+                        newtests.append(test)
+
+    # Catch remaining stuff
+    if newtests and basename.endswith('.sh'):
+        updated_tests.update({basename.replace('.sh', ''):newtests})
+    return (updated_tests, commentonly)
+
+class PatchAnalyzer(object):
+    """ Keeps a bare mirror of just the refs we are asked about.
+        Refs are fetched in batches (one git fetch for many refs), then
+        every revision is formatted and parsed in a worker pool.
+        Results are cached by revision. """
+    def __init__(self, mirror, remote, workers=8, batchsize=50, cachesize=10000):
+        self.mirror = mirror
+        self.remote = remote
+        self.batchsize = batchsize
+        self.cachesize = cachesize
+        self.cache = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.fetchlock = threading.Lock() # fetches share FETCH_HEAD
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.logger = logging.getLogger("PatchAnalyzer")
+        self.ensure_mirror()
+
+    def git(self, args, timeout=600, env=None, input=None):
+        """ Run git in the mirror, returns (returncode, stdout) """
+        if input is None:
+            stdin = {'stdin':subprocess.DEVNULL}
+        else:
+            stdin = {'input':input}
+        try:
+            proc = subprocess.run(['git', '--git-dir=' + self.mirror] + args,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, timeout=timeout,
+                                  env=env, **stdin)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            self.logger.error("git " + " ".join(args[:2]) + " failed: " + str(e))
+            return (-1, b"")
+        if proc.returncode:
+            self.logger.debug("git %s: %s", " ".join(args[:2]), proc.stderr.decode('utf-8', errors='replace').strip())
+        return (proc.returncode, proc.stdout)
+
+    def ensure_mirror(self):
+        if os.path.exists(self.mirror + "/HEAD"):
+            return
+        subprocess.call(['git', 'init', '--bare', '-q', self.mirror])
+
+    def have_commit(self, revision):
+        return self.git(['cat-file', '-e', revision + '^{commit}'])[0] == 0
+
+    def fetch_refs(self, refs):
+        """ Fetch all refs into the same names locally, in batches.
+            A batch with a bad ref is retried one ref at a time. """
+        refspecs = ['+' + ref + ':' + ref for ref in refs]
+        with self.fetchlock:
+            for i in range(0, len(refspecs), self.batchsize):
+                batch = refspecs[i:i + self.batchsize]
+                if self.git(['fetch', '-q', '--no-tags', self.remote] + batch)[0] == 0:
+                    continue
+                if len(batch) == 1:
+                    continue
+                for refspec in batch:
+                    self.git(['fetch', '-q', '--no-tags', self.remote, refspec])
+
+    def resolve(self, name):
+        """ Full hash for a hash, tag or branch name or None. Full hashes
+            we have already do not go to the server. """
+        if len(name) == 40 and all(x in "0123456789abcdef" for x in name.lower()):
+            rc, out = self.git(['rev-parse', '--verify', '-q', name + '^{commit}'])
+            if rc == 0:
+                return out.decode('utf-8').strip()
+        with self.fetchlock:
+            if self.git(['fetch', '-q', '--no-tags', self.remote, name])[0] == 0:
+                rc, out = self.git(['rev-parse', '--verify', '-q', 'FETCH_HEAD^{commit}'])
+                if rc == 0:
+                    return out.decode('utf-8').strip()
+        # Plain hash the server would not give us by name, maybe we have it
+        rc, out = self.git(['rev-parse', '--verify', '-q', name + '^{commit}'])
+        if rc == 0:
+            return out.decode('utf-8').strip()
+        return None
+
+    def tree(self, change):
+        """ Tree hash of the current revision of change or None """
+        revision = change.get('current_revision')
+        if not revision or change.get('branchwide'):
+            return None
+        if not self.have_commit(revision):
+            try:
+                self.fetch_refs([change['revisions'][revision]['ref']])
+            except KeyError:
+                return None
+        rc, out = self.git(['rev-parse', '--verify', '-q', revision + '^{tree}'])
+        if rc != 0:
+            return None
+        return out.decode('utf-8').strip()
+
+    def combine(self, branch, changes, message):
+        """ Apply the current revisions of changes one by one on top of
+            the tip of branch and commit the result. Changes that do not
+            apply or sit on top of something not yet on branch are left
+            out. Returns (commit, [changes applied]) or (None, []) """
+        missing = []
+        for change in changes:
+            revision = change['current_revision']
+            if not self.have_commit(revision):
+                missing.append(change['revisions'][revision]['ref'])
+        if missing:
+            self.fetch_refs(missing)
+        base = self.resolve(branch)
+        if not base:
+            return (None, [])
+
+        applied = []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            env = dict(os.environ, GIT_INDEX_FILE=tmpdir + "/index")
+            env.setdefault('GIT_AUTHOR_NAME', 'Batch Tester')
+            env.setdefault('GIT_AUTHOR_EMAIL', 'tester@localhost')
+            env.setdefault('GIT_COMMITTER_NAME', env['GIT_AUTHOR_NAME'])
+            env.setdefault('GIT_COMMITTER_EMAIL', env['GIT_AUTHOR_EMAIL'])
+            if self.git(['read-tree', base], env=env)[0] != 0:
+                return (None, [])
+            for change in changes:
+                revision = change['current_revision']
+                # Without its parent this is not the tree it is in
+                if self.git(['merge-base', '--is-ancestor', revision + '^', base])[0] != 0:
+                    continue
+                rc, diff = self.git(['diff', '--binary', revision + '^', revision])
+                if rc != 0 or not diff:
+                    continue
+                if self.git(['apply', '--cached', '-'], env=env, input=diff)[0] == 0:
+                    applied.append(change)
+            if not applied:
+                return (None, [])
+            rc, tree = self.git(['write-tree'], env=env)
+            if rc != 0:
+                return (None, [])
+            rc, commit = self.git(['commit-tree', tree.decode('utf-8').strip(),
+                                   '-p', base, '-m', message], env=env)
+            if rc != 0:
+                return (None, [])
+        return (commit.decode('utf-8').strip(), applied)
+
+    def publish(self, commit, repo, ref):
+        """ Push commit as ref into repo (a path), None commit deletes ref """
+        if commit is None:
+            refspec = ':' + ref
+        else:
+            refspec = '+' + commit + ':' + ref
+        return self.git(['push', '-q', repo, refspec])[0] == 0
+
+    def _analyze(self, revision):
+        rc, patch = self.git(['format-patch', '-1', '-n', '--stdout',
+                              '--no-signature', revision])
+        if rc != 0 or not patch:
+            result = None
+        else:
+            result = parse_patch(patch)
+        with self.lock:
+            del self.pending[revision]
+            if result is not None:
+                if len(self.cache) >= self.cachesize:
+                    self.cache.clear()
+                self.cache[revision] = result
+        return result
+
+    def submit(self, changes):
+        """ Start analysis of the current revision of all changes,
+            fetching whatever refs are missing in one go """
+        wanted = {}
+        for change in changes:
+            revision = change.get('current_revision')
+            if not revision or change.get('branchwide'):
+                continue
+            try:
+                wanted[revision] = change['revisions'][revision]['ref']
+            except KeyError:
+                continue
+        with self.lock:
+            for revision in list(wanted):
+                if revision in self.cache or revision in self.pending:
+                    del wanted[revision]
+        if not wanted:
+            return
+
+        missing = [wanted[revision] for revision in wanted if not self.have_commit(revision)]
+        if missing:
+            self.fetch_refs(missing)
+
+        with self.lock:
+            for revision in wanted:
+                if revision in self.cache or revision in self.pending:
+                    continue
+                self.pending[revision] = self.pool.submit(self._analyze, revision)
+
+    def analyze(self, change):
+        """ (updated_tests, commentonly) for the current revision of
+            change, None if the patch cannot be had """
+        revision = change.get('current_revision')
+        if not revision:
+            return None
+        with self.lock:
+            result = self.cache.get(revision)
+            future = self.pending.get(revision)
+        if result is not None:
+            return result
+        if future is None:
+            self.submit([change])
+            with self.lock:
+                result = self.cache.get(revision)
+                future = self.pending.get(revision)
+            if result is not None:
+                return result
+            if future is None:
+                return None
+        return future.result()
@@ -0,0 +1,44 @@
+""" Classify changed files into all of their filelist categories at once
+"""
+import fnmatch
+import re
+import threading
+
+class PathClassifier(object):
+    """ Compile a number of named fnmatch pattern lists into a single regex.
+        Every category becomes an optional lookahead with a named group,
+        so one match call tells us all the categories a path belongs to.
+        Results are memoized per path. """
+    def __init__(self, categories, cachesize=100000):
+        """ categories is a list of (name, [pattern, ...]) """
+        self.names = []
+        parts = []
+        for idx, (name, patterns) in enumerate(categories):
+            self.names.append(name)
+            if not patterns:
+                continue
+            translated = "|".join(fnmatch.translate(pattern) for pattern in patterns)
+            parts.append("(?:(?=(?P<c%d>%s)))?" % (idx, translated))
+        self.regex = re.compile("".join(parts), re.DOTALL)
+        self.groups = [("c%d" % (idx), name) for idx, name in enumerate(self.names) if categories[idx][1]]
+        self.cache = {}
+        self.cachesize = cachesize
+        self.lock = threading.Lock()
+
+    def classify(self, path):
+        """ Return frozenset of category names path belongs to """
+        result = self.cache.get(path)
+        if result is not None:
+            return result
+
+        match = self.regex.match(path)
+        result = frozenset(name for group, name in self.groups if match.group(group) is not None)
+
+        with self.lock:
+            if len(self.cache) >= self.cachesize:
+                self.cache.clear()
+            self.cache[path] = result
+        return result
+
+    def matches(self, path, name):
+        return name in self.classify(path)
@@ -0,0 +1,108 @@
+""" Persistent record of what change revisions were already reviewed
+"""
+import os
+import sqlite3
+import threading
+import logging
+
+class ReviewHistory(object):
+    """ sqlite (WAL mode) backed review history keyed by change_id+revision.
+        Lookups go to the db index so nothing is loaded into memory upfront.
+        Poll timestamps are kept as a single row instead of an ever growing
+        list of markers. """
+    def __init__(self, dbpath, legacypath=None, persistent=True, checkpoint_every=100):
+        self.dbpath = dbpath
+        self.legacypath = legacypath
+        self.persistent = persistent
+        self.checkpoint_every = checkpoint_every
+        self.markers = 0
+        self.overlay = {} # for non-persistent mode
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger("ReviewHistory")
+        self.conn = sqlite3.connect(dbpath, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS reviews (change_id TEXT NOT NULL, revision TEXT NOT NULL, score INTEGER, epoch INTEGER, PRIMARY KEY (change_id, revision)) WITHOUT ROWID")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.conn.commit()
+        if legacypath:
+            self.import_legacy(legacypath)
+
+    def _get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)", (key, str(value)))
+
+    def import_legacy(self, path):
+        """ One time import of the old text REVIEW_HISTORY file """
+        with self.lock:
+            if self._get_meta("legacy-imported"):
+                return
+            if not os.path.exists(path):
+                self._set_meta("legacy-imported", "none")
+                self.conn.commit()
+                return
+
+            timestamp = 0
+            rows = []
+            with open(path) as history_file:
+                for line in history_file:
+                    try:
+                        epoch, change_id, revision, score = line.split()
+                        epoch = int(float(epoch))
+                    except ValueError:
+                        continue # torn line from a crash
+                    if change_id == '-':
+                        timestamp = epoch
+                    else:
+                        rows.append((change_id, revision, score, epoch))
+
+            self.conn.executemany("INSERT OR REPLACE INTO reviews(change_id, revision, score, epoch) VALUES (?, ?, ?, ?)", rows)
+            if timestamp > int(self._get_meta("timestamp") or 0):
+                self._set_meta("timestamp", timestamp)
+            self._set_meta("legacy-imported", path)
+            self.conn.commit()
+        self.logger.info("Imported %d review history entries from %s", len(rows), path)
+
+    def add(self, change_id, revision, score, epoch):
+        if not self.persistent:
+            self.overlay[change_id + ' ' + revision] = score
+            return
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO reviews(change_id, revision, score, epoch) VALUES (?, ?, ?, ?)", (change_id, revision, score, epoch))
+            self.conn.commit()
+
+    def contains(self, change_id, revision):
+        if change_id + ' ' + revision in self.overlay:
+            return True
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM reviews WHERE change_id = ? AND revision = ?", (change_id, revision)).fetchone()
+        return row is not None
+
+    def get_timestamp(self):
+        with self.lock:
+            return int(self._get_meta("timestamp") or 0)
+
+    def set_timestamp(self, epoch):
+        """ Record the poll marker, periodically checkpointing the WAL """
+        if not self.persistent:
+            return
+        with self.lock:
+            self._set_meta("timestamp", epoch)
+            self.conn.commit()
+            self.markers += 1
+            if self.markers >= self.checkpoint_every:
+                self.markers = 0
+                try:
+                    self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                except sqlite3.Error as e:
+                    self.logger.warning("WAL checkpoint failed: " + str(e))
+
+    def size(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM reviews").fetchone()[0] + len(self.overlay)
@@ -0,0 +1,178 @@
+""" Recorded test run times used to estimate how long things would take
+"""
+import math
+import heapq
+import sqlite3
+import threading
+import logging
+
+class RuntimeHistory(object):
+    """ Exponentially weighted moving average of test durations keyed by
+        (test name, fstype, DNE, distro). Everything is kept in memory
+        for lookups, sqlite is only there to survive restarts. """
+    def __init__(self, dbpath, alpha=0.3, default=3600):
+        self.alpha = alpha
+        self.default = default
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger("RuntimeHistory")
+        self.conn = sqlite3.connect(dbpath, check_same_thread=False)
+        self.tests = {}
+        self.bytest = {} # name -> [ewma, samples] over all configurations
+        self.subtests = {} # (test, fstype) -> {subtest: [ewma, samples]}
+        self.builds = {} # distro -> [ewma, samples]
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS tests (name TEXT NOT NULL, fstype TEXT NOT NULL, dne INTEGER NOT NULL, distro TEXT NOT NULL, ewma REAL, samples INTEGER, PRIMARY KEY (name, fstype, dne, distro))")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS subtests (test TEXT NOT NULL, fstype TEXT NOT NULL, subtest TEXT NOT NULL, ewma REAL, samples INTEGER, PRIMARY KEY (test, fstype, subtest))")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS builds (distro TEXT PRIMARY KEY, ewma REAL, samples INTEGER)")
+            self.conn.commit()
+            for name, fstype, dne, distro, ewma, samples in self.conn.execute("SELECT name, fstype, dne, distro, ewma, samples FROM tests"):
+                self.tests[(name, fstype, dne, distro)] = [ewma, samples]
+                self._add_bytest(name, ewma, samples)
+            for test, fstype, subtest, ewma, samples in self.conn.execute("SELECT test, fstype, subtest, ewma, samples FROM subtests"):
+                self.subtests.setdefault((test, fstype), {})[subtest] = [ewma, samples]
+            for distro, ewma, samples in self.conn.execute("SELECT distro, ewma, samples FROM builds"):
+                self.builds[distro] = [ewma, samples]
+
+    def _add_bytest(self, name, ewma, samples):
+        entry = self.bytest.get(name)
+        if entry is None:
+            self.bytest[name] = [ewma, samples]
+        else:
+            total = entry[1] + samples
+            entry[0] = (entry[0] * entry[1] + ewma * samples) / total
+            entry[1] = total
+
+    @staticmethod
+    def key(testinfo, distro):
+        return (testinfo.get('name', testinfo['test']), testinfo.get('fstype', ''),
+                int(bool(testinfo.get('DNE'))), distro or '')
+
+    def record_test(self, testinfo, distro, duration):
+        """ Fold in one observed run time (seconds) """
+        key = self.key(testinfo, distro)
+        with self.lock:
+            entry = self.tests.get(key)
+            if entry is None:
+                entry = [float(duration), 1]
+                self.tests[key] = entry
+            else:
+                entry[0] = self.alpha * duration + (1 - self.alpha) * entry[0]
+                entry[1] += 1
+            self._add_bytest(key[0], float(duration), 1)
+            try:
+                self.conn.execute("INSERT OR REPLACE INTO tests(name, fstype, dne, distro, ewma, samples) VALUES (?, ?, ?, ?, ?, ?)", key + tuple(entry))
+                self.conn.commit()
+            except sqlite3.Error as e:
+                self.logger.warning("Cannot record runtime: " + str(e))
+
+    def expected_test(self, testinfo, distro):
+        """ Expected run time in seconds. Falls back to the same test in
+            any configuration, then to the test timeout, then default """
+        key = self.key(testinfo, distro)
+        with self.lock:
+            entry = self.tests.get(key)
+            if entry is None:
+                entry = self.bytest.get(key[0])
+        if entry is not None:
+            return entry[0]
+        timeout = testinfo.get('timeout', -1)
+        if timeout > 0:
+            return timeout / 2
+        return self.default
+
+    def record_subtests(self, test, fstype, durations):
+        """ Fold in [(subtest, seconds), ...] from one run of test script """
+        if not durations:
+            return
+        with self.lock:
+            known = self.subtests.setdefault((test, fstype), {})
+            rows = []
+            for subtest, duration in durations:
+                try:
+                    duration = float(duration)
+                except (TypeError, ValueError):
+                    continue
+                entry = known.get(subtest)
+                if entry is None:
+                    entry = [duration, 1]
+                    known[subtest] = entry
+                else:
+                    entry[0] = self.alpha * duration + (1 - self.alpha) * entry[0]
+                    entry[1] += 1
+                rows.append((test, fstype, subtest, entry[0], entry[1]))
+            try:
+                self.conn.executemany("INSERT OR REPLACE INTO subtests(test, fstype, subtest, ewma, samples) VALUES (?, ?, ?, ?, ?)", rows)
+                self.conn.commit()
+            except sqlite3.Error as e:
+                self.logger.warning("Cannot record subtest runtimes: " + str(e))
+
+    def subtest_durations(self, test, fstype):
+        """ {subtest: expected seconds} for test script, from fstype runs
+            if we have them, otherwise from any fstype """
+        with self.lock:
+            known = self.subtests.get((test, fstype))
+            if known:
+                return {name: entry[0] for name, entry in known.items()}
+            result = {}
+            for (othertest, otherfstype), known in self.subtests.items():
+                if othertest != test:
+                    continue
+                for name, entry in known.items():
+                    result[name] = max(result.get(name, 0), entry[0])
+            return result
+
+    def record_build(self, distro, duration):
+        """ Fold in one successful build time (seconds) for distro """
+        with self.lock:
+            entry = self.builds.get(distro)
+            if entry is None:
+                entry = [float(duration), 1]
+                self.builds[distro] = entry
+            else:
+                entry[0] = self.alpha * duration + (1 - self.alpha) * entry[0]
+                entry[1] += 1
+            try:
+                self.conn.execute("INSERT OR REPLACE INTO builds(distro, ewma, samples) VALUES (?, ?, ?)", (distro, entry[0], entry[1]))
+                self.conn.commit()
+            except sqlite3.Error as e:
+                self.logger.warning("Cannot record build time: " + str(e))
+
+    def expected_build(self, distro, default=600):
+        """ Expected build time in seconds for distro """
+        with self.lock:
+            entry = self.builds.get(distro)
+        if entry is not None:
+            return entry[0]
+        return default
+
+def make_shards(durations, target, maxshards):
+    """ Split {subtest: seconds} into about total/target shards (at most
+        maxshards), each subtest longest first into the least loaded
+        shard. Returns [(expected seconds, [subtests]), ...] or None if
+        it is not worth splitting """
+    total = sum(durations.values())
+    count = min(maxshards, int(math.ceil(total / max(target, 1))))
+    if count < 2 or len(durations) < count:
+        return None
+    bins = [(0.0, idx, []) for idx in range(count)]
+    for name, duration in sorted(durations.items(), key=lambda x: (-x[1], x[0])):
+        load, idx, names = heapq.heappop(bins)
+        names.append(name)
+        heapq.heappush(bins, (load + duration, idx, names))
+    return [(load, names) for load, idx, names in sorted(bins, key=lambda x: x[1])]
+
+def predict_makespan(durations, slots, start=0):
+    """ Finish time of running durations longest first on slots
+        parallel workers that become free at start """
+    if slots < 1:
+        slots = 1
+    heap = [start] * slots
+    finish = start
+    for duration in sorted(durations, reverse=True):
+        free = heapq.heappop(heap)
+        end = free + duration
+        finish = max(finish, end)
+        heapq.heappush(heap, end)
+    return finish
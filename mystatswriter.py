@@ -72,3 +72,45 @@ class StatsWriter:
             }
         ]
         self.influxclient.write_points(json_body)
+
+    def queuewaitstats(self, waits):
+        json_body = []
+        now = int(time.time() * 1000000000)
+        for share, (p50, p90, p99, count) in waits.items():
+            json_body.append(
+                {
+                    "measurement": "queuewait",
+                    "tags": {
+                        "host": os.environ['HOSTNAME'],
+                        "metric": "testerstats",
+                        "share": share
+                    },
+                    "time": now,
+                    "fields": {
+                       "p50" : p50,
+                       "p90" : p90,
+                       "p99" : p99,
+                       "samples" : count,
+                    }
+                })
+        if json_body:
+            self.influxclient.write_points(json_body)
+
+    def cancelstats(self, stats):
+        json_body = [
+            {
+                "measurement": "cancelled",
+                "tags": {
+                    "host": os.environ['HOSTNAME'],
+                    "metric": "testerstats"
+                },
+                "time": int(time.time() * 1000000000),
+                "fields": {
+                   "builds" : stats['builds'],
+                   "tests" : stats['tests'],
+                   "builderseconds" : stats['builder-seconds'],
+                   "nodeseconds" : stats['node-seconds'],
+                }
+            }
+        ]
+        self.influxclient.write_points(json_body)
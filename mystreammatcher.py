@@ -0,0 +1,74 @@
+""" Looking for a fixed set of strings in text that keeps growing, like
+    console logs, without keeping the text itself around
+"""
+import io
+import codecs
+
+# How much of a file match_file reads at a time
+CHUNKSIZE = 1024 * 1024
+
+class StreamMatcher(object):
+    """ Feed text as it arrives, remembers the offset at which every
+        pattern was first seen. Only the last longest-pattern-minus-one
+        characters are kept, so a match split between two feeds is still
+        found. Patterns in repeating are looked for in every feed, the
+        rest only until they first show up.
+        Every pattern is looked for with str.find over the new text only,
+        for the few dozen patterns we have that is faster in CPython than
+        one combined regex or a python level automaton. """
+    def __init__(self, patterns, repeating=()):
+        self.patterns = [x for x in dict.fromkeys(list(patterns) + list(repeating)) if x]
+        self.repeating = set(x for x in repeating if x)
+        self.unseen = [x for x in self.patterns if x not in self.repeating]
+        self.keep = max([len(x) for x in self.patterns] + [1]) - 1
+        self.first = {} # pattern -> offset of its first match
+        self.offset = 0 # characters fed so far
+        self.tail = ""
+
+    def feed(self, text):
+        """ Returns patterns found in text, including matches started
+            in earlier feeds """
+        if not text:
+            return []
+        window = self.tail + text
+        start = self.offset - len(self.tail)
+        found = []
+        for pattern in list(self.repeating) + self.unseen:
+            # Anything ending within the old tail was found last time
+            idx = window.find(pattern, max(0, len(self.tail) - len(pattern) + 1))
+            if idx == -1:
+                continue
+            found.append(pattern)
+            if pattern not in self.first:
+                self.first[pattern] = start + idx
+        if found:
+            self.unseen = [x for x in self.unseen if x not in self.first]
+        self.offset += len(text)
+        if self.keep:
+            self.tail = window[-self.keep:]
+        return found
+
+    def knows(self, pattern):
+        """ pattern is one we look for """
+        return pattern in self.patterns
+
+    def seen(self, pattern):
+        return pattern in self.first
+
+    def first_offset(self, pattern):
+        """ Offset of the first match of pattern or None """
+        return self.first.get(pattern)
+
+def match_file(filename, patterns, encoding="ISO-8859-1", start=0):
+    """ Run filename from byte offset start to the end through a new
+        StreamMatcher for patterns, returns the matcher. Raises OSError. """
+    matcher = StreamMatcher(patterns)
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    with io.open(filename, "rb") as fd:
+        fd.seek(start)
+        while matcher.unseen:
+            data = fd.read(CHUNKSIZE)
+            matcher.feed(decoder.decode(data, not data))
+            if not data:
+                break
+    return matcher
@@ -0,0 +1,252 @@
+""" One event loop thread watching the pipes and console logs of all
+    running test, server and client processes
+"""
+import os
+import time
+import codecs
+import selectors
+import threading
+import logging
+from subprocess import TimeoutExpired
+
+class Stream(object):
+    """ One pipe of a watched process, decoded data goes to sink """
+    def __init__(self, fileobj, watch, sink):
+        self.fileobj = fileobj
+        self.watch = watch
+        self.sink = sink
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.closed = False
+        try:
+            self.fd = fileobj.fileno()
+        except ValueError: # closed already
+            self.fd = None
+            self.closed = True
+
+    def deliver(self, data, final=False):
+        text = self.decoder.decode(data, final)
+        if text:
+            self.sink(text.replace('\r\n', '\n'))
+
+class Watch(object):
+    """ What one tester thread sleeps on. Woken as soon as one of its
+        processes writes something or exits, one of its files grows, or
+        somebody kicks it. """
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self.cond = threading.Condition()
+        self.generation = 0
+        self.seen = 0
+        self.streams = {} # id(process) -> [Stream, ...]
+        self.files = []
+
+    def notify(self):
+        with self.cond:
+            self.generation += 1
+            self.cond.notify_all()
+
+    kick = notify
+
+    def wait(self, timeout=None):
+        """ Sleep until something happened since the last wait or until
+            timeout runs out. Returns True if something happened. """
+        if timeout is not None:
+            deadline = time.time() + max(timeout, 0)
+        with self.cond:
+            while self.generation == self.seen:
+                if timeout is None:
+                    self.cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            changed = self.generation != self.seen
+            self.seen = self.generation
+        return changed
+
+    def add_process(self, process, outsink, errsink):
+        """ Feed stdout and stderr of process to the sinks """
+        streams = []
+        for pipe, sink in ((process.stdout, outsink), (process.stderr, errsink)):
+            if pipe is not None:
+                streams.append(Stream(pipe, self, sink))
+        self.streams[id(process)] = streams
+        self.supervisor.add_streams(streams)
+
+    def add_file(self, path):
+        """ Wake us whenever path grows """
+        self.files.append(path)
+        self.supervisor.add_file(path, self)
+
+    def drained(self, process):
+        """ All output of process was delivered """
+        return all(stream.closed for stream in self.streams.get(id(process), []))
+
+    def wait_exit(self, process, timeout):
+        """ Wait for process to exit and its output to be delivered.
+            Returns False if it did not happen in timeout seconds. """
+        deadline = time.time() + timeout
+        while process.poll() is None and not self.drained(process):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self.wait(remaining)
+        # The output ends right before the exit status shows up
+        try:
+            process.wait(max(deadline - time.time(), 0))
+        except TimeoutExpired:
+            return False
+        # and the other way around
+        deadline = min(deadline, time.time() + 5)
+        while not self.drained(process) and time.time() < deadline:
+            self.wait(deadline - time.time())
+        return True
+
+    def close(self):
+        """ Stop watching everything, output still in flight is dropped """
+        streams = []
+        for item in self.streams.values():
+            streams.extend(item)
+        self.streams = {}
+        self.supervisor.remove_streams(streams)
+        for path in self.files:
+            self.supervisor.remove_file(path, self)
+        self.files = []
+
+class Supervisor(object):
+    """ Single thread multiplexing the output pipes of every test, server
+        and client process of all testers with a selector, so testers
+        block until something happens instead of polling. Console logs
+        are plain files that cannot be selected on, their sizes are
+        checked every fileinterval seconds, all in this same thread. """
+    def __init__(self, fileinterval=1):
+        self.fileinterval = fileinterval
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.pending = [] # (add or remove, Stream), applied by our thread
+        self.files = {} # path -> {id(watch): [watch, last size]}
+        self.logger = logging.getLogger("Supervisor")
+        self.wakeread, self.wakewrite = os.pipe()
+        os.set_blocking(self.wakeread, False)
+        os.set_blocking(self.wakewrite, False)
+        self.selector.register(self.wakeread, selectors.EVENT_READ, None)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def watch(self):
+        return Watch(self)
+
+    def _wakeup(self):
+        try:
+            os.write(self.wakewrite, b'x')
+        except BlockingIOError:
+            pass # it is going to wake up anyway
+
+    def add_streams(self, streams):
+        with self.lock:
+            self.pending.extend(('add', stream) for stream in streams)
+        self._wakeup()
+
+    def remove_streams(self, streams):
+        with self.lock:
+            self.pending.extend(('remove', stream) for stream in streams)
+        self._wakeup()
+
+    def add_file(self, path, watch):
+        with self.lock:
+            self.files.setdefault(path, {})[id(watch)] = [watch, -1]
+        self._wakeup()
+
+    def remove_file(self, path, watch):
+        with self.lock:
+            watchers = self.files.get(path, {})
+            watchers.pop(id(watch), None)
+            if not watchers:
+                self.files.pop(path, None)
+
+    def _apply_pending(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        for op, stream in pending:
+            if op == 'remove':
+                stream.closed = True
+                self._unregister(stream)
+                continue
+            if stream.closed:
+                continue
+            os.set_blocking(stream.fd, False)
+            try:
+                self.selector.register(stream.fd, selectors.EVENT_READ, stream)
+            except KeyError:
+                # The fd was closed and reused without us hearing about it
+                self.selector.unregister(stream.fd)
+                self.selector.register(stream.fd, selectors.EVENT_READ, stream)
+            except (OSError, ValueError):
+                stream.closed = True
+                stream.watch.notify()
+
+    def _unregister(self, stream):
+        try:
+            key = self.selector.get_key(stream.fd)
+        except (KeyError, ValueError):
+            return
+        if key.data is stream:
+            self.selector.unregister(stream.fd)
+
+    def _read(self, stream):
+        try:
+            data = os.read(stream.fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if stream.closed:
+            return # removed meanwhile
+        if data:
+            stream.deliver(data)
+        else:
+            stream.deliver(b'', final=True)
+            stream.closed = True
+            self._unregister(stream)
+        stream.watch.notify()
+
+    def _check_files(self):
+        with self.lock:
+            watched = [(path, list(watchers.values())) for path, watchers in self.files.items()]
+        for path, watchers in watched:
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                continue
+            for entry in watchers:
+                if entry[1] != size:
+                    entry[1] = size
+                    entry[0].notify()
+
+    def run(self):
+        nextfilecheck = 0
+        while True:
+            try:
+                self._apply_pending()
+                timeout = None
+                if self.files:
+                    timeout = max(0, nextfilecheck - time.time())
+                for key, mask in self.selector.select(timeout):
+                    if key.data is None:
+                        try:
+                            while os.read(self.wakeread, 4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                        continue
+                    self._read(key.data)
+                if self.files and time.time() >= nextfilecheck:
+                    self._check_files()
+                    nextfilecheck = time.time() + self.fileinterval
+            except Exception as e:
+                # Losing this thread would hang every tester
+                self.logger.error("Supervisor loop error: " + str(e))
+                time.sleep(1)
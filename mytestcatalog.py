@@ -0,0 +1,64 @@
+""" Indexed view of all the tests/*.json test lists
+"""
+import threading
+
+class TestCatalog(object):
+    """ All known test lists indexed by 'test' and by 'name'.
+        Everything returned is a fresh copy (entries are flat dicts), so
+        callers are free to mark entries disabled or override parameters
+        without touching the shared catalog. """
+    LISTS = ('initial', 'comprehensive', 'lnet', 'zfs', 'ldiskfs')
+
+    def __init__(self, initial, comprehensive, lnet, zfs, ldiskfs):
+        self.lists = {'initial': initial or [],
+                      'comprehensive': comprehensive or [],
+                      'lnet': lnet or [],
+                      'zfs': zfs or [],
+                      'ldiskfs': ldiskfs or []}
+        self.by_test = {}
+        self.by_name = {}
+        for listname in self.LISTS:
+            for entry in self.lists[listname]:
+                self.by_test.setdefault(entry['test'], []).append(entry)
+                # First one wins, same as the linear search used to do
+                self.by_name.setdefault(entry.get('name', entry['test']), entry)
+        self.branchlists = {}
+        self.lock = threading.Lock()
+
+    def _for_branch(self, branch):
+        """ Lists with onlybranch entries for other branches filtered out """
+        if not branch:
+            return self.lists
+        lists = self.branchlists.get(branch)
+        if lists is not None:
+            return lists
+        lists = {}
+        for listname in self.LISTS:
+            lists[listname] = [entry for entry in self.lists[listname]
+                               if not entry.get('onlybranch') or
+                               branch.startswith(entry['onlybranch'])]
+        with self.lock:
+            self.branchlists[branch] = lists
+        return lists
+
+    def get_list(self, listname, branch=None, disabled=()):
+        """ Copy of a test list for the branch, entries for tests in
+            disabled are marked as such """
+        result = []
+        for entry in self._for_branch(branch)[listname]:
+            entry = dict(entry)
+            if entry['test'] in disabled:
+                entry['disabled'] = True
+            result.append(entry)
+        return result
+
+    def find_by_test(self, testname):
+        """ Copies of all entries running testname, in all lists """
+        return [dict(entry) for entry in self.by_test.get(testname, [])]
+
+    def find_by_name(self, name):
+        """ Copy of the entry with this name (or test if no name) or None """
+        entry = self.by_name.get(name)
+        if entry is None:
+            return None
+        return dict(entry)
@@ -9,7 +9,6 @@ import threading
 import logging
 import re
 import shlex
-import json
 import shutil
 import traceback
 import yaml
@@ -20,30 +19,109 @@ from mytestdatadb import process_results
 from mytestdatadb import process_warning
 from mytuplesorter import TupleSortingOn0
 import myyamlsanitizer
+from myconfigregistry import registry
+from mystreammatcher import StreamMatcher, match_file
+from myoutputbuffer import OutputBuffer
+
+# Longest a tester sleeps without any event, just in case one got lost
+WATCH_MAX_WAIT = 60
+
+# Console strings we look for besides console_errors_lookup.json
+PORTMAP_ERROR = "port 988: port already in use"
+# Need to catch early booting message to be sure, so grab part of the
+# kdump kernel commandline instead of "Starting Kdump Vmcore Save Service"
+KDUMP_START_MESSAGE = "irqpoll nr_cpus=1 reset_devices"
+KDUMP_END_MESSAGE = "kdump: saving vmcore complete"
+TEST_MARKER = "Lustre: DEBUG MARKER: == "
+# How much console log we take in at a time
+CONSOLE_CHUNK = 1024 * 1024
+# Looked for in all of the output, not just the tail we keep
+NODE_OUTPUT_STRINGS = ("login:", "Entering emergency mode. Exit the shell to continue",
+                       "nbd: nbd0 already in use")
+NODE_ERROR_STRINGS = ("Timeout, server",)
+TEST_OUTPUT_STRINGS = (".ko: File exists", ": double free or corruption ", "Backtrace: ")
+
+# With fsconfig 'session-reuse' a VM pair that ran a test cleanly goes on
+# to the next test of the same build, at most this many tests in a row
+SESSION_MAX_TESTS = 10
+# Each of these is run over ssh between tests, overridable in fsconfig.
+# 'session-cleanup' runs on the client with the test environment of the
+# test that just finished, the other two run on the server and the
+# client must pass on both.
+SESSION_CLEANUP = "/home/green/git/lustre-release/lustre/tests/llmountcleanup.sh"
+SESSION_SERVER_CLEANUP = "for dev in /dev/vdc /dev/vdd /dev/vde /dev/vdf ; do [ -b $dev ] && wipefs -a -q $dev ; done ; true"
+SESSION_CHECK = "! grep -qE '^(lustre|lnet|libcfs|ldiskfs) ' /proc/modules && ! grep -qw lustre /proc/mounts"
+SESSION_STEP_TIMEOUT = 600
+
+def console_patterns():
+    """ Everything node consoles are matched against, only rebuilt
+        when console_errors_lookup.json changes """
+    def build(console_errors):
+        patterns = [PORTMAP_ERROR, KDUMP_START_MESSAGE, KDUMP_END_MESSAGE]
+        for item in console_errors or []:
+            if item.get('error'):
+                patterns.append(item['error'])
+        return tuple(patterns)
+    return registry.get_derived("console-patterns", ["console_errors_lookup.json"], build)
 
 class Node(object):
-    def __init__(self, name, outputdir):
+    def __init__(self, name, outputdir, watch, testdir=None):
         self.name = name # Node name
         # XXX we probably want a better way eventually.
         self.consolelogfile = outputdir + "/" + name + "-console.txt"
         self.outputdir = outputdir
+        # Results dir of the current test, differs from outputdir when the
+        # node lives on for more tests
+        self.testdir = testdir or outputdir
+        self.watch = watch # supervisor Watch of our tester
         self.process = None # Popen object
-        self.outs = '' # full accumulated stdout output
-        self.errs = '' # full accumulated stderr output
-        self.consoleoutput = ""
+        # Full output goes to the results dir, the tail stays here
+        self.outs = OutputBuffer(self.testdir + "/" + name + "-stdout.txt", watchfor=NODE_OUTPUT_STRINGS)
+        self.errs = OutputBuffer(self.testdir + "/" + name + "-stderr.txt", watchfor=NODE_ERROR_STRINGS)
+        # Console text is only run through this, never kept
+        self.consolematcher = StreamMatcher(console_patterns(), repeating=(TEST_MARKER,))
         self.consolelogdesc = None
+        self.consolepos = 0 # console characters read so far
+        self.consolestart = 0 # where the current test started
+        self.consolesaved = False
         self.last_test_line_time = time.time()
 
-    def match_console_string(self, string):
-        # Right now we assume the output cannot be changing as we are called
-        # at the end. This migth change eventually I guess
+    def start_test(self, testdir):
+        """ Point a node that already ran a test at the next one """
+        self.read_console()
+        self.consolestart = self.consolepos
+        self.consolematcher = StreamMatcher(console_patterns(), repeating=(TEST_MARKER,))
+        self.consolesaved = False
+        self.testdir = testdir
+        self.outs.close()
+        self.errs.close()
+        self.outs = OutputBuffer(testdir + "/" + self.name + "-stdout.txt", watchfor=NODE_OUTPUT_STRINGS)
+        self.errs = OutputBuffer(testdir + "/" + self.name + "-stderr.txt", watchfor=NODE_ERROR_STRINGS)
+        self.last_test_line_time = time.time()
+
+    def save_console(self):
+        """ Copy the console of the current test to its results dir,
+            unless the console log is there already """
+        if self.testdir == self.outputdir or self.consolesaved:
+            return
+        self.consolesaved = True
+        try:
+            with open(self.consolelogfile, "rb") as src, \
+                 open(self.testdir + "/" + self.name + "-console.txt", "wb") as dst:
+                src.seek(self.consolestart)
+                shutil.copyfileobj(src, dst)
+        except OSError:
+            pass # what can we do
+
+    def read_console(self):
+        """ Run console output that appeared since the last time through
+            the matcher """
         if not os.path.exists(self.consolelogfile):
             return False
 
-        # If console output is not empty that means we have opened this
-        # file in the past and there's no need to reopen it again
-        # because it was closed by terminate or some such
-        if not self.consolelogdesc and not self.consoleoutput:
+        # If we have opened this file in the past there's no need to
+        # reopen it again because it was closed by terminate or some such
+        if not self.consolelogdesc:
             try:
                 self.consolelogdesc = io.open(self.consolelogfile, "r", encoding = "ISO-8859-1")
             except OSError:
@@ -52,22 +130,59 @@ class Node(object):
             fl = fcntl.fcntl(fd, fcntl.F_GETFL)
             fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
 
-        try:
-            newdata = self.consolelogdesc.read()
-        except ValueError: # File was closed already
-            newdata = ""
+        # Only what was appended since the last time
+        while True:
+            try:
+                newdata = self.consolelogdesc.read(CONSOLE_CHUNK)
+            except ValueError: # File was closed already
+                newdata = ""
+            if not newdata:
+                break
+            self.consolepos += len(newdata)
+            if TEST_MARKER in self.consolematcher.feed(newdata):
+                self.last_test_line_time = time.time()
 
         # If this process is already dead, no new data can come so
         # let's close this preemptively
         if not self.is_alive():
             self.consolelogdesc.close() # Ok to do many times
+        return True
+
+    def match_console_string(self, string):
+        # Right now we assume the output cannot be changing as we are called
+        # at the end. This migth change eventually I guess
+        if not self.read_console():
+            return False
+
+        if self.consolematcher.knows(string):
+            return self.consolematcher.seen(string)
+        # Not one of ours, go through the log of this test for it
+        try:
+            return match_file(self.consolelogfile, [string], start=self.consolestart).seen(string)
+        except OSError:
+            return False
+
+    def add_outs(self, data):
+        self.outs.write(data)
 
-        if "Lustre: DEBUG MARKER: == " in newdata:
-            self.last_test_line_time = time.time()
+    def add_errs(self, data):
+        self.errs.write(data)
 
-        self.consoleoutput += newdata
+    def supervise(self):
+        """ Have the supervisor collect our output and wake the tester
+            on any output, exit or console log growth """
+        self.watch.add_process(self.process, self.add_outs, self.add_errs)
+        self.watch.add_file(self.consolelogfile)
 
-        return string in self.consoleoutput
+    def exited(self):
+        """ The process is gone and all its output collected """
+        if self.watch.drained(self.process):
+            # Exit status shows up right behind the end of output
+            self.watch.wait_exit(self.process, 5)
+        if self.process.poll() is None:
+            return False
+        self.watch.wait_exit(self.process, 5)
+        return True
 
     def is_alive(self):
         if self.process is not None:
@@ -78,26 +193,9 @@ class Node(object):
     def wait_for_login(self):
         """ Returns error as string or None if all is fine. No timeout handling """
 
-        fd = self.process.stdout.fileno()
-        fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-        fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-
         deadlinetime = time.time() + 300 # IF a node did not come up in 5 minutes, something is wrong with it anyway. Only this long because initial nfs mount for client state is somewhat slow.
         while time.time() <= deadlinetime:
-            try:
-                string = self.process.stdout.read()
-            except:
-                string = ''
-                time.sleep(1)
-            else:
-                self.outs += string
-                #pprint(string)
-
-            self.process.poll()
-            if self.process.returncode is not None:
-                # Capture stderr too
-                string = self.process.stderr.read()
-                self.errs += string
+            if self.exited():
                 return "Process died"
             if "Entering emergency mode. Exit the shell to continue" in self.outs:
                 print("Emergency mode shell detected!")
@@ -106,9 +204,8 @@ class Node(object):
             if "nbd: nbd0 already in use" in self.outs:
                 return "nbd0 is in use"
             if "login:" in self.outs:
-                # Restore old blocking behavior
-                fcntl.fcntl(fd, fcntl.F_SETFL, fl)
                 return None
+            self.watch.wait(deadlinetime - time.time())
         # Hm, the loop ended somehow?
         self.process.terminate()
         return "Timed Out waiting for login prompt"
@@ -116,52 +213,40 @@ class Node(object):
     def terminate(self):
         if self.consolelogdesc is not None:
             self.consolelogdesc.close() # Safe to do many times
-        if self.process is None or self.process.returncode is not None:
-            return
-        try:
-            self.process.terminate()
-        except OSError: # Already dead? ignore
-            pass
-        # This can actually hang too if the process refuses to die.
-        # 3 minutes sounds like an extreme, but we want to avoid making
-        # it available until it's truly dead or until the timoeut has triggered.
-        # Helps us to save crashdumps and whatnot I guess
-        try:
-            outs, errs = self.process.communicate(timeout=180)
-            self.outs += outs
-            self.errs += errs
-        except TimeoutExpired:
-            print(self.name + " did not die after terminate, leaving it be")
+        if self.process is not None and self.process.returncode is None:
+            try:
+                self.process.terminate()
+            except OSError: # Already dead? ignore
+                pass
+            # This can actually hang too if the process refuses to die.
+            # 3 minutes sounds like an extreme, but we want to avoid making
+            # it available until it's truly dead or until the timoeut has triggered.
+            # Helps us to save crashdumps and whatnot I guess
+            if not self.watch.wait_exit(self.process, 180):
+                print(self.name + " did not die after terminate, leaving it be")
+        self.save_console()
+        self.outs.close() # Safe to do many times
+        self.errs.close()
 
     def returncode(self):
         self.process.poll()
         return self.process.returncode
 
     def check_node_alive(self):
-        self.process.poll()
-        if self.process.returncode is None:
-            return True
-
-        outs, errs = self.process.communicate()
-        self.outs += outs
-        self.errs += errs
-        return False
+        return not self.exited()
 
     def dump_core(self, prefix):
         """ This dumps core and asks the qemu to quit, assumes qemu """
         if not self.process or not self.check_node_alive():
             return None
-        outs = ''
-        errs = ''
-        corename = '%s/%s-%s-core' % (self.outputdir, self.name, prefix)
+        corename = '%s/%s-%s-core' % (self.testdir, self.name, prefix)
         # \1c is to trigger monitor mode
         command = '\1c\ndump-guest-memory -l %s\nquit\n' % (corename)
         try:
-            outs, errs = self.process.communicate(input=command, timeout=1)
-        except TimeoutExpired:
-            pass
-        self.outs += outs
-        self.errs += errs
+            self.process.stdin.write(command)
+            self.process.stdin.close()
+        except (OSError, ValueError):
+            pass # Died meanwhile
         return corename
 
 class Tester(object):
@@ -187,38 +272,48 @@ class Tester(object):
         sleep_on_error = 15
         while True:
             if self.RequestExit:
+                self.end_session()
                 self.logger.info("Exiting on request")
                 return # painlessly terminate our thread. no locks held.
-            in_cond.acquire()
-            while in_queue.empty():
-                # This means we cannot remove workers while work queue is
-                # not empty.
-                if self.OneShot or self.RequestExit:
-                    self.RequestExit = True
-                    in_cond.release()
-                    self.logger.info("Exiting. Oneshot " + str(self.OneShot))
-                    return # This terminates our thread
-                in_cond.wait()
-
-            job = in_queue.get()
-            self.logger.info("Remaining Testing items in the queue left: " + str(in_queue.qsize()))
-            self.Busy = True
-            in_cond.release()
+            job = None
+            if self.session is not None:
+                # Our VMs are still up, anything else they could run?
+                in_cond.acquire()
+                job = in_queue.take_first(lambda entry: self.session_key(entry[1], entry[2]) == self.session['key'])
+                if job is not None:
+                    self.logger.info("Remaining Testing items in the queue left: " + str(in_queue.qsize()))
+                    self.Busy = True
+                in_cond.release()
+                if job is None:
+                    self.end_session()
+            if job is None:
+                in_cond.acquire()
+                while in_queue.empty():
+                    # This means we cannot remove workers while work queue is
+                    # not empty.
+                    if self.OneShot or self.RequestExit:
+                        self.RequestExit = True
+                        in_cond.release()
+                        self.logger.info("Exiting. Oneshot " + str(self.OneShot))
+                        return # This terminates our thread
+                    in_cond.wait()
+
+                job = in_queue.get()
+                self.logger.info("Remaining Testing items in the queue left: " + str(in_queue.qsize()))
+                self.Busy = True
+                in_cond.release()
             priority = job[0] # Not really used here
             testinfo = job[1]
             workitem = job[2]
             self.logger.info("Got job buildid " + str(workitem.buildnr) + " test " + str(testinfo))
+            self.jobstart = time.time()
+            self.currenttest = testinfo
+            self.currentitem = workitem
             try:
                 result = self.test_worker(testinfo, workitem)
-                # save the test output if any
-                if self.testresultsdir and self.testouts:
-                    try:
-                        with open(self.testresultsdir + "/test.stdout", "w") as sout:
-                            sout.write(self.testouts)
-                        with open(self.testresultsdir + "/test.stderr", "w") as serr:
-                            serr.write(self.testerrs)
-                    except OSError:
-                        pass # what can we do
+                # test.stdout and test.stderr were written as we went
+                self.testouts.close()
+                self.testerrs.close()
             except:
                 tb = traceback.format_exc()
                 self.logger.info("Exception in job buildid " + str(workitem.buildnr) + " " + testinfo['name'] + '-' + testinfo['fstype'] + ": " + str(sys.exc_info()))
@@ -242,6 +337,13 @@ class Tester(object):
                     out_queue.put(workitem)
                     out_cond.notify()
                     out_cond.release()
+            elif workitem.Aborted or testinfo.get("Cancelled"):
+                # Failure came from us killing it, nothing to retry
+                self.logger.info("Cancelled job buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'])
+                out_cond.acquire()
+                out_queue.put(workitem)
+                out_cond.notify()
+                out_cond.release()
             else:
                 # We had some problem with our VMs or whatnot, return
                 # the job to the pool for retrying and sleep for some time
@@ -286,10 +388,20 @@ class Tester(object):
         self.TimeoutDetected = False
         self.error = False
         self.crashfiles = []
-        self.testerrs = ''
-        self.testouts = ''
+        self.testerrs = OutputBuffer()
+        self.testouts = OutputBuffer()
         self.startTime = 0
         self.fatal_exceptions = 0
+        self.currentitem = None
+        self.currenttest = None
+        self.jobstart = 0
+        self.nodes = []
+        self.testprocess = None
+        self.watch = None
+        self.session = None # VM pair kept running for the next test
+        # What boot admission control counts our boots against
+        self.bootresources = ["host:" + workerinfo.get('vmhost', 'localhost'),
+                              "nfs:" + workerinfo.get('nfsserver', 'default')]
         self.out_cond = out_cond
         self.out_queue = out_queue
         self.daemon = threading.Thread(target=self.run_daemon, args=(in_cond, in_queue, out_cond, out_queue))
@@ -396,13 +508,12 @@ class Tester(object):
             return matches
 
         try:
-            with open(filename, "r", encoding = "ISO-8859-1") as suitefd:
-                suitelog = suitefd.read()
+            matcher = match_file(filename, [pattern.get('string', 'blahblah') for pattern in patterns])
         except OSError:
             return matches
 
         for pattern in patterns:
-            if pattern.get('string', 'blahblah') in suitelog:
+            if matcher.seen(pattern.get('string', 'blahblah')):
                 matches.append(pattern)
         return matches
 
@@ -410,13 +521,123 @@ class Tester(object):
         return int(time.time() - self.startTime)
 
     def cleanup_after_run(self):
-        self.testerrs = ''
-        self.testouts = ''
+        self.testerrs.close()
+        self.testouts.close()
+        self.testerrs = OutputBuffer()
+        self.testouts = OutputBuffer()
         self.crashfiles = []
+        self.currentitem = None
+        self.currenttest = None
+        self.nodes = []
+        self.testprocess = None
+        if self.watch is not None:
+            if self.session is None or self.session['watch'] is not self.watch:
+                self.watch.close()
+            self.watch = None
+
+    def add_testouts(self, data):
+        self.testouts.write(data)
+
+    def add_testerrs(self, data):
+        self.testerrs.write(data)
+
+    def cancel(self, workitem, OnlySpeculative=False):
+        """ Called from other threads. If we are running a test of workitem
+            kill the test and both VMs, our thread then notices Aborted or
+            Cancelled and cleans up. Returns (testinfo, seconds it ran) or
+            None if we are not running anything of workitem """
+        testinfo = self.currenttest
+        if self.currentitem is not workitem or testinfo is None:
+            return None
+        if OnlySpeculative and not testinfo.get('Speculative'):
+            return None
+        self.logger.warning("Cancelling job for buildid " + str(workitem.buildnr) + " test " + testinfo.get('name', '') + '-' + testinfo.get('fstype', ''))
+        processes = [self.testprocess] + [node.process for node in self.nodes]
+        for process in processes:
+            if process is None or process.returncode is not None:
+                continue
+            try:
+                process.terminate()
+            except OSError:
+                pass # Already gone
+        watch = self.watch
+        if watch is not None:
+            watch.kick()
+        return (testinfo, time.time() - self.jobstart)
+
+    def session_key(self, testinfo, workitem):
+        """ Tests with the same key can run on the same booted VM pair """
+        distro = testinfo.get("forcedistro", workitem.distro)
+        return (workitem.buildnr, workitem.artifactsdir,
+                testinfo.get("serverdistro", distro),
+                testinfo.get("clientdistro", distro),
+                bool(testinfo.get("SELINUX", False)),
+                testinfo.get("vmparams", ""))
+
+    def run_on_node(self, nodename, command, watch):
+        """ Run command on nodename over ssh, output goes with the test
+            output. Returns True if it succeeded """
+        args = ["ssh", "-o", "StrictHostKeyChecking=no", "root@" + nodename, command]
+        try:
+            process = Popen(args, close_fds=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        except OSError as details:
+            self.logger.warning("Failed to run " + command + " on " + nodename + ": " + str(details))
+            return False
+        watch.add_process(process, self.add_testouts, self.add_testerrs)
+        if not watch.wait_exit(process, SESSION_STEP_TIMEOUT):
+            self.logger.warning("Timed out running " + command + " on " + nodename)
+            try:
+                process.terminate()
+            except OSError:
+                pass
+            return False
+        if process.returncode != 0:
+            self.logger.warning("Failed " + command + " on " + nodename + " with code " + str(process.returncode))
+            return False
+        return True
+
+    def keep_session(self, key, jobs, server, client, watch, testenv):
+        """ Clean up both VMs after a test that went fine and keep them
+            around for the next one. Returns False if they are not fit
+            for it and need a reboot. """
+        if not self.fsinfo.get('session-reuse'):
+            return False
+        if jobs >= self.fsinfo.get('session-max-tests', SESSION_MAX_TESTS):
+            return False
+        if not server.check_node_alive() or not client.check_node_alive():
+            return False
+        check = self.fsinfo.get('session-check', SESSION_CHECK)
+        steps = [(client.name, testenv + self.fsinfo.get('session-cleanup', SESSION_CLEANUP)),
+                 (server.name, self.fsinfo.get('session-server-cleanup', SESSION_SERVER_CLEANUP)),
+                 (server.name, check), (client.name, check)]
+        for nodename, command in steps:
+            if command and not self.run_on_node(nodename, command, watch):
+                return False
+        # Anything bad showing up on the consoles while at it?
+        for item in registry.get("console_errors_lookup.json", []):
+            if item.get('error') and (server.match_console_string(item['error']) or
+                                      client.match_console_string(item['error'])):
+                return False
+        server.save_console()
+        client.save_console()
+        self.session = {'key':key, 'jobs':jobs, 'server':server,
+                        'client':client, 'watch':watch}
+        return True
+
+    def end_session(self):
+        """ Shut down the VMs kept around for the next test, if any """
+        session = self.session
+        if session is None:
+            return
+        self.session = None
+        self.logger.info("Shutting down VMs after " + str(session['jobs']) + " tests")
+        session['server'].terminate()
+        session['client'].terminate()
+        session['watch'].close()
 
     def init_new_run(self):
-        self.testerrs = ''
-        self.testouts = ''
+        self.testerrs = OutputBuffer()
+        self.testouts = OutputBuffer()
         self.CrashDetected = False
         self.Crashed = False
         self.TimeoutDetected = False
@@ -450,20 +671,14 @@ class Tester(object):
             workitem.UpdateTestStatus(testinfo, "Invalid testinfo!", Failed=True)
             return True # No point in retrying an invalid test
 
-        if workitem.Aborted:
+        if workitem.Aborted or testinfo.get("Cancelled"):
             return True
 
         if testinfo.get("failcount", 0) > 30: # arbitrary high number
             workitem.UpdateTestStatus(testinfo, "Cannot get this item to successfully run for 30 times! Giving up", Failed=True)
             return True
 
-        console_errors = []
-        if os.path.exists("console_errors_lookup.json"):
-            try:
-                with open("console_errors_lookup.json", "r") as errfile:
-                    console_errors = json.load(errfile)
-            except: # any error really
-                self.logger.error("Failure loading console errors description?")
+        console_errors = registry.get("console_errors_lookup.json", [])
 
         timeout = testinfo.get("timeout", -1)
         if timeout == -1:
@@ -491,6 +706,7 @@ class Tester(object):
 
         testresultsdir += "-" + serverdistro + "_" + self.serverarch
         testresultsdir += "-" + clientdistro + "_" + self.clientarch
+        sessionkey = self.session_key(testinfo, workitem)
 
         clientbuild = artifactdir + "/lustre-" + clientdistro + "-" + self.clientarch + ".ssq"
         serverbuild = artifactdir + "/lustre-" + serverdistro + "-" + self.serverarch + ".ssq"
@@ -528,81 +744,150 @@ class Tester(object):
 
         # To know where to copy syslogs and core files
         self.testresultsdir = testresultsdir
-
-        server = Node(self.servernetname, testresultsdir)
-        client = Node(self.clientnetname, testresultsdir)
+        self.testouts = OutputBuffer(testresultsdir + "/test.stdout", watchfor=TEST_OUTPUT_STRINGS)
+        self.testerrs = OutputBuffer(testresultsdir + "/test.stderr")
 
         workitem.UpdateTestStatus(testinfo, None, ResultsDir=testresultsdir)
 
-        # SELinux check here since it needs a command line argument
-
-        env = os.environ.copy()
-        if testinfo.get("vmparams"):
-            VMPARAMS = dict(re.findall(r'(\S+)=(".*?"|\S+)', testinfo['vmparams']))
-            for p in VMPARAMS:
-                env[p] = VMPARAMS[p]
-
-        try:
-            env['DISTRO'] = serverdistro
-            server.process = Popen([self.serverruncommand, server.name, serverkernel, serverinitrd, serverbuild, testresultsdir], close_fds=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=True, env=env)
-        except (OSError) as details:
-            self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Failed to run server " + str(details))
-            return False
+        # Still running VMs from the previous test of the same build?
+        server = None
+        client = None
+        session = self.session
+        self.session = None
+        sessionjobs = 1
+        if session is not None and session['key'] == sessionkey:
+            server = session['server']
+            client = session['client']
+            watch = session['watch']
+            self.watch = watch
+            self.nodes = [server, client]
+            server.start_test(testresultsdir)
+            client.start_test(testresultsdir)
+            remount = "umount /tmp/testlogs ; mount 192.168.200.253:/" + testresultsdir + " /tmp/testlogs -t nfs"
+            if server.check_node_alive() and client.check_node_alive() and \
+               self.run_on_node(self.clientnetname, remount, watch):
+                sessionjobs = session['jobs'] + 1
+                self.logger.info("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Reusing VMs, test " + str(sessionjobs) + " on them")
+            else:
+                self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Cannot reuse VMs, rebooting")
+                self.session = session
+                self.end_session()
+                server = None
+                client = None
+        elif session is not None:
+            self.session = session
+            self.end_session()
+
+        if server is None:
+            watch = self.fsinfo['supervisor'].watch()
+            self.watch = watch
+            # VMs that might run more tests get a dir of their own for the
+            # console logs, every test gets its part copied over
+            rundir = testresultsdir
+            if self.fsinfo.get('session-reuse'):
+                sessionnr = 1
+                while os.path.exists(outdir + "/vms-" + self.name + "-" + str(sessionnr)):
+                    sessionnr += 1
+                sessiondir = outdir + "/vms-" + self.name + "-" + str(sessionnr)
+                try:
+                    os.mkdir(sessiondir)
+                    rundir = sessiondir
+                except OSError:
+                    self.logger.warning("Cannot create VM dir " + sessiondir)
+            server = Node(self.servernetname, rundir, watch, testdir=testresultsdir)
+            client = Node(self.clientnetname, rundir, watch, testdir=testresultsdir)
+            self.nodes = [server, client]
+
+            # SELinux check here since it needs a command line argument
+
+            env = os.environ.copy()
+            if testinfo.get("vmparams"):
+                VMPARAMS = dict(re.findall(r'(\S+)=(".*?"|\S+)', testinfo['vmparams']))
+                for p in VMPARAMS:
+                    env[p] = VMPARAMS[p]
+
+            # Wait for our turn so the host and the NFS server our roots
+            # come from do not get everybody booting at once
+            admission = self.fsinfo.get('boot-admission')
+            ticket = None
+            if admission is not None:
+                ticket = admission.admit(self.bootresources, 2, lambda: workitem.Aborted or testinfo.get("Cancelled"))
+                if ticket is None:
+                    self.logger.warning("job for buildid " + str(workitem.buildnr) + " aborted while waiting to boot")
+                    return True
+            bootstart = time.time()
+            bootduration = None
+            bootfailed = False
+            try:
+                try:
+                    env['DISTRO'] = serverdistro
+                    server.process = Popen([self.serverruncommand, server.name, serverkernel, serverinitrd, serverbuild, rundir], close_fds=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=True, env=env)
+                except (OSError) as details:
+                    self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Failed to run server " + str(details))
+                    return False
+                server.supervise()
 
-        try:
-            env['DISTRO'] = clientdistro
-            client.process = Popen([self.clientruncommand, client.name, clientkernel, clientinitrd, clientbuild, testresultsdir], close_fds=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=True, env=env)
-        except (OSError) as details:
-            self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Failed to run client " + str(details))
-            server.terminate()
-            return False
-        # Now we need to wait until both have booted and gave us login prompt
-        if server.wait_for_login() is not None:
-            client.terminate()
-            #pprint(server.errs)
-            self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Server did not show login prompt " + str(server.errs) + " " + str(server.outs) + " " + str([self.serverruncommand, server.name, serverkernel, serverinitrd, serverbuild, testresultsdir]))
-            return False
-        if client.wait_for_login() is not None:
-            server.terminate()
-            #pprint(client.errs)
-            self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Client did not show login prompt" + str(client.errs) + " " + str(client.outs) + " " + str([self.clientruncommand, client.name, clientkernel, clientinitrd, clientbuild, testresultsdir]))
-            return False
+                try:
+                    env['DISTRO'] = clientdistro
+                    client.process = Popen([self.clientruncommand, client.name, clientkernel, clientinitrd, clientbuild, rundir], close_fds=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=True, env=env)
+                except (OSError) as details:
+                    self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Failed to run client " + str(details))
+                    server.terminate()
+                    return False
+                client.supervise()
+                # Now we need to wait until both have booted and gave us login prompt
+                if server.wait_for_login() is not None:
+                    client.terminate()
+                    #pprint(server.errs)
+                    bootfailed = not (workitem.Aborted or testinfo.get("Cancelled"))
+                    self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Server did not show login prompt " + str(server.errs) + " " + str(server.outs) + " " + str([self.serverruncommand, server.name, serverkernel, serverinitrd, serverbuild, testresultsdir]))
+                    return False
+                if client.wait_for_login() is not None:
+                    server.terminate()
+                    #pprint(client.errs)
+                    bootfailed = not (workitem.Aborted or testinfo.get("Cancelled"))
+                    self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Client did not show login prompt" + str(client.errs) + " " + str(client.outs) + " " + str([self.clientruncommand, client.name, clientkernel, clientinitrd, clientbuild, testresultsdir]))
+                    return False
+                bootduration = time.time() - bootstart
+            finally:
+                if ticket is not None:
+                    admission.release(ticket, bootduration, Failed=bootfailed)
 
-        if workitem.Aborted:
-            server.terminate()
-            client.terminate()
-            return True
+            if workitem.Aborted or testinfo.get("Cancelled"):
+                server.terminate()
+                client.terminate()
+                return True
 
-        # Now perform initial preparations like starting kdump and mount NFS in VM
-        try:
-            command = "ssh -o StrictHostKeyChecking=no root@" + self.clientnetname + \
-                    " 'systemctl start kdump ; mkdir /tmp/testlogs ; mount 192.168.200.253:/" + \
-                    testresultsdir + " /tmp/testlogs -t nfs'"
-            args = shlex.split(command)
-            setupprocess = Popen(args, close_fds=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=True)
-            outs, errs = setupprocess.communicate(timeout=600) # XXX timeout handling
-            self.testouts += outs
-            self.testerrs += errs
-            if setupprocess.returncode != 0:
-                self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Failed to setup test environment: " + self.testerrs + " " + self.testouts)
+            # Now perform initial preparations like starting kdump and mount NFS in VM
+            try:
+                command = "ssh -o StrictHostKeyChecking=no root@" + self.clientnetname + \
+                        " 'systemctl start kdump ; mkdir /tmp/testlogs ; mount 192.168.200.253:/" + \
+                        testresultsdir + " /tmp/testlogs -t nfs'"
+                args = shlex.split(command)
+                setupprocess = Popen(args, close_fds=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+                watch.add_process(setupprocess, self.add_testouts, self.add_testerrs)
+                if not watch.wait_exit(setupprocess, 600):
+                    raise TimeoutExpired(args, 600)
+                if setupprocess.returncode != 0:
+                    self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Failed to setup test environment: " + str(self.testerrs) + " " + str(self.testouts))
+                    server.terminate()
+                    client.terminate()
+                    return False
+            except OSError as details:
+                self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Failed to run test setup " + str(details))
+                server.terminate()
+                client.terminate()
+                return False
+            except TimeoutExpired:
+                self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Timed out mounting nfs")
+                setupprocess.terminate()
                 server.terminate()
                 client.terminate()
                 return False
-        except OSError as details:
-            self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Failed to run test setup " + str(details))
-            server.terminate()
-            client.terminate()
-            return False
-        except TimeoutExpired:
-            self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Timed out mounting nfs")
-            setupprocess.terminate()
-            server.terminate()
-            client.terminate()
-            return False
 
-        del setupprocess
+            del setupprocess
 
-        if workitem.Aborted:
+        if workitem.Aborted or testinfo.get("Cancelled"):
             self.logger.warning("job for buildid " + str(workitem.buildnr) + " aborted")
             server.terminate()
             client.terminate()
@@ -627,16 +912,19 @@ class Tester(object):
             ENVPARAMS = testinfo.get('env', '')
             AUSTERPARAMS = testinfo.get('austerparam', '')
             # XXX - this stuff should be in some config
+            testenv = 'PDSH="pdsh -S -Rssh -w" mds_HOST=' + self.servernetname + \
+                    " ost_HOST=" + self.servernetname + " MDSDEV1=/dev/vdc " + \
+                    "OSTDEV1=/dev/vde OSTDEV2=/dev/vdf LOAD_MODULES_REMOTE=true " + \
+                    "FSTYPE=" + fstype + DNEStr + SSKSTR + SELINUXSTR + \
+                    "MDSSIZE=0 OSTSIZE=0 " + \
+                    "MGSSIZE=0 " + ENVPARAMS + " "
             args = ["ssh", "-tt", "-o", "ServerAliveInterval=0", "-o",
                     "StrictHostKeyChecking=no", "root@" + self.clientnetname,
-                    'PDSH="pdsh -S -Rssh -w" mds_HOST=' + self.servernetname +
-                    " ost_HOST=" + self.servernetname + " MDSDEV1=/dev/vdc " +
-                    "OSTDEV1=/dev/vde OSTDEV2=/dev/vdf LOAD_MODULES_REMOTE=true " +
-                    "FSTYPE=" + fstype + DNEStr + SSKSTR + SELINUXSTR +
-                    "MDSSIZE=0 OSTSIZE=0 " +
-                    "MGSSIZE=0 " + ENVPARAMS + " "
+                    testenv +
                     "NAME=ncli /home/green/git/lustre-release/lustre/tests/auster -D /tmp/testlogs/ -r -k " + AUSTERPARAMS + " " + testscript + " " + TESTPARAMS]
             testprocess = Popen(args, close_fds=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+            self.testprocess = testprocess
+            watch.add_process(testprocess, self.add_testouts, self.add_testerrs)
         except (OSError) as details:
             self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Failed to run test " + str(details))
             server.terminate()
@@ -653,111 +941,20 @@ class Tester(object):
         message = ""
         warnings = ""
         matched_suite_errors = []
-        while testprocess.returncode is None: # XXX add a timer
-            try:
-                # This is a very ugly workaround to the fact that when you call
-                # communicate with timeout, it polls(!!!) the FDs of the subprocess
-                # at an insane rate resulting in huge cpu hog. So only let it
-                # poll once per call and we do our sleeping ourselves.
-                # XXX - perhaps consider doing some sort of a manual select call?
-                time.sleep(5) # every 5 seconds, not ideal because that becomes our latency
-                outs = "" # avoid repeats
-                errs = ""
-                outs, errs = testprocess.communicate(timeout=0.01) # cannot have 0 somehow
-            except ValueError:
-                testprocess.poll()
-                break # dead already?
-            except TimeoutExpired:
-                if workitem.Aborted:
-                    self.logger.warning("job for buildid " + str(workitem.buildnr) + " aborted")
-                    testprocess.terminate()
-                    server.terminate()
-                    client.terminate()
-                    return True
-
-                self.testouts += outs
-                self.testerrs += errs
-                if not server.check_node_alive():
-                    # See if ssh timed out and we need to restart
-                    if "Timeout, server" in server.errs:
-                        self.logger.info(server.name + " ssh session died, need to restart")
-                        testprocess.terminate()
-                        client.terminate()
-                        return False
-
-                    self.logger.info(server.name + " died while processing test job Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'])
-                    self.error = True
-                    self.Crashed = True
-                    message = "Server crashed"
-                    break
-                if not client.check_node_alive():
-                    # See if ssh timed out and we need to restart
-                    if "Timeout, server" in client.errs:
-                        self.logger.info(client.name + " ssh session died, need to restart")
-                        testprocess.terminate()
-                        server.terminate()
-                        return False
-
-                    self.logger.info(client.name + " died while processing test job Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'])
-                    message += "Client crashed"
-                    self.Crashed = True
-                    self.error = True
-                    break
-
-                # See if any fatal errors happened that would allow us to
-                # terminate job sooner as we know it's not healthy anymore
-                for item in console_errors:
-                    if item.get('error') and item.get('fatal'):
-                        for node in [server, client]:
-                            if node.match_console_string(item['error']):
-                                self.logger.warning("Matched fatal error in logs: " + item['error'] + ' on node ' + node.name + " Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'])
-                                self.error = True
-                                message = 'Fatal Error "' + item['error'] + '" on ' + str(node.name)
-                                corefile = node.dump_core("fatalerror")
-                                counter = 0
-                                while node.check_node_alive():
-                                    if counter > 60:
-                                        self.logger.warning("Timeout waiting for crashdump generation on fatalerror on " + str(node.name) + " Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'])
-                                        break
-                                    counter += 1
-                                    time.sleep(5)
-                                mycrashanalyzer.crasher_add_work(self.fsinfo, corefile, testinfo, clientdistro, self.clientarch, workitem, message, TIMEOUT=True, COND=self.out_cond, QUEUE=self.out_queue)
-                        # Cannot break from the above loop
-                        if self.error:
-                            break
-                if self.error:
-                    break # the above break only breaks from the for loop
-
-                # Also timeout both full test and single subtest
-                if (time.time() > deadlinetime) or \
-                   (time.time() - client.last_test_line_time > single_subtest_timeout):
-                    self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Job timed out, terminating")
-                    self.error = True
-                    message = "Timeout"
-                    self.TimeoutDetected = True
-                    # Now lets dump qemu crashdumps of the server and client
-                    clientcore = client.dump_core("timeout")
-                    servercore = server.dump_core("timeout")
-                    counter = 0
-                    while client.check_node_alive() and server.check_node_alive():
-                        if counter > 60:
-                            self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Timeout waiting for crashdump generation on timeout")
-                            break
-                        counter += 1
-                        time.sleep(5)
-                    if clientcore:
-                        mycrashanalyzer.crasher_add_work(self.fsinfo, clientcore, testinfo, clientdistro, self.clientarch, workitem, message, TIMEOUT=True, COND=self.out_cond, QUEUE=self.out_queue)
-                    if servercore:
-                        mycrashanalyzer.crasher_add_work(self.fsinfo, servercore, testinfo, serverdistro, self.serverarch, workitem, message, TIMEOUT=True, COND=self.out_cond, QUEUE=self.out_queue)
-                    # XXX kick some additional analyzer for backtraces or such
-                    break
-            else:
-                self.testouts += outs
-                self.testerrs += errs
+        while True:
+            # Sleep until the test, a node or a console log has news or
+            # the nearest timeout comes up
+            watch.wait(min(deadlinetime - time.time(),
+                           client.last_test_line_time + single_subtest_timeout - time.time(),
+                           WATCH_MAX_WAIT))
+            if watch.drained(testprocess) or testprocess.poll() is not None:
+                # Let the supervisor hand us whatever output is left
+                watch.wait_exit(testprocess, 10)
+            if testprocess.poll() is not None:
                 # We finished normally, let's see if it was an invalid
                 # run.
                 # Add a config file if this list is to grow
-                portmap_error = "port 988: port already in use"
+                portmap_error = PORTMAP_ERROR
                 if server.match_console_string(portmap_error) or client.match_console_string(portmap_error):
                     self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Clash with portmap, restarting")
                     server.terminate()
@@ -774,31 +971,22 @@ class Tester(object):
 
                 # Match test suite output for signs of neessary restart.
                 # Also see if we can print various warnings.
-                if os.path.exists("suite_errors_lookup.json"):
-                    suite_errors = []
-                    try:
-                        with open("suite_errors_lookup.json", "r") as errfile:
-                            suite_errors = json.load(errfile)
-                    except: # any error really
-                        self.logger.error("Failure loading suite errors description?")
-                    else:
-                        matched_suite_errors = self.match_test_output(testscript, suite_errors)
-                        for match in matched_suite_errors:
-                            # self.get_duration() < 300 and ?
-                            if match.get("fatal"):
-                                self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " matched suite error pattern " + match.get("name", "no name"))
-                                server.terminate()
-                                client.terminate()
-                                return False
+                suite_errors = registry.get("suite_errors_lookup.json")
+                if suite_errors:
+                    matched_suite_errors = self.match_test_output(testscript, suite_errors)
+                    for match in matched_suite_errors:
+                        # self.get_duration() < 300 and ?
+                        if match.get("fatal"):
+                            self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " matched suite error pattern " + match.get("name", "no name"))
+                            server.terminate()
+                            client.terminate()
+                            return False
 
                 # It's also possible either a client or server are dead or
                 # are dying (crashdumping), need to check for it here
-                #kdump_start_message = "Starting Kdump Vmcore Save Service"
-                # Need to catch early booting message to be sure, so grab
-                # part of the kdump kernel commandline instead
-                kdump_start_message = "irqpoll nr_cpus=1 reset_devices"
-                kdump_end_message = "kdump: saving vmcore complete"
-                counter = 0
+                kdump_start_message = KDUMP_START_MESSAGE
+                kdump_end_message = KDUMP_END_MESSAGE
+                kdump_deadline = time.time() + 300 # 5 minutes max for crashdump
                 if server.match_console_string(kdump_start_message):
                     self.logger.info(server.name + " kdump starting while processing test job Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'])
                     self.error = True
@@ -809,12 +997,11 @@ class Tester(object):
                         if server.match_console_string(kdump_end_message):
                             self.logger.info(server.name + " kdump done Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'])
                             break
-                        if counter > 60: # 5 minutes max for crashdump
+                        if time.time() > kdump_deadline:
                             self.logger.info(server.name + " kdump timeout Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'])
                             warnings += "(crashdump timeout)"
                             break
-                        time.sleep(5)
-                        counter += 1
+                        watch.wait(kdump_deadline - time.time())
                 if client.match_console_string(kdump_start_message):
                     self.logger.info(client.name + " kdump starting while processing test job Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'])
                     self.error = True
@@ -824,13 +1011,90 @@ class Tester(object):
                         if client.match_console_string(kdump_end_message):
                             self.logger.info(client.name + " kdump done Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'])
                             break
-                        if counter > 60: # 5 minutes max for crashdump
+                        if time.time() > kdump_deadline:
                             self.logger.info(client.name + " kdump timeout Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'])
                             warnings += "(crashdump timeout)"
                             break
-                        time.sleep(5)
+                        watch.wait(kdump_deadline - time.time())
+                break
+
+            if workitem.Aborted or testinfo.get("Cancelled"):
+                self.logger.warning("job for buildid " + str(workitem.buildnr) + " aborted")
+                testprocess.terminate()
+                server.terminate()
+                client.terminate()
+                return True
 
-        if workitem.Aborted:
+            if not server.check_node_alive():
+                # See if ssh timed out and we need to restart
+                if "Timeout, server" in server.errs:
+                    self.logger.info(server.name + " ssh session died, need to restart")
+                    testprocess.terminate()
+                    client.terminate()
+                    return False
+
+                self.logger.info(server.name + " died while processing test job Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'])
+                self.error = True
+                self.Crashed = True
+                message = "Server crashed"
+                break
+            if not client.check_node_alive():
+                # See if ssh timed out and we need to restart
+                if "Timeout, server" in client.errs:
+                    self.logger.info(client.name + " ssh session died, need to restart")
+                    testprocess.terminate()
+                    server.terminate()
+                    return False
+
+                self.logger.info(client.name + " died while processing test job Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'])
+                message += "Client crashed"
+                self.Crashed = True
+                self.error = True
+                break
+
+            # See if any fatal errors happened that would allow us to
+            # terminate job sooner as we know it's not healthy anymore
+            for item in console_errors:
+                if item.get('error') and item.get('fatal'):
+                    for node in [server, client]:
+                        if node.match_console_string(item['error']):
+                            self.logger.warning("Matched fatal error in logs: " + item['error'] + ' on node ' + node.name + " Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'])
+                            self.error = True
+                            message = 'Fatal Error "' + item['error'] + '" on ' + str(node.name)
+                            corefile = node.dump_core("fatalerror")
+                            if not watch.wait_exit(node.process, 300):
+                                self.logger.warning("Timeout waiting for crashdump generation on fatalerror on " + str(node.name) + " Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'])
+                            mycrashanalyzer.crasher_add_work(self.fsinfo, corefile, testinfo, clientdistro, self.clientarch, workitem, message, TIMEOUT=True, COND=self.out_cond, QUEUE=self.out_queue)
+                    # Cannot break from the above loop
+                    if self.error:
+                        break
+            if self.error:
+                break # the above break only breaks from the for loop
+
+            # Also timeout both full test and single subtest
+            if (time.time() > deadlinetime) or \
+               (time.time() - client.last_test_line_time > single_subtest_timeout):
+                self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Job timed out, terminating")
+                self.error = True
+                message = "Timeout"
+                self.TimeoutDetected = True
+                # Now lets dump qemu crashdumps of the server and client
+                clientcore = client.dump_core("timeout")
+                servercore = server.dump_core("timeout")
+                dump_deadline = time.time() + 300
+                while client.check_node_alive() and server.check_node_alive():
+                    if time.time() > dump_deadline:
+                        self.logger.warning("Buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " Timeout waiting for crashdump generation on timeout")
+                        break
+                    watch.wait(dump_deadline - time.time())
+                if clientcore:
+                    mycrashanalyzer.crasher_add_work(self.fsinfo, clientcore, testinfo, clientdistro, self.clientarch, workitem, message, TIMEOUT=True, COND=self.out_cond, QUEUE=self.out_queue)
+                if servercore:
+                    mycrashanalyzer.crasher_add_work(self.fsinfo, servercore, testinfo, serverdistro, self.serverarch, workitem, message, TIMEOUT=True, COND=self.out_cond, QUEUE=self.out_queue)
+                # XXX kick some additional analyzer for backtraces or such
+                break
+
+        if workitem.Aborted or testinfo.get("Cancelled"):
             self.logger.warning("job for buildid " + str(workitem.buildnr) + " aborted")
             try:
                 testprocess.terminate()
@@ -843,6 +1107,7 @@ class Tester(object):
 
         failedsubtests = ""
         skippedsubtests = ""
+        subtestdurations = []
         if self.error:
             Failure = True
             try:
@@ -850,12 +1115,7 @@ class Tester(object):
             except OSError:
                 pass # No such process?
             else:
-                try:
-                    outs, errs = testprocess.communicate()
-                    self.testouts += outs
-                    self.testerrs += errs
-                except:
-                    pass # did it die?
+                watch.wait_exit(testprocess, 180)
 
         else:
             # Don't go here if we had a panic, it's unimportant.
@@ -890,6 +1150,8 @@ class Tester(object):
                                 continue # no subtests?
 
                             for subtest in yamltest.get('SubTests', []):
+                                if subtest.get('status') == "PASS" and subtest.get('duration'):
+                                    subtestdurations.append((subtest['name'], subtest['duration']))
                                 if not subtest.get('status'):
                                     if (testscript != "sanity-dom") or (subtest['name'] not in ("test_sanity", "test_sanityn")):
                                         subtest['status'] = "FAIL"
@@ -930,6 +1192,10 @@ class Tester(object):
 
         duration = self.get_duration()
         message += "(" + str(duration) + "s)"
+        if not self.error and self.fsinfo.get('runtime-history'):
+            # Crashed and killed runs say nothing about how long it takes
+            self.fsinfo['runtime-history'].record_test(testinfo, distro, duration)
+            self.fsinfo['runtime-history'].record_subtests(testscript, testinfo['fstype'], subtestdurations)
 
         # See if there was anything in error logs
         matched_server_errors = []
@@ -1018,13 +1284,17 @@ class Tester(object):
 
         #pprint(self.testerrs)
 
-        # Now kill the client and server
-        server.terminate()
-        #pprint(souts)
-        #pprint(serrs)
-        client.terminate()
-        #pprint(couts)
-        #pprint(cerrs)
+        # Now kill the client and server, unless everything went fine and
+        # they can go on with the next test of this build.
+        # Any failure, crash or warning means a reboot.
+        if self.error or self.Crashed or Failure or warnings or uniq_warns or \
+           not self.keep_session(sessionkey, sessionjobs, server, client, watch, testenv):
+            server.terminate()
+            #pprint(souts)
+            #pprint(serrs)
+            client.terminate()
+            #pprint(couts)
+            #pprint(cerrs)
 
         # See if we have any crashdumps
         crashname = self.collect_crashdump(server)
@@ -1042,12 +1312,12 @@ class Tester(object):
         # We crashed, but did not find the crash file, huh?
         if self.Crashed:
             self.logger.warning("job for buildid " + str(workitem.buildnr) + " test " + testinfo['name'] + '-' + testinfo['fstype'] + " We had a crash " + message + "but no crashdumps?")
-            self.logger.warning("client stderr: " + client.errs)
-            self.logger.warning("server stderr: " + server.errs)
+            self.logger.warning("client stderr: " + str(client.errs))
+            self.logger.warning("server stderr: " + str(server.errs))
 
         del client
         del server
 
-        workitem.UpdateTestStatus(testinfo, message, Finished=True, Crash=self.CrashDetected, TestStdOut=self.testouts, TestStdErr=self.testerrs, Failed=Failure, Subtests=failedsubtests, Skipped=skippedsubtests, Warnings=warnings)
+        workitem.UpdateTestStatus(testinfo, message, Finished=True, Crash=self.CrashDetected, TestStdOut=self.testouts.reference(), TestStdErr=self.testerrs.reference(), Failed=Failure, Subtests=failedsubtests, Skipped=skippedsubtests, Warnings=warnings)
 
         return True
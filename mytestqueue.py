@@ -0,0 +1,217 @@
+""" Fair share test queue, drop in replacement for the PriorityQueue
+    of TupleSortingOn0((priority, testinfo, workitem)) entries
+"""
+import time
+import heapq
+import queue
+import threading
+import itertools
+from collections import deque
+
+STRIDE1 = 1 << 20
+
+class Flow(object):
+    """ Queued entries of one share with its stride scheduling state """
+    def __init__(self, key, weight):
+        self.key = key
+        self.stride = STRIDE1 / max(weight, 0.001)
+        self.passvalue = 0
+        self.heap = []
+
+class FairShareQueue(object):
+    """ Urgent entries (priority[0] <= urgent, initial and highprio
+        testing) are always served first in priority order. Everything
+        else is split into flows by share_of(entry) and served by stride
+        scheduling with weight_of(share) so a single big push cannot take
+        all the testers. Inside a flow entries go in priority order.
+        An entry that waited longer than maxwait is served first no matter
+        whose it is, so nobody starves.
+        Entries with priority[0] >= speculative only run when there is
+        nothing else to do. """
+    def __init__(self, share_of, weight_of, urgent=3, speculative=1 << 40, maxwait=4 * 3600, samples=500):
+        self.share_of = share_of
+        self.weight_of = weight_of
+        self.urgent = urgent
+        self.speculative = speculative
+        self.speculativeheap = []
+        self.maxwait = maxwait
+        self.samples = samples
+        self.urgentheap = []
+        self.flows = {}
+        self.globalpass = 0
+        self.count = 0
+        self.seq = itertools.count()
+        self.waits = {}
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+
+    @staticmethod
+    def _lane(priority):
+        if isinstance(priority, tuple):
+            return priority[0]
+        return priority
+
+    def put(self, entry, block=True, timeout=None):
+        item = (entry[0], next(self.seq), time.time(), entry)
+        with self.mutex:
+            if self._lane(entry[0]) <= self.urgent:
+                heapq.heappush(self.urgentheap, item)
+            elif self._lane(entry[0]) >= self.speculative:
+                heapq.heappush(self.speculativeheap, item)
+            else:
+                key = self.share_of(entry)
+                flow = self.flows.get(key)
+                if flow is None:
+                    flow = Flow(key, self.weight_of(key))
+                    self.flows[key] = flow
+                if not flow.heap:
+                    # Idle flows do not get to bank credit
+                    flow.passvalue = max(flow.passvalue, self.globalpass)
+                heapq.heappush(flow.heap, item)
+            self.count += 1
+            self.not_empty.notify()
+
+    def _pick_flow(self):
+        now = time.time()
+        oldest = None
+        best = None
+        for flow in self.flows.values():
+            if not flow.heap:
+                continue
+            head = flow.heap[0]
+            if now - head[2] > self.maxwait:
+                if oldest is None or head[2] < oldest.heap[0][2]:
+                    oldest = flow
+            if best is None or (flow.passvalue, head[0], head[1]) < (best.passvalue, best.heap[0][0], best.heap[0][1]):
+                best = flow
+        if oldest is not None:
+            return oldest
+        return best
+
+    def _record_wait(self, label, waited):
+        waits = self.waits.get(label)
+        if waits is None:
+            waits = deque(maxlen=self.samples)
+            self.waits[label] = waits
+        waits.append(waited)
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if not block:
+                if not self.count:
+                    raise queue.Empty
+            elif timeout is None:
+                while not self.count:
+                    self.not_empty.wait()
+            else:
+                deadline = time.time() + timeout
+                while not self.count:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self.not_empty.wait(remaining)
+
+            flow = None
+            if not self.urgentheap:
+                flow = self._pick_flow()
+            if self.urgentheap:
+                item = heapq.heappop(self.urgentheap)
+                label = "urgent"
+            elif flow is None:
+                item = heapq.heappop(self.speculativeheap)
+                label = "speculative"
+            else:
+                item = heapq.heappop(flow.heap)
+                self.globalpass = max(self.globalpass, flow.passvalue)
+                flow.passvalue += flow.stride
+                label = "/".join(str(x) for x in flow.key)
+                if not flow.heap and len(self.flows) > 1000:
+                    del self.flows[flow.key]
+            self.count -= 1
+            self._record_wait(label, time.time() - item[2])
+            return item[3]
+
+    def remove_if(self, predicate):
+        """ Take out and return all entries predicate(entry) is true for """
+        removed = []
+        with self.mutex:
+            for heap in [self.urgentheap, self.speculativeheap] + [flow.heap for flow in self.flows.values()]:
+                keep = []
+                for item in heap:
+                    if predicate(item[3]):
+                        removed.append(item[3])
+                    else:
+                        keep.append(item)
+                if len(keep) != len(heap):
+                    heap[:] = keep
+                    heapq.heapify(heap)
+            self.count -= len(removed)
+        return removed
+
+    def take_first(self, predicate):
+        """ Take out the first entry predicate(entry) is true for or
+            return None. Only entries as urgent as the ones get would
+            serve next are looked at, so nothing more urgent is passed
+            over. Taking from a flow is charged to it as usual. """
+        with self.mutex:
+            if self.urgentheap:
+                candidates = [(None, self.urgentheap)]
+            elif any(flow.heap for flow in self.flows.values()):
+                candidates = [(flow, flow.heap) for flow in self.flows.values() if flow.heap]
+            else:
+                candidates = [(None, self.speculativeheap)]
+            best = None
+            for flow, heap in candidates:
+                for item in heap:
+                    if (best is None or item[:2] < best[2][:2]) and predicate(item[3]):
+                        best = (flow, heap, item)
+            if best is None:
+                return None
+            flow, heap, item = best
+            heap.remove(item)
+            heapq.heapify(heap)
+            if flow is None:
+                label = "urgent" if heap is self.urgentheap else "speculative"
+            else:
+                self.globalpass = max(self.globalpass, flow.passvalue)
+                flow.passvalue += flow.stride
+                label = "/".join(str(x) for x in flow.key)
+            self.count -= 1
+            self._record_wait(label, time.time() - item[2])
+            return item[3]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def put_nowait(self, entry):
+        return self.put(entry, block=False)
+
+    def qsize(self):
+        with self.mutex:
+            return self.count
+
+    def empty(self):
+        with self.mutex:
+            return not self.count
+
+    @property
+    def queue(self):
+        """ Snapshot of all queued entries, in no particular order """
+        with self.mutex:
+            entries = [item[3] for item in self.urgentheap + self.speculativeheap]
+            for flow in self.flows.values():
+                entries.extend(item[3] for item in flow.heap)
+            return entries
+
+    def wait_percentiles(self):
+        """ {share: (p50, p90, p99, samples)} of recent queue waits in seconds """
+        result = {}
+        with self.mutex:
+            snapshot = [(label, sorted(waits)) for label, waits in self.waits.items()]
+        for label, waits in snapshot:
+            if not waits:
+                continue
+            last = len(waits) - 1
+            result[label] = (waits[int(last * 0.5)], waits[int(last * 0.9)],
+                             waits[int(last * 0.99)], len(waits))
+        return result